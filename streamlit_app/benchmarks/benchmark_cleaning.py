@@ -0,0 +1,85 @@
+"""
+Benchmark and verification of the vectorized data cleaning against the previous row-wise implementation
+(Series.map with safe_decode and adjust_invalid_times), and of the deduplication of the hashed rows against
+drop_duplicates.
+
+Usage (from the streamlit_app folder):
+    python benchmarks/benchmark_cleaning.py --rows 2000000
+"""
+import argparse
+import os
+import sys
+import time
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import utils.data_cleaning as data_cleaning
+import utils.functions as functions
+
+def synthetic_raw_data(rows, stops=2000, seed=0):
+    # Renamed raw data with the columns touched by the cleaning: latin1-mangled umlauts in the stop names,
+    # departure times above 24h, missing next stops and duplicated rows
+    rng = np.random.default_rng(seed)
+    names = np.array([(f"Zürich, Bürkliplatz {i}".encode("utf-8").decode("latin1") if i % 3 == 0 else f"Zürich, Stop {i}")
+                      for i in range(stops)] + [np.nan], dtype=object)
+    seconds = rng.integers(4 * 3600, 27 * 3600, rows)
+    departure_time = np.array([f"{s // 3600:02d}:{s % 3600 // 60:02d}:{s % 60:02d}" for s in range(27 * 3600)], dtype=object)
+    data = pd.DataFrame({
+        "stop_current": names[rng.integers(0, stops, rows)],
+        "stop_next": names[rng.integers(0, stops + 1, rows)],
+        "departure_time": departure_time[seconds],
+        "distance": rng.integers(100, 2000, rows),
+        "passenger_amount": rng.integers(0, 5, rows) * 1.5,
+    })
+    return pd.concat([data, data.iloc[: rows // 100]], ignore_index=True)
+
+def rowwise_clean_data(data):
+    # Previous implementation, one Python call per row
+    data["stop_next"] = data["stop_next"].map(data_cleaning.safe_decode)
+    data["stop_current"] = data["stop_current"].map(data_cleaning.safe_decode)
+    data["departure_time"] = data["departure_time"].map(data_cleaning.adjust_invalid_times)
+    data["departure_time"] = pd.to_datetime(data["departure_time"], format="%H:%M:%S").dt.time
+    data["distance"] = data["distance"] / 1000
+    return data.drop_duplicates()
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rows", type=int, default=1_000_000)
+    args = parser.parse_args()
+
+    data = synthetic_raw_data(args.rows)
+
+    start = time.perf_counter()
+    expected = rowwise_clean_data(data.copy())
+    rowwise_seconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    result = data_cleaning.clean_data(data.copy())
+    vectorized_seconds = time.perf_counter() - start
+
+    # Deduplication alone, on the cleaned rows with 1% of them repeated
+    repeated = pd.concat([result, result.sample(frac=0.01, random_state=0)], ignore_index=True)
+    start = time.perf_counter()
+    expected_rows = repeated.drop_duplicates()
+    drop_duplicates_seconds = time.perf_counter() - start
+    start = time.perf_counter()
+    deduplicated = data_cleaning.drop_duplicated_rows(repeated)
+    hashed_seconds = time.perf_counter() - start
+    pd.testing.assert_frame_equal(deduplicated, expected_rows, check_exact=True)
+
+    # Same rows and values, with the departure times stored as seconds since midnight
+    assert result["departure_time"].dtype == "int32"
+    result["departure_time"] = functions.seconds_to_time(result["departure_time"])
+    pd.testing.assert_frame_equal(result, expected, check_exact=True)
+
+    print(f"rows: {len(data):,}")
+    print(f"row-wise cleaning:   {rowwise_seconds:8.3f} s")
+    print(f"vectorized cleaning: {vectorized_seconds:8.3f} s")
+    print(f"speedup:             {rowwise_seconds / vectorized_seconds:8.2f} x")
+    print(f"drop_duplicates:     {drop_duplicates_seconds:8.3f} s")
+    print(f"hashed rows:         {hashed_seconds:8.3f} s ({deduplicated.attrs['duplicated_rows']:,} rows dropped, "
+          f"{data_cleaning.DEDUP_WORKERS} thread(s))")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,208 @@
+"""
+Benchmark of the metric cube against the previous implementations: the per-year partials computed with one pivot
+table per metric, and calculate_metrics as it was before the partials (pivot tables of all the years, then
+aggregate_time_step("15S")).
+
+Usage (from the streamlit_app folder):
+    python benchmarks/benchmark_metrics.py --rows 2000000 --years 3
+"""
+import argparse
+import os
+import sys
+import time
+from collections.abc import Mapping
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import utils.functions as functions
+import utils.metrics as metrics
+import utils.sketches as sketches
+
+def synthetic_cleaned_data(rows, years, seed=0):
+    # Cleaned data with the columns and cardinalities used by the metrics
+    rng = np.random.default_rng(seed)
+    departure_time = rng.integers(0, 24 * 3600, rows).astype("int32") # Seconds since midnight, as in the cleaned data
+    lines = np.array([f"L{i}" for i in range(60)], dtype=object)
+    vehicles = np.array(["T", "B", "TR", "N", "BP", "BZ", "SB", "FB"], dtype=object)
+    line_codes = rng.integers(0, len(lines), rows)
+    data = pd.DataFrame({
+        "year": rng.choice([str(2015 + i) for i in range(years)], rows),
+        "departure_time": departure_time,
+        "line_name": lines[line_codes],
+        "type_transport": vehicles[line_codes % len(vehicles)],
+        "passenger_in": rng.random(rows) * 10,
+        "passenger_amount": rng.random(rows) * 50,
+        "distance": rng.random(rows) * 2,
+        "factor_average": rng.choice([365.0, 300.0, 0.0], rows),
+        "factor_workingDays": 251.0,
+        "factor_saturday": 52.0,
+        "factor_sunday": 62.0,
+        "factor_saturday_night": rng.random(rows) * 52,
+        "factor_sunday_night": rng.random(rows) * 62,
+        "seat_capacity": rng.integers(20, 90, rows).astype("float64"),
+        "carbon_intensity": rng.choice([0.029, 0.097, 0.072], rows),
+    })
+    # Capacities with 1 to 4 standing passengers per m2 (KAP_1m2 ... KAP_4m2)
+    standing_area = rng.integers(5, 30, rows)
+    for m in range(1, 5):
+        data[f"passenger_capacity_{m}"] = data["seat_capacity"] + m * standing_area
+    return data
+
+def pivot_partial_metrics(data):
+    # Previous implementation: one pivot table (full scan and hash-group) per metric
+    data = data.copy()
+    for name, values in metrics.calculate_measures(data).items():
+        data[name] = values
+
+    partials = {}
+    partials["pkm_total"] = data.pivot_table(index="year", values="passenger_kilometre", aggfunc="sum")
+    partials["number_passengers"] = data.pivot_table(index="year", columns="line_name", values="flow_passengers_in", aggfunc="sum")
+    partials["occupancy_trend"] = data.pivot_table(index="departure_time", columns="year",
+                                                   values=["passenger_amount_workingDay", "passenger_amount_nonWorkingDay", "passenger_amount_night"],
+                                                   aggfunc="sum")
+    partials["passenger_day"] = data.pivot_table(index="departure_time", columns="year", values="passenger_amount_night", aggfunc="sum")
+    partials["pkm_amount"] = data.pivot_table(index="departure_time", columns=["year", "type_transport"], values="passenger_kilometre", aggfunc="sum")
+    partials["number_lines"] = data.groupby(["year", "type_transport"])["line_name"].nunique()
+    partials["capacity_factor"] = data.groupby(["departure_time", "year", "type_transport"])["ocuppancy_rate_seats"].agg(["sum", "count"])
+    partials["distance_travelled"] = data.pivot_table(index="year", columns="type_transport", values="distance_travelled", aggfunc="sum")
+    partials["pkm_co2_public_transport"] = data.pivot_table(index="year", columns="type_transport", values="passenger_kilometre_co2", aggfunc="sum")
+    # The crowding sketches have no pivot table counterpart, both implementations build them from the rows
+    partials["crowding"] = sketches.build_sketches(data)
+    return partials
+
+def aggregate_time_step(df, amount="5min"):
+    # Reference copy of the previous utils/functions.aggregate_time_step
+    df.index = pd.to_datetime(df.index, format="%H:%M:%S")
+    if amount != " ":
+        df = df.resample(amount).mean()
+    df.index = df.index.time
+
+    return df
+
+def baseline_calculate_metrics(data):
+    # Reference copy of the previous utils/metrics.calculate_metrics (without st.cache_data, and with the "15s"
+    # alias of the deprecated "15S"), which expects the departure times as "%H:%M:%S" strings
+
+    # Adding needed metrics
+    data["flow_passengers_in"] = data["passenger_in"] * data["factor_average"]
+    data["ocuppancy_rate_seats"] = data["passenger_amount"] / data["seat_capacity"]
+    data["passenger_amount_workingDay"] = data["passenger_amount"] * data["factor_workingDays"] / metrics.TOTAL_WORKING_DAYS_FACTOR
+    data["passenger_amount_nonWorkingDay"] = ((data["passenger_amount"] * data["factor_saturday"] / metrics.TOTAL_SATURDAYS_FACTOR) +
+                                    (data["passenger_amount"] * data["factor_sunday"] / metrics.TOTAL_SUNDAYS_FACTOR))
+    data["passenger_amount_night"] = ((data["passenger_amount"] * data["factor_saturday_night"] / metrics.TOTAL_SATURDAYS_FACTOR) +
+                                    (data["passenger_amount"] * data["factor_sunday_night"]) / metrics.TOTAL_SUNDAYS_FACTOR)
+    data["passenger_kilometre"] = data["passenger_amount"] * data["distance"] * data["factor_average"]
+    data["passenger_kilometre_co2"] = data["passenger_kilometre"] * data["carbon_intensity"]
+    data["distance_travelled"] = data["distance"] * data["factor_average"]
+
+    pkm_total = data.pivot_table(index="year", values="passenger_kilometre", aggfunc="sum")
+
+    number_passengers = data.pivot_table(index="year", columns="line_name", values="flow_passengers_in", aggfunc="sum")
+
+    occupancy_trend = data.pivot_table(index="departure_time",
+                                       columns="year",
+                                       values=["passenger_amount_workingDay", "passenger_amount_nonWorkingDay", "passenger_amount_night"],
+                                       aggfunc="sum")
+    occupancy_trend = (aggregate_time_step(occupancy_trend, amount="15s")
+                           .rename({"passenger_amount_nonWorkingDay": "Non-working days",
+                                    "passenger_amount_workingDay": "Working days",
+                                    "passenger_amount_night": "Non-working nights"},
+                                   axis=1))
+
+    passengers_night = data.pivot_table(index="departure_time", columns="year", values="passenger_amount_night", aggfunc="sum")
+    passengers_night = aggregate_time_step(passengers_night, amount="15s")
+
+    pkm_amount = data.pivot_table(index=["departure_time"], columns=["year", "type_transport"], values="passenger_kilometre", aggfunc="sum")
+    pkm_amount = aggregate_time_step(pkm_amount, amount="15s")
+    pkm_amount = pkm_amount.stack(future_stack=True).stack(future_stack=True).reset_index().rename({"level_0":"time","type_transport":"vehicle_class",
+                                                                  0:"pkm"}, axis=1)
+
+    number_lines = (data.groupby(["year", "type_transport"])[["line_name"]]
+                        .nunique()
+                        .unstack())
+    number_lines.columns = number_lines.columns.droplevel(0)
+
+    capacity_factor = data.pivot_table(index="departure_time", columns=["year", "type_transport"], values="ocuppancy_rate_seats").fillna(0)
+
+    distance_travelled = (data.pivot_table(index="year", columns="type_transport", values="distance_travelled", aggfunc="sum")
+                            .unstack()
+                            .reset_index()
+                            .rename({"type_transport":"vehicle_class",
+                                     0:"distance_travelled"}, axis=1))
+
+    pkm_co2_public_transport = data.pivot_table(index="year", columns="type_transport", values="passenger_kilometre_co2", aggfunc="sum")
+    pkm_co2_car = pkm_total * metrics.CARBON_INTENSITY_VEHICLE_FLEET
+    saved_co2 = pkm_co2_car.sub(pkm_co2_public_transport.sum(axis=1), axis="rows") / 1000 # Translate to tons CO2-eq
+
+    all_df = {"number_passengers": number_passengers,
+              "occupancy_trend": occupancy_trend,
+              "passenger_day" : passengers_night,
+              "pkm_amount": pkm_amount,
+              "number_lines": number_lines,
+              "capacity_factor": capacity_factor,
+              "distance_travelled": distance_travelled,
+              "saved_co2": saved_co2}
+
+    return all_df
+
+def assert_equal(left, right, obj):
+    # Metrics are frames, series or mappings of them (e.g. the levels of the time roll-ups, the pkm tensor)
+    if isinstance(right, Mapping):
+        assert sorted(left) == sorted(right), f"{obj}: keys differ"
+        for key in right:
+            assert_equal(left[key], right[key], f"{obj} {key}")
+    elif isinstance(right, pd.Series):
+        pd.testing.assert_series_equal(left, right, obj=obj)
+    else:
+        pd.testing.assert_frame_equal(left, right, obj=obj)
+
+def timed(function, data, repeat):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = function(data)
+        timings.append(time.perf_counter() - start)
+    return result, min(timings)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rows", type=int, default=1_000_000)
+    parser.add_argument("--years", type=int, default=3)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    data = synthetic_cleaned_data(args.rows, args.years)
+    # The previous cleaned data had the departure times as strings
+    baseline_data = data.assign(departure_time=pd.to_datetime(data["departure_time"], unit="s").dt.strftime("%H:%M:%S"))
+    year_frames = [year_data for _, year_data in data.groupby("year", sort=True)]
+
+    pivot_partials, pivot_seconds = timed(lambda frames: [pivot_partial_metrics(f) for f in frames], year_frames, args.repeat)
+    cube_partials, cube_seconds = timed(lambda frames: [metrics.calculate_partial_metrics(f) for f in frames], year_frames, args.repeat)
+    cube_result, combine_seconds = timed(metrics.combine_partial_metrics, cube_partials, args.repeat)
+    baseline_result, baseline_seconds = timed(baseline_calculate_metrics, baseline_data, args.repeat)
+    _, calculate_seconds = timed(metrics.calculate_metrics, data, args.repeat)
+
+    # Both implementations must produce the same metric frames (up to floating point summation order)
+    pivot_result = metrics.combine_partial_metrics(pivot_partials)
+    for name, metric in pivot_result.items():
+        assert_equal(cube_result[name], metric, name)
+
+    # All the frames of the previous calculate_metrics, end to end. Its capacity factor is indexed by the departure
+    # time strings, the metric cube by datetime.time objects
+    baseline_result["capacity_factor"].index = pd.Index(functions.to_datetime_index(baseline_result["capacity_factor"].index).time,
+                                                        name="departure_time")
+    for name, metric in baseline_result.items():
+        assert_equal(cube_result[name], metric, f"{name} (previous calculate_metrics)")
+
+    print(f"rows: {args.rows:,}  years: {args.years}")
+    print(f"aggregation with pivot tables: {pivot_seconds:8.3f} s")
+    print(f"aggregation with metric cube:  {cube_seconds:8.3f} s")
+    print(f"speedup:                       {pivot_seconds / cube_seconds:8.2f} x")
+    print(f"combination of the partials:   {combine_seconds:8.3f} s (common to both)")
+    print(f"previous calculate_metrics:    {baseline_seconds:8.3f} s")
+    print(f"calculate_metrics:             {calculate_seconds:8.3f} s (also builds the roll-ups and sketches)")
+    print(f"speedup against the previous:  {baseline_seconds / calculate_seconds:8.2f} x")
+
+if __name__ == "__main__":
+    main()
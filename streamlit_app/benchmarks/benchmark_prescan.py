@@ -0,0 +1,55 @@
+"""
+Benchmark of the pre-scan of the ZIP files (utils/prescan.py): time of the pre-scan of a year against the time of
+loading and cleaning it, and the estimated rows, memory of the merged frame and peak memory against the actual
+ones. Each year is loaded in a process of its own, so that its peak memory is not that of the previous years.
+
+Usage (from the streamlit_app folder):
+    python benchmarks/benchmark_prescan.py --rows 3000000 --years 2
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import utils.data_loading as data_loading
+import utils.pipeline as pipeline
+import utils.prescan as prescan
+import utils.profiling as profiling
+from benchmarks.synthetic_data import generate_archives
+
+DATA_DIRECTORY = os.path.join(tempfile.gettempdir(), "vbz_synthetic_data") # Shared with benchmark_suite.py
+
+def load_year(path, year):
+    # Rows, merged memory, peak memory above the memory before loading and time of loading and cleaning a year
+    profiling.reset_peak_rss()
+    before = profiling.read_peak_rss_mb()
+    start = time.perf_counter()
+    data = data_loading.load_and_merge_zip(path, year)
+    memory_mb = data.memory_usage(deep=True, index=False).sum() / 1024**2
+    rows = len(data)
+    pipeline.clean_data(data)
+    return rows, memory_mb, profiling.read_peak_rss_mb() - before, time.perf_counter() - start
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rows", type=int, default=3_000_000)
+    parser.add_argument("--years", type=int, default=2)
+    parser.add_argument("--directory", default=DATA_DIRECTORY)
+    args = parser.parse_args()
+
+    for year, path in generate_archives(args.directory, args.rows, args.years):
+        start = time.perf_counter()
+        plan = prescan.plan_ingestion(prescan.scan_archives([(path, path)]))["files"][0]
+        scan_seconds = time.perf_counter() - start
+        with ProcessPoolExecutor(max_workers=1) as executor:
+            rows, memory_mb, peak_mb, load_seconds = executor.submit(load_year, path, year).result()
+        print(f"{year}: pre-scan {scan_seconds:.2f} s, load and clean {load_seconds:.1f} s")
+        print(f"  rows         estimated {plan['rows']:>12,}   actual {rows:>12,}")
+        print(f"  memory (MB)  estimated {plan['memory_mb']:>12,.1f}   actual {memory_mb:>12,.1f}")
+        print(f"  peak (MB)    estimated {plan['peak_memory_mb']:>12,.1f}   actual {peak_mb:>12,.1f}")
+
+if __name__ == "__main__":
+    main()
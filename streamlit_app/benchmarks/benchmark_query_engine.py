@@ -0,0 +1,99 @@
+"""
+Benchmark of the query engine (utils/query_engine.py) on a stored dataset: the metrics and the slices of the
+Dashboard are queried with DuckDB and with pandas, and compared with the metrics of the in-memory pipeline.
+
+The dataset is built from synthetic archives (see synthetic_data.py) unless a stored dataset is given.
+
+Usage (from the streamlit_app folder):
+    python benchmarks/benchmark_query_engine.py --rows 1000000 --years 3
+    python benchmarks/benchmark_query_engine.py --dataset output/processed_data_2021-2023
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+import pandas as pd
+
+APP_DIRECTORY = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, APP_DIRECTORY)
+import utils.data_loading as data_loading
+import utils.functions as functions
+import utils.metrics as metrics
+import utils.pipeline as pipeline
+import utils.query_engine as query_engine
+import utils.storage as storage
+from benchmarks.benchmark_suite import DATA_DIRECTORY
+from benchmarks.synthetic_data import generate_archives, FIRST_YEAR
+
+RTOL = 1e-6
+
+def build_dataset(path, rows, years, seed):
+    # Stored dataset of the synthetic archives, processed as in the app
+    archives = generate_archives(DATA_DIRECTORY, rows, years, FIRST_YEAR, seed)
+    data = functions.concat_frames([pipeline.clean_data(data_loading.load_and_merge_zip(archive, year))
+                                    for year, archive in archives])
+    return storage.write_dataset(data, path)
+
+def timed(function, *args, repeat=3, **kwargs):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = function(*args, **kwargs)
+        times.append(time.perf_counter() - start)
+    return min(times), result
+
+def assert_equal_metrics(expected, result, name=""):
+    # Metric frames are nested in dictionaries (e.g. the time roll-ups)
+    if isinstance(expected, dict):
+        for key in expected:
+            assert_equal_metrics(expected[key], result[key], f"{name}/{key}")
+    elif isinstance(expected, pd.DataFrame):
+        pd.testing.assert_frame_equal(expected, result, check_dtype=False, rtol=RTOL, obj=name)
+    else:
+        pd.testing.assert_series_equal(expected, result, check_dtype=False, rtol=RTOL, obj=name)
+
+def slices(path):
+    # Queries of the Dashboard: (name, keys, filters, years)
+    years = storage.dataset_years(path)
+    lines = query_engine.distinct_values(path, "line_name", engine="pandas")
+    stops = query_engine.distinct_values(path, "stop_current", engine="pandas")
+    return [("all the data by year", ["year"], {}, None),
+            ("one line by time, last year", ["year", "departure_time"], {"line_name": lines[:1]}, years[-1:]),
+            ("five stops by line", ["year", "line_name"], {"stop_current": stops[:5], "direction": [1]}, None)]
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rows", type=int, default=1_000_000, help="rows of REISENDE per year of the synthetic data")
+    parser.add_argument("--years", type=int, default=3)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--dataset", help="stored dataset to query instead of the synthetic data")
+    args = parser.parse_args()
+
+    engines = query_engine.ENGINES if query_engine.duckdb is not None else ["pandas"]
+    with tempfile.TemporaryDirectory() as directory:
+        path = args.dataset or build_dataset(os.path.join(directory, "dataset"), args.rows, args.years, args.seed)
+
+        print("metrics of the whole dataset")
+        seconds, expected = timed(lambda: metrics.calculate_metrics(storage.read_dataset(path)), repeat=args.repeat)
+        print(f"  {'in memory (read + pipeline)':<30} {seconds:8.3f} s")
+        for engine in engines:
+            seconds, result = timed(query_engine.calculate_metrics, path, engine=engine, repeat=args.repeat)
+            # The crowding sketches are built from the rows, the query engine has none (see metrics.crowding)
+            assert_equal_metrics({name: frame for name, frame in expected.items() if name != "crowding"}, result)
+            print(f"  {engine:<30} {seconds:8.3f} s   same metrics")
+
+        print("slices")
+        measures = ["passenger_kilometre", "flow_passengers_in", query_engine.OCCUPANCY_COUNT]
+        for name, keys, filters, years in slices(path):
+            results = {}
+            for engine in engines:
+                seconds, results[engine] = timed(query_engine.aggregate, path, keys, measures, filters, years,
+                                                 engine=engine, repeat=args.repeat)
+                print(f"  {name:<30} {engine:<7} {seconds:8.3f} s   {len(results[engine]):>6} rows")
+            if len(results) > 1:
+                pd.testing.assert_frame_equal(results["pandas"], results["duckdb"], check_dtype=False, rtol=RTOL)
+
+if __name__ == "__main__":
+    main()
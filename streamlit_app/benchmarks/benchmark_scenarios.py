@@ -0,0 +1,67 @@
+"""
+Benchmark of the CO2 scenarios (utils/scenarios.py): avoided emissions of many scenarios (random intensities of
+the vehicle classes and fleet mixes) computed at once from the passenger-kilometre tensor, against one scenario at
+a time as saved_co2 is computed in utils/metrics.py. The scenario of the current intensities is checked against
+saved_co2.
+
+Usage (from the streamlit_app folder):
+    python benchmarks/benchmark_scenarios.py --rows 2000000 --years 3 --scenarios 1000
+"""
+import argparse
+import os
+import sys
+import time
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import utils.global_values as global_values
+import utils.metrics as metrics
+import utils.scenarios as scenarios
+from benchmarks.benchmark_metrics import synthetic_cleaned_data
+
+def one_at_a_time(pkm, pkm_total, intensities, fleet_mixes):
+    # Each scenario as saved_co2: emissions of the fleet minus those of the vehicle classes, by year
+    results = []
+    for scenario_intensities, fleet_mix in zip(intensities, fleet_mixes):
+        car_intensity = sum(share / sum(fleet_mix) * intensity for share, intensity in zip(fleet_mix, scenarios.FLEET_INTENSITY))
+        pkm_co2 = pkm.mul(pd.Series(scenario_intensities, index=pkm.columns), axis=1)
+        results.append((pkm_total * car_intensity - pkm_co2.sum(axis=1)) / 1000)
+    return pd.concat(results, axis=1).T.to_numpy()
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rows", type=int, default=2_000_000)
+    parser.add_argument("--years", type=int, default=3)
+    parser.add_argument("--scenarios", type=int, default=1000)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    data = synthetic_cleaned_data(args.rows, args.years, args.seed)
+    # Intensities of the vehicle classes, as attached by utils/data_loading.py
+    data["carbon_intensity"] = data["type_transport"].map(global_values.CARBON_INTENSITY_TRANSPORT_VBZ["carbon_intensity"]).astype("float64")
+    all_df = metrics.calculate_metrics(data)
+    arrays = scenarios.tensor_arrays(all_df["pkm_tensor"])
+    print(f"tensor: {len(arrays['years'])} years x {len(arrays['vehicle_classes'])} vehicle classes x {len(arrays['hours'])} hours")
+
+    baseline = scenarios.avoided_emissions(arrays, scenarios.baseline_intensities(arrays["vehicle_classes"]), scenarios.FLEET_MIX)
+    np.testing.assert_allclose(baseline[0], all_df["saved_co2"].to_numpy().ravel(), rtol=1e-9)
+    print("current intensities: same emissions avoided as saved_co2")
+
+    rng = np.random.default_rng(args.seed)
+    intensities = rng.random((args.scenarios, len(arrays["vehicle_classes"]))) * 0.1
+    fleet_mixes = rng.random((args.scenarios, len(scenarios.FLEET_TYPES)))
+    start = time.perf_counter()
+    vectorized = scenarios.avoided_emissions(arrays, intensities, fleet_mixes)
+    vectorized_seconds = time.perf_counter() - start
+
+    pkm = pd.DataFrame(arrays["pkm"].sum(axis=2), index=arrays["years"], columns=arrays["vehicle_classes"])
+    start = time.perf_counter()
+    looped = one_at_a_time(pkm, pd.Series(arrays["pkm_total"], index=arrays["years"]), intensities, fleet_mixes)
+    looped_seconds = time.perf_counter() - start
+    np.testing.assert_allclose(vectorized, looped, rtol=1e-9)
+    print(f"{args.scenarios} scenarios: matrix product {vectorized_seconds * 1000:.2f} ms, "
+          f"one at a time {looped_seconds * 1000:.1f} ms (x{looped_seconds / vectorized_seconds:.0f}), same results")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,61 @@
+"""
+Benchmark of the crowding sketches (utils/sketches.py): percentiles of the crowding by line and by hour read from
+the sketches of the years, against the exact (weighted) percentiles computed on the rows. Checks that the error of
+every percentile is within sketches.RELATIVE_ACCURACY.
+
+Usage (from the streamlit_app folder):
+    python benchmarks/benchmark_sketches.py --rows 2000000 --years 3
+"""
+import argparse
+import os
+import sys
+import time
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import utils.sketches as sketches
+from benchmarks.benchmark_metrics import synthetic_cleaned_data
+
+QUANTILES = [0.5, 0.9, 0.99]
+
+def exact_quantiles(data, keys, capacity):
+    # Weighted quantiles of the rows of each group: the smallest value whose cumulated weight reaches the rank
+    crowding = data["passenger_amount"] / data[capacity]
+    df = pd.DataFrame({**{key: data[key] for key in keys}, "value": crowding, "weight": data["factor_average"]})
+    df = df[np.isfinite(df["value"]) & (df["weight"] > 0)].sort_values(keys + ["value"])
+    df["cumulative"] = df.groupby(keys)["weight"].cumsum()
+    totals = df.groupby(keys)["weight"].transform("sum")
+    return pd.DataFrame({f"P{quantile * 100:g}": df[df["cumulative"] >= quantile * totals].groupby(keys)["value"].first()
+                         for quantile in QUANTILES})
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rows", type=int, default=2_000_000, help="rows of all the years")
+    parser.add_argument("--years", type=int, default=3)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    data = synthetic_cleaned_data(args.rows, args.years, args.seed)
+    data["time"] = data["departure_time"] // sketches.BUCKET_SECONDS * sketches.BUCKET_SECONDS
+    start = time.perf_counter()
+    sketch = sketches.merge_sketches([sketches.build_sketches(year_data) for _, year_data in data.groupby("year")])
+    print(f"sketches of {len(data)} rows: {time.perf_counter() - start:.2f} s, {len(sketch)} bins")
+
+    for capacity in ["seat_capacity", "passenger_capacity_4"]:
+        capacity_sketch = sketch[sketch["capacity"] == capacity]
+        for keys in [["line_name"], ["time"]]:
+            start = time.perf_counter()
+            estimated = sketches.sketch_quantiles(capacity_sketch, keys, QUANTILES).drop(columns="weight")
+            sketch_seconds = time.perf_counter() - start
+            start = time.perf_counter()
+            exact = exact_quantiles(data, keys, capacity)
+            exact_seconds = time.perf_counter() - start
+            estimated.index = exact.index # Same groups, sorted by the keys
+            error = ((estimated - exact).abs() / exact).max().max()
+            assert error <= sketches.RELATIVE_ACCURACY + 1e-9, error
+            print(f"  {capacity:<22} by {keys[0]:<10} sketches {sketch_seconds:7.3f} s   exact {exact_seconds:7.3f} s   "
+                  f"max relative error {error:.4f} (bound {sketches.RELATIVE_ACCURACY})")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,91 @@
+"""
+Cold-start benchmark: import time of the processing modules and first-render latency of the app pages.
+Each measurement runs in a fresh Python process, so nothing is reused from a previous import.
+
+Usage (from the streamlit_app folder):
+    python benchmarks/benchmark_startup.py --repeat 5
+"""
+import argparse
+import os
+import pickle
+import subprocess
+import sys
+import tempfile
+
+APP_DIRECTORY = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, APP_DIRECTORY)
+
+MODULES = ["utils.functions", "utils.data_loading", "utils.data_cleaning", "utils.metrics", "utils.pipeline"]
+HEAVY_MODULES = ["streamlit", "plotly", "matplotlib"]
+PAGES = ["main.py", "pages/1_Dashboard.py"]
+
+IMPORT_CODE = """
+import sys, time
+start = time.perf_counter()
+import {module}
+seconds = time.perf_counter() - start
+print(seconds, ",".join(m for m in {heavy_modules!r} if m in sys.modules) or "-")
+"""
+
+RENDER_CODE = """
+import pickle, sys, time
+start = time.perf_counter()
+from streamlit.testing.v1 import AppTest
+app = AppTest.from_file(sys.argv[1], default_timeout=300)
+if len(sys.argv) > 2:
+    import pandas as pd
+    import utils.dataset_registry as dataset_registry
+    with open(sys.argv[2], "rb") as f:
+        metrics = pickle.load(f)
+    app.session_state["dataset"] = dataset_registry.open_dataset("benchmark", lambda: (pd.DataFrame(), metrics))
+app.run()
+first = time.perf_counter() - start
+start = time.perf_counter()
+app.run()
+print(first, time.perf_counter() - start, len(app.exception))
+"""
+
+def run_python(code, *args):
+    result = subprocess.run([sys.executable, "-c", code, *args], cwd=APP_DIRECTORY, capture_output=True, text=True, check=True)
+    return result.stdout.split()
+
+def import_time(module, repeat):
+    runs = [run_python(IMPORT_CODE.format(module=module, heavy_modules=HEAVY_MODULES)) for _ in range(repeat)]
+    return min(float(seconds) for seconds, _ in runs), runs[0][1]
+
+def render_time(page, repeat, metrics_path=None):
+    args = [page] + ([metrics_path] if metrics_path else [])
+    runs = [run_python(RENDER_CODE, *args) for _ in range(repeat)]
+    return min(float(first) for first, _, _ in runs), min(float(rerun) for _, rerun, _ in runs), int(runs[0][2])
+
+def synthetic_metrics(rows, years):
+    # Metrics of synthetic data, so that the Dashboard draws all its charts
+    from benchmarks.benchmark_metrics import synthetic_cleaned_data
+    import utils.metrics as metrics
+    return metrics.calculate_metrics(synthetic_cleaned_data(rows, years))
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--rows", type=int, default=200_000, help="rows of the synthetic data behind the Dashboard metrics")
+    args = parser.parse_args()
+
+    print("import time (fresh process)")
+    for module in MODULES:
+        seconds, loaded = import_time(module, args.repeat)
+        print(f"  {module:<22} {seconds:8.3f} s   heavy modules imported: {loaded}")
+
+    with tempfile.TemporaryDirectory() as directory:
+        metrics_path = os.path.join(directory, "metrics.pkl")
+        with open(metrics_path, "wb") as f:
+            pickle.dump(synthetic_metrics(args.rows, 3), f)
+
+        print("render time (fresh process, including imports)")
+        for page in PAGES:
+            first, rerun, exceptions = render_time(page, args.repeat)
+            print(f"  {page:<30} first run {first:8.3f} s   rerun {rerun:8.3f} s   exceptions: {exceptions}")
+        first, rerun, exceptions = render_time(PAGES[1], args.repeat, metrics_path)
+        print(f"  {PAGES[1] + ' (charts)':<30} first run {first:8.3f} s   rerun {rerun:8.3f} s   exceptions: {exceptions}")
+
+if __name__ == "__main__":
+    main()
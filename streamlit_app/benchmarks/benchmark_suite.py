@@ -0,0 +1,184 @@
+"""
+Benchmark suite of the pipeline on synthetic archives following the OGD data scheme (see synthetic_data.py).
+
+Each year is loaded and merged from its ZIP file (load_and_merge_zip), cleaned, and the metrics of all the years
+are calculated and drawn on the Dashboard. The time, CPU time and peak memory of every stage (including the
+stages recorded inside those functions, see utils/profiling.py) are written as JSON and compared with a
+baseline from a previous run, so that performance changes can be followed run over run.
+
+Usage (from the streamlit_app folder):
+    python benchmarks/benchmark_suite.py --rows 1000000 --years 3 --save-baseline
+    python benchmarks/benchmark_suite.py --rows 1000000 --years 3 --output results.json
+"""
+import argparse
+import datetime
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+
+APP_DIRECTORY = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, APP_DIRECTORY)
+import utils.data_loading as data_loading
+import utils.dataset_registry as dataset_registry
+import utils.functions as functions
+import utils.metrics as metrics
+import utils.pipeline as pipeline
+import utils.profiling as profiling
+from benchmarks.synthetic_data import generate_archives, FIRST_YEAR
+
+BASELINE_FILE = os.path.join(APP_DIRECTORY, "benchmarks", "baseline.json")
+DATA_DIRECTORY = os.path.join(tempfile.gettempdir(), "vbz_synthetic_data") # Archives are reused by later runs
+DASHBOARD_PAGE = os.path.join(APP_DIRECTORY, "pages", "1_Dashboard.py")
+TOLERANCE = 0.10 # Relative change of the wall time reported as a regression or an improvement
+MIN_CHANGE_SECONDS = 0.05 # Smaller changes are taken as noise, whatever their relative size
+
+def run_pipeline(archives):
+    # Stages of one run of the pipeline, with the metrics it produced
+    with profiling.collect() as records:
+        cleaned = []
+        for year, path in archives:
+            with profiling.stage("load and merge", year) as record:
+                raw_data = data_loading.load_and_merge_zip(path, year)
+                record["rows_out"] = len(raw_data)
+            with profiling.stage("clean", year, rows_in=len(raw_data)) as record:
+                cleaned.append(pipeline.clean_data(raw_data))
+                record["rows_out"] = len(cleaned[-1])
+            del raw_data
+        data = functions.concat_frames(cleaned)
+        del cleaned
+        with profiling.stage("calculate metrics", rows_in=len(data)):
+            all_df = metrics.calculate_metrics(data)
+    return records, all_df
+
+def draw_dashboard(all_df):
+    # Stages of the figures of one run of the Dashboard page. The page runs in a thread of its own, its records
+    # are taken from those of the process
+    import streamlit as st
+    from streamlit.testing.v1 import AppTest
+    profiling.clear()
+    profiling.set_payloads(True) # The size of the figures sent to the browser is reported too
+    st.cache_data.clear() # Every run draws the figures from scratch
+    app = AppTest.from_file(DASHBOARD_PAGE, default_timeout=600)
+    # The page only reads the metrics of the dataset
+    app.session_state["dataset"] = dataset_registry.open_dataset("benchmark", lambda: (pd.DataFrame(), all_df))
+    with profiling.stage("draw dashboard") as record:
+        app.run()
+    if app.exception:
+        raise RuntimeError(f"The Dashboard failed: {app.exception[0].message}")
+    return [r for r in profiling.RECORDS if r["stage"].startswith("figure: ")] + [record]
+
+def summarize(runs):
+    """
+    Measurements per stage from the records of several runs: the wall and CPU times of a stage are added over the
+    years of a run, and the fastest run is kept. The peak memory is the highest of all the runs.
+    """
+    summary = {}
+    for records in runs:
+        run = {}
+        for record in records:
+            stage = run.setdefault(record["stage"], {"wall_seconds": 0.0, "cpu_seconds": 0.0, "peak_rss_mb": 0.0, "rows_out": 0})
+            stage["wall_seconds"] += record["wall_seconds"]
+            stage["cpu_seconds"] += record["cpu_seconds"]
+            stage["peak_rss_mb"] = max(stage["peak_rss_mb"], record["peak_rss_mb"] or 0.0)
+            stage["rows_out"] += record["rows_out"] or 0
+            if "payload_kb" in record: # Figures of the Dashboard
+                stage["payload_kb"] = record["payload_kb"]
+        for name, stage in run.items():
+            best = summary.setdefault(name, stage)
+            if stage["wall_seconds"] < best["wall_seconds"]:
+                summary[name] = {**stage, "peak_rss_mb": max(stage["peak_rss_mb"], best["peak_rss_mb"])}
+            else:
+                best["peak_rss_mb"] = max(stage["peak_rss_mb"], best["peak_rss_mb"])
+    return {name: {key: round(value, 4) for key, value in stage.items()} for name, stage in summary.items()}
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=APP_DIRECTORY, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def compare(results, baseline, tolerance=TOLERANCE):
+    # Ratio of the wall time of each stage to that of the baseline, flagged beyond the tolerance
+    # (and MIN_CHANGE_SECONDS)
+    if results["parameters"] != baseline["parameters"]:
+        print(f"warning: the baseline was run with other parameters {baseline['parameters']}")
+    comparison = {}
+    for name, stage in results["stages"].items():
+        previous = baseline["stages"].get(name)
+        if previous is None or previous["wall_seconds"] == 0:
+            continue
+        ratio = stage["wall_seconds"] / previous["wall_seconds"]
+        status = "slower" if ratio > 1 + tolerance else "faster" if ratio < 1 - tolerance else "same"
+        if abs(stage["wall_seconds"] - previous["wall_seconds"]) < MIN_CHANGE_SECONDS:
+            status = "same"
+        comparison[name] = {"baseline_seconds": previous["wall_seconds"], "seconds": stage["wall_seconds"],
+                            "ratio": round(ratio, 3), "status": status}
+    return comparison
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rows", type=int, default=1_000_000, help="rows of REISENDE per year (10k to 100M)")
+    parser.add_argument("--years", type=int, default=3, help="number of years (1 to 15)")
+    parser.add_argument("--first-year", type=int, default=FIRST_YEAR)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--skip-dashboard", action="store_true", help="do not measure the figures of the Dashboard")
+    parser.add_argument("--data-directory", default=DATA_DIRECTORY, help="folder of the synthetic archives")
+    parser.add_argument("--baseline", default=BASELINE_FILE, help="results of a previous run to compare with")
+    parser.add_argument("--save-baseline", action="store_true", help="store the results of this run as the baseline")
+    parser.add_argument("--output", help="also write the results of this run to this JSON file")
+    parser.add_argument("--tolerance", type=float, default=TOLERANCE)
+    parser.add_argument("--fail-on-regression", action="store_true", help="exit with an error if a stage got slower")
+    args = parser.parse_args()
+
+    archives = generate_archives(args.data_directory, args.rows, args.years, args.first_year, args.seed)
+
+    pipeline_runs, dashboard_runs = [], []
+    for _ in range(args.repeat):
+        records, all_df = run_pipeline(archives)
+        pipeline_runs.append(records)
+    if not args.skip_dashboard:
+        dashboard_runs = [draw_dashboard(all_df) for _ in range(args.repeat)]
+
+    results = {
+        "created_at": datetime.datetime.now().isoformat(timespec="seconds"),
+        "git_commit": git_commit(),
+        "environment": {"python": platform.python_version(), "platform": platform.platform(), "cpu_count": os.cpu_count(),
+                        "pandas": pd.__version__, "numpy": np.__version__, "pyarrow": pa.__version__},
+        "parameters": {"rows": args.rows, "years": args.years, "first_year": args.first_year, "seed": args.seed},
+        "stages": {**summarize(pipeline_runs), **summarize(dashboard_runs)},
+    }
+
+    print(f"rows per year: {args.rows:,}  years: {args.years}  runs: {args.repeat}")
+    for name, stage in results["stages"].items():
+        print(f"  {name:<40} {stage['wall_seconds']:9.3f} s  CPU {stage['cpu_seconds']:9.3f} s  peak {stage['peak_rss_mb']:8.1f} MB"
+              + (f"  payload {stage['payload_kb']:8.1f} KB" if "payload_kb" in stage else ""))
+
+    regressions = []
+    if os.path.exists(args.baseline) and not args.save_baseline:
+        with open(args.baseline) as f:
+            comparison = compare(results, json.load(f), args.tolerance)
+        results["comparison"] = comparison
+        print(f"compared with {args.baseline}")
+        for name, change in comparison.items():
+            print(f"  {name:<40} {change['baseline_seconds']:9.3f} s -> {change['seconds']:9.3f} s  x{change['ratio']:.2f}  {change['status']}")
+        regressions = [name for name, change in comparison.items() if change["status"] == "slower"]
+
+    for path in [args.output] + ([args.baseline] if args.save_baseline else []):
+        if path:
+            with open(path, "w") as f:
+                json.dump(results, f, indent=2)
+            print(f"results written to {path}")
+
+    if regressions and args.fail_on_regression:
+        sys.exit(f"slower than the baseline: {', '.join(regressions)}")
+
+if __name__ == "__main__":
+    main()
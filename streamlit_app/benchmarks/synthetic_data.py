@@ -0,0 +1,240 @@
+"""
+Generator of synthetic yearly ZIP files following the OGD data scheme of the VBZ passenger counts
+(documentation/metadata.xlsx and scheme_data.png): REISENDE with the counts of each stop of each planned trip,
+and the matching tables LINIE, HALTESTELLEN, GEFAESSGROESSE and TAGTYP.
+
+The data has realistic cardinalities (about 150 lines, 800 stops and one planned trip per 24 stops served),
+departure times above 24h for the trips after midnight, long stop names with latin1-mangled umlauts as in the
+published files, a few duplicated rows and trips missing from GEFAESSGROESSE. REISENDE is generated and
+compressed in blocks of trips, so archives of 100M rows are written with bounded memory.
+
+Usage (from the streamlit_app folder):
+    python benchmarks/synthetic_data.py ../data/synthetic --rows 1000000 --years 3
+"""
+import argparse
+import json
+import os
+import zipfile
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.csv as pa_csv
+
+FIRST_YEAR = 2010
+LINES = 150
+STOPS = 800
+BLOCK_TRIPS = 40_000 # Trips generated and written at a time (about 1M rows of REISENDE)
+DUPLICATED_FRACTION = 0.001 # Rows of REISENDE written twice
+ORPHAN_TRIP_FRACTION = 0.001 # Trips missing from GEFAESSGROESSE
+PARAMETERS_FILE = "synthetic.json" # Parameters of the archives of a directory, to reuse them when they match
+
+# Transport systems of the lines (VSYS) with their share of the lines, route lengths (stops) and seats
+VEHICLES = pd.DataFrame({"VSYS": ["T", "TR", "B", "BP", "BL", "BZ", "BG", "N", "SB", "FB"],
+                         "share": [0.10, 0.04, 0.59, 0.05, 0.04, 0.05, 0.04, 0.05, 0.02, 0.02],
+                         "min_stops": [15, 15, 8, 8, 8, 8, 8, 10, 2, 10],
+                         "max_stops": [35, 30, 30, 25, 25, 25, 25, 40, 4, 20],
+                         "seats": [90, 55, 40, 35, 35, 35, 45, 40, 30, 80]})
+
+# Day types with the days of the year each one is extrapolated to
+DAY_TYPES = pd.DataFrame({"Tagtyp_Id": [1, 2, 3, 4, 5],
+                          "Tagtypname": ["Mo-Do", "Fr", "Sa", "So", "Nacht"],
+                          "Bemerkung": ["Montag bis Donnerstag", "Freitag", "Samstag", "Sonntag und Feiertage", "Nachtnetz"],
+                          "share": [0.45, 0.15, 0.15, 0.15, 0.10],
+                          "Tage_DTV": [201.0, 50.0, 52.0, 62.0, 0.0],
+                          "Tage_DWV": [201.0, 50.0, 0.0, 0.0, 0.0],
+                          "Tage_SA": [0.0, 0.0, 52.0, 0.0, 0.0],
+                          "Tage_SO": [0.0, 0.0, 0.0, 62.0, 0.0]})
+
+PLACES = ["Zürich", "Zürich", "Zürich", "Zürich", "Schlieren", "Kilchberg", "Küsnacht", "Wallisellen", "Dübendorf"]
+STREETS = ["Bürkliplatz", "Bahnhofplatz/HB", "Central", "Bellevue", "Höschgasse", "Röslistrasse", "Schäfligasse",
+           "Hönggerberg", "Zoo", "Milchbuck", "Klusplatz", "Paradeplatz", "Löwenplatz", "Stauffacher", "Hardbrücke",
+           "Güterbahnhof", "Sihlpost", "Bucheggplatz", "Triemli", "Wiedikon", "Frankental", "Hürlimannplatz"]
+
+# "HH:MM:SS" of every second of the first 48 hours
+TIME_STRINGS = np.array([f"{s // 3600:02d}:{s % 3600 // 60:02d}:{s % 60:02d}" for s in range(48 * 3600)], dtype=object)
+
+def mangle(name):
+    # Long names are published as UTF-8 bytes read as latin1 ("ZÃ¼rich" for "Zürich")
+    return name.encode("utf-8").decode("latin1")
+
+def stop_table(rng):
+    ids = np.sort(rng.choice(np.arange(1, 10 * STOPS), STOPS, replace=False))
+    names = [f"{PLACES[i % len(PLACES)]}, {STREETS[i % len(STREETS)]}" + ("" if i < len(STREETS) else f" {i // len(STREETS)}")
+             for i in range(STOPS)]
+    return pd.DataFrame({"Haltestellen_Id": ids,
+                         "Haltestellennummer": np.arange(1001, 1001 + STOPS),
+                         "Haltestellenkurzname": [f"H{i:04d}" for i in range(STOPS)],
+                         "Haltestellenlangname": [mangle(name) for name in names]})
+
+def line_table(rng):
+    vehicles = rng.choice(len(VEHICLES), LINES, p=VEHICLES["share"].to_numpy())
+    vsys = VEHICLES["VSYS"].to_numpy()[vehicles]
+    names = [f"N{i}" if v == "N" else str(i) for i, v in enumerate(vsys, start=2)]
+    return pd.DataFrame({"Linien_Id": np.sort(rng.choice(np.arange(1, 10 * LINES), LINES, replace=False)),
+                         "Linienname": names,
+                         "VSYS": vsys,
+                         "Linienname_Fahrgastauskunft": names})
+
+def line_routes(rng, lines, stops):
+    # Stops served by each line in direction 1 (direction 2 serves them in reverse) and the length of the section
+    # starting at each of them, flattened with the position where the route of each line starts
+    routes, distances = [], []
+    for vsys in lines["VSYS"]:
+        vehicle = VEHICLES[VEHICLES["VSYS"] == vsys].iloc[0]
+        length = rng.integers(vehicle["min_stops"], vehicle["max_stops"] + 1)
+        routes.append(rng.choice(stops["Haltestellen_Id"].to_numpy(), length, replace=False))
+        distances.append(rng.integers(150, 1500, length))
+    lengths = np.array([len(route) for route in routes])
+    return np.concatenate(routes), np.concatenate(distances), np.cumsum(lengths) - lengths, lengths
+
+def trip_block(rng, first_trip, trips, lines, routes, ridership):
+    """
+    Rows of REISENDE of the trips first_trip to first_trip + trips, one row per stop served, and the seats of
+    each trip. Night lines run from 00:30 to 04:00 on the night day type (as times from 24:30 to 28:00), the rest
+    of the lines from 05:00 to 25:00 on the other day types.
+    """
+    route_stops, route_distances, route_offsets, route_lengths = routes
+    line = rng.integers(0, len(lines), trips)
+    night = (lines["VSYS"].to_numpy() == "N")[line]
+    direction = rng.integers(1, 3, trips)
+    day_shares = DAY_TYPES["share"].to_numpy()[:4] / DAY_TYPES["share"].to_numpy()[:4].sum()
+    day_type = np.where(night, 5, rng.choice(4, trips, p=day_shares) + 1)
+    start = np.where(night, rng.integers(int(24.5 * 3600), 28 * 3600, trips), rng.integers(5 * 3600, 25 * 3600, trips))
+    lengths = route_lengths[line]
+
+    # One row per stop served, with its position in the trip and in the route of the line
+    trip = np.repeat(np.arange(trips), lengths)
+    offsets = np.cumsum(lengths) - lengths
+    sequence = np.arange(len(trip)) - offsets[trip]
+    last = sequence == lengths[trip] - 1
+    reverse = direction[trip] == 2
+    position = route_offsets[line[trip]] + np.where(reverse, lengths[trip] - 1 - sequence, sequence)
+    stop = route_stops[position]
+    next_stop = np.where(last, np.nan, route_stops[np.clip(np.where(reverse, position - 1, position + 1), 0, len(route_stops) - 1)])
+    distance = np.where(last, 0, route_distances[np.where(reverse, position - 1, position)])
+
+    # Departure times grow along the trip, the counts depend on the time of day
+    elapsed = np.cumsum(rng.integers(50, 150, len(trip)))
+    departure = start[trip] + elapsed - elapsed[offsets][trip]
+    hour = (departure // 3600) % 24
+    peak = 1 + 1.5 * np.exp(-((hour - 8) ** 2) / 2) + 1.5 * np.exp(-((hour - 17.5) ** 2) / 3)
+    boarding = np.round(rng.gamma(1.2, 2.5 * ridership, len(trip)) * peak, 2)
+    alighting = np.round(rng.gamma(1.2, 2.5 * ridership, len(trip)) * peak, 2)
+    boarding[last], alighting[offsets] = 0.0, 0.0
+    balance = np.cumsum(boarding - alighting)
+    occupancy = np.round(np.maximum(balance - (balance - boarding + alighting)[offsets][trip], 0), 2)
+
+    day = DAY_TYPES.set_index("Tagtyp_Id").loc[day_type[trip]]
+    night_network = rng.integers(0, 2, trips)[trip] * night[trip]
+    rows = pd.DataFrame({
+        "Tagtyp_Id": day_type[trip],
+        "Linien_Id": lines["Linien_Id"].to_numpy()[line[trip]],
+        "Linienname": lines["Linienname"].to_numpy()[line[trip]],
+        "Plan_Fahrt_Id": first_trip + trip,
+        "Richtung": direction[trip],
+        "Sequenz": sequence + 1,
+        "Haltestellen_Id": stop,
+        "Nach_Hst_Id": next_stop,
+        "FZ_AB": TIME_STRINGS[departure],
+        "Anzahl_Messungen": rng.integers(0, 12, len(trip)),
+        "Einsteiger": boarding,
+        "Aussteiger": alighting,
+        "Besetzung": occupancy,
+        "Distanz": distance,
+        "Tage_DTV": day["Tage_DTV"].to_numpy(),
+        "Tage_DWV": day["Tage_DWV"].to_numpy(),
+        "Tage_SA": day["Tage_SA"].to_numpy(),
+        "Tage_SO": day["Tage_SO"].to_numpy(),
+        "Nachtnetz": night_network,
+        "Tage_SA_N": np.where(night[trip] & (night_network == 0), 52.0, 0.0),
+        "Tage_SO_N": np.where(night[trip] & (night_network == 1), 52.0, 0.0),
+        "ID_Abschnitt": stop * 10000 + np.nan_to_num(next_stop).astype("int64"),
+    })
+
+    seats = VEHICLES.set_index("VSYS").loc[lines["VSYS"].to_numpy()[line], "seats"].to_numpy()
+    standing = rng.integers(20, 40, trips)
+    sizes = pd.DataFrame({"Plan_Fahrt_Id": first_trip + np.arange(trips), "SITZPLAETZE": seats,
+                          **{f"KAP_{m}m2": seats + m * standing for m in range(1, 5)}})
+    return rows, sizes
+
+def write_csv(f, data, header=True):
+    # The CSV writer of Arrow is about ten times faster than DataFrame.to_csv. No value holds a ";" or a quote
+    options = pa_csv.WriteOptions(include_header=header, delimiter=";", quoting_style="none")
+    pa_csv.write_csv(pa.Table.from_pandas(data, preserve_index=False), f, options)
+
+def write_table(zip_ref, table, data):
+    with zip_ref.open(f"{table}.csv", "w", force_zip64=True) as f:
+        write_csv(f, data)
+
+def write_archive(path, year, rows, seed=0):
+    """
+    Write the synthetic ZIP file of a year with rows rows in REISENDE (including the duplicated ones).
+    The ridership changes a little from one year to the next, the lines and stops are the same every year.
+    """
+    rng = np.random.default_rng(seed)
+    stops, lines = stop_table(rng), line_table(rng)
+    routes = line_routes(rng, lines, stops)
+    year_rng = np.random.default_rng([seed, int(year)])
+    ridership = year_rng.uniform(0.85, 1.15)
+
+    sizes, written, first_trip = [], 0, 1
+    # Deflate at the lowest level: reading cost does not depend on it, and writing 100M rows stays fast
+    with zipfile.ZipFile(path, "w", zipfile.ZIP_DEFLATED, compresslevel=1) as zip_ref:
+        with zip_ref.open("REISENDE.csv", "w", force_zip64=True) as f:
+            while written < rows:
+                # The last block only has the trips needed (routes have at least 2 stops)
+                trips = min(BLOCK_TRIPS, (rows - written) // 2 + 1)
+                block, block_sizes = trip_block(year_rng, first_trip, trips, lines, routes, ridership)
+                # Duplicated rows follow the original ones
+                duplicated = block.sample(frac=DUPLICATED_FRACTION, random_state=year_rng.integers(2**31))
+                block = pd.concat([block, duplicated]).sort_index(kind="stable").iloc[:rows - written]
+                write_csv(f, block, header=written == 0)
+                written += len(block)
+                sizes.append(block_sizes[block_sizes["Plan_Fahrt_Id"].isin(block["Plan_Fahrt_Id"])])
+                first_trip += trips
+        sizes = pd.concat(sizes, ignore_index=True)
+        orphans = year_rng.random(len(sizes)) < ORPHAN_TRIP_FRACTION
+        write_table(zip_ref, "GEFAESSGROESSE", sizes[~orphans])
+        write_table(zip_ref, "LINIE", lines)
+        write_table(zip_ref, "HALTESTELLEN", stops)
+        write_table(zip_ref, "TAGTYP", DAY_TYPES[["Tagtyp_Id", "Tagtypname", "Bemerkung"]])
+    return path
+
+def generate_archives(directory, rows, years, first_year=FIRST_YEAR, seed=0):
+    """
+    Synthetic archives of years consecutive years from first_year in directory, as (year, path) tuples.
+    The archives already in the directory are reused when they were generated with the same parameters.
+    """
+    os.makedirs(directory, exist_ok=True)
+    parameters = {"rows": rows, "seed": seed}
+    parameters_path = os.path.join(directory, PARAMETERS_FILE)
+    existing = {}
+    if os.path.exists(parameters_path):
+        with open(parameters_path) as f:
+            existing = json.load(f)
+
+    archives = []
+    for year in (str(first_year + i) for i in range(years)):
+        path = os.path.join(directory, f"Fahrgastzahlen_{year}.zip")
+        if existing.get(year) != parameters or not os.path.exists(path):
+            write_archive(path, year, rows, seed)
+            existing[year] = parameters
+            with open(parameters_path, "w") as f:
+                json.dump(existing, f, indent=2)
+        archives.append((year, path))
+    return archives
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("directory", help="folder where the ZIP files are written")
+    parser.add_argument("--rows", type=int, default=1_000_000, help="rows of REISENDE per year (10k to 100M)")
+    parser.add_argument("--years", type=int, default=3, help="number of years (1 to 15)")
+    parser.add_argument("--first-year", type=int, default=FIRST_YEAR)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    for year, path in generate_archives(args.directory, args.rows, args.years, args.first_year, args.seed):
+        print(f"{year}: {path} ({os.path.getsize(path) / 1024**2:.1f} MB)")
+
+if __name__ == "__main__":
+    main()
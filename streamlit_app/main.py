@@ -3,14 +3,21 @@ import pandas as pd
 import os
 
 # Import custom modules
-import utils.functions as functions_app
-import utils.data_loading as data_loading
-import utils.data_cleaning as data_cleaning
-import utils.metrics as metrics
+import utils.dataset_registry as dataset_registry
+import utils.ingestion as ingestion
+import utils.jobs as jobs
+import utils.pipeline as pipeline
+import utils.pipeline_cache as pipeline_cache
+import utils.prescan as prescan
+import utils.profiling as profiling
+import utils.storage as storage
 import utils.global_values as global_values
 
 # Constants
-EXTRACT_OUTPUT_DIRECTORY = "./data/"
+LOADING_MODE = "zip" # "zip": read the tables from the ZIP files in memory, "disk": extract the CSV files to pipeline.EXTRACT_OUTPUT_DIRECTORY first
+INGESTION_WORKERS = ingestion.MAX_WORKERS # Worker processes loading the years in parallel ("zip" mode)
+INGESTION_MEMORY_BUDGET_MB = ingestion.MEMORY_BUDGET_MB # Estimated memory allowed for the years loaded at the same time
+JOB_POLL_SECONDS = 1 # Refresh interval of the progress of the processing job
 
 # Streamlit Page Configuration
 st.set_page_config(page_title="Dashboard application",
@@ -18,103 +25,189 @@ st.set_page_config(page_title="Dashboard application",
                    layout="wide")
 st.title("Pilot Project - v0.2")
 
-# Initialize Session State Variables
-if "final_data" not in st.session_state:
-    st.session_state.final_data = None
+# Initialize Session State Variables. The processed data and its metrics are shared by all the sessions working on
+# the same data (utils/dataset_registry.py): a session only holds a handle to them (st.session_state.dataset)
+if "dataset" not in st.session_state:
+    st.session_state.dataset = None
 if "years" not in st.session_state:
     st.session_state.years = None
-if "uploaded_files_processed" not in st.session_state:
-    st.session_state.uploaded_files_processed = False
-if "csv_uploaded_processed" not in st.session_state:
-    st.session_state.csv_uploaded_processed = False
-
-# Cache functions
-@st.cache_data
-def process_uploaded_files(uploaded_files):
-    dataframes, years = [], []
-    for uploaded_file in uploaded_files:
-        year_file = functions_app.obtain_year_zipfile(uploaded_file.name)
-        years.append(year_file)
-        extraction_directory = os.path.join(EXTRACT_OUTPUT_DIRECTORY, str(year_file))
-        os.makedirs(extraction_directory, exist_ok=True)
-        csv_files = functions_app.extract_csv_files(uploaded_file, extraction_directory)
-
-        if csv_files:
-            st.success(f"Extracted {len(csv_files)} CSV files to: {extraction_directory}")
-        else:
-            st.warning(f"No CSV files found in {uploaded_file.name}")
-
-        dataframes.append(data_loading.load_and_merge_data(year_file))
-    return pd.concat(dataframes, ignore_index=True), years
-
-@st.cache_data
-def clean_data(raw_data):
-    raw_data = raw_data.rename(global_values.MAPPING_ATTRIBUTES, axis=1)
-    return data_cleaning.clean_data(raw_data)
-
-@st.cache_data
-def compute_metrics(cleaned_data):
-    return metrics.calculate_metrics(cleaned_data)
-
-@st.cache_data
-def load_csv(path):
-    return pd.read_csv(path)
-
-def obtain_year_period(csv_path):
-        years = csv_path.split("_")[-1].split(".")[0].split("-")
-        return years
+if "archive_keys" not in st.session_state:
+    st.session_state.archive_keys = None
+if "loaded_source" not in st.session_state:
+    st.session_state.loaded_source = None # Identifies the uploaded files or dataset currently loaded, to process them only once
+if "job" not in st.session_state:
+    st.session_state.job = None # Background job processing the uploaded ZIP files (utils/jobs.py)
+if "plan" not in st.session_state:
+    st.session_state.plan = None # Ingestion plan of the uploaded ZIP files (utils/prescan.py), shown before processing them
+if "dataset_path" not in st.session_state:
+    st.session_state.dataset_path = None # Stored dataset of the loaded data, queried by the Dashboard to explore slices of it
+
+# Pipeline functions (utils/pipeline.py). Results are persisted in the pipeline cache, keyed by the SHA-256 of the uploaded ZIP files
+def process_uploaded_files(job, archives, workers):
+    # Run in the background job: the processed data is opened as a shared dataset, adopted by the session once done.
+    # The years loaded at the same time (workers) are those of the ingestion plan
+    final_data, years, ingestion_report, archive_keys, all_df = pipeline.process_archives_job(
+        job, archives, LOADING_MODE, workers, INGESTION_MEMORY_BUDGET_MB)
+    dataset = dataset_registry.open_dataset(dataset_id(*[archive_keys[year] for year in years]), lambda: (final_data, all_df))
+    return {"dataset": dataset, "years": years, "report": ingestion_report, "archive_keys": archive_keys}
+
+def load_processed_dataset(name):
+    # Only the columns needed by the metrics are read from the stored dataset
+    return storage.read_dataset(os.path.join(storage.OUTPUT_DIRECTORY, name), columns=global_values.METRIC_COLUMNS)
+
+def load_processed_file(uploaded_file):
+    return pd.read_parquet(uploaded_file, columns=global_values.METRIC_COLUMNS)
+
+def dataset_id(*keys):
+    # Id of the shared dataset: the same data gets the same id in every session
+    return pipeline_cache.entry_key("dataset", *keys)
+
+def obtain_year_period(data):
+    return sorted(data["year"].unique())
+
+@st.fragment(run_every=JOB_POLL_SECONDS)
+def job_progress(job):
+    # Progress of the processing job, refreshed on its own until the job finishes and the whole page runs again
+    if job.finished:
+        st.rerun()
+    st.progress(job.progress(), text=f"Processing {len(job.years)} year(s) in the background...")
+    stages = {year: [r["stage"] for r in list(job.records) if r["year"] == str(year)] for year in job.years}
+    st.dataframe(pd.DataFrame({"stage": job.years, "completed stages": {year: ", ".join(s) for year, s in stages.items()}}))
+    if job.partial is not None:
+        st.info(f"Years {', '.join(map(str, job.partial['years']))} can already be seen on the Dashboard")
+    if st.button("Cancel processing"):
+        job.cancel()
 
 # File Upload Widgets
 st.markdown(f"Option 1: Upload ZIP files containing raw datasets")
 uploaded_files = st.file_uploader("Upload ZIP file(s)", type="zip", accept_multiple_files=True)
 
-st.markdown(f"<br>Option 2: Upload the processed data", unsafe_allow_html=True)
-processed_csv_uploaded = st.file_uploader(label="Upload processed CSV file",type="csv")
+st.markdown(f"<br>Option 2: Load the processed data", unsafe_allow_html=True)
+stored_dataset = st.selectbox("Select a processed dataset", options=storage.list_datasets(), index=None)
+processed_file_uploaded = st.file_uploader(label="Or upload a processed Parquet file", type="parquet")
 
 # Handle uploaded Zip files
-if uploaded_files and not st.session_state.uploaded_files_processed:
+uploaded_source = ("zip",) + tuple(f.file_id for f in uploaded_files) if uploaded_files else None
+if uploaded_source and uploaded_source != st.session_state.loaded_source:
+    # Pre-scan of the uploads (central directory and first rows of each table), whose plan is shown before the
+    # files are processed
+    if st.session_state.plan is None or st.session_state.plan["source"] != uploaded_source:
+        with profiling.stage("pre-scan"):
+            scans = prescan.scan_archives([(f.name, f.getvalue()) for f in uploaded_files])
+            st.session_state.plan = {"source": uploaded_source,
+                                     **prescan.plan_ingestion(scans, INGESTION_MEMORY_BUDGET_MB, INGESTION_WORKERS)}
+    plan = st.session_state.plan
+    st.markdown("Ingestion plan")
+    st.dataframe(prescan.plan_summary(plan))
+    for info in plan["files"]:
+        if info["loading"] == "skipped":
+            st.error(f"{info['file']} will not be loaded: {'; '.join(info['errors'])}")
+        elif info["loading"] == "stream":
+            st.warning(f"{info['file']} will not be loaded: the estimated peak memory ({info['peak_memory_mb']} MB) "
+                       f"exceeds the memory budget ({INGESTION_MEMORY_BUDGET_MB} MB). run_pipeline.py --loading-mode "
+                       f"stream --chunk-size {info['chunk_size']} processes it with bounded memory")
+    # The app loads the years in memory: the files the plan streams are left out, as the skipped ones
+    archives = prescan.planned_archives(plan, [(f.name, f) for f in uploaded_files], loadings=["zip"])
+    if st.button("Start processing", disabled=not archives):
+        # Process, clean and calculate the metrics in the background (the dataset is written next to the metrics),
+        # replacing the job of previous uploads
+        if st.session_state.job is not None:
+            st.session_state.job.cancel()
+        archives = [(year, f.getvalue()) for year, f in archives]
+        st.session_state.job = jobs.submit(process_uploaded_files, [year for year, _ in archives], archives, plan["workers"])
+        st.session_state.loaded_source, st.session_state.plan = uploaded_source, None
+        st.rerun()
+
+job = st.session_state.job
+if job is not None and not job.finished:
+    job_progress(job)
+elif job is not None:
+    st.session_state.job = None
+    if job.status == "done":
+        ingestion_report = job.result["report"]
+        for year, info in ingestion_report.items():
+            if info["status"] == "failed":
+                st.warning(f"Year {year} could not be loaded: {info['error']}")
+            elif any(info[key] for key in info if key.startswith("orphan_")):
+                st.warning(f"Year {year} has rows referencing missing dimension records, see the ingestion report")
+        with st.expander("Ingestion report"):
+            st.dataframe(pd.DataFrame.from_dict(ingestion_report, orient="index"))
+        st.session_state.dataset = job.result["dataset"]
+        st.session_state.years, st.session_state.archive_keys = job.result["years"], job.result["archive_keys"]
+        st.session_state.dataset_path = storage.dataset_path(job.result["years"])
+    elif job.status == "failed":
+        st.error(f"An error occured while processing files: {job.error}")
+    else:
+        st.warning("Processing cancelled")
+
+# Handle processed data
+if processed_file_uploaded:
+    processed_source = ("file", processed_file_uploaded.file_id)
+elif stored_dataset:
+    processed_source = ("dataset", stored_dataset)
+else:
+    processed_source = None
+if processed_source and processed_source != st.session_state.loaded_source:
+    if st.session_state.job is not None: # The processed data replaces the uploads being processed
+        st.session_state.job.cancel()
+        st.session_state.job = None
     try:
-        # Process and clean data
-        raw_data, st.session_state.years = process_uploaded_files(uploaded_files)
-        st.session_state.final_data = clean_data(raw_data)
-
-        # Save processed data and provide a download option
-        csv_path = os.path.join(os.getcwd(), "output", f"processed_data_{st.session_state.years[0]}-{st.session_state.years[-1]}.csv")
-        st.session_state.final_data.to_csv(csv_path, index=False)
-        st.download_button(
-            label=f"Download CSV",
-            data=st.session_state.final_data.to_csv(),
-            file_name=f"processed_data_{st.session_state.years[0]}-{st.session_state.years[-1]}.csv",
-            mime="text/csv"
-        )
-        st.session_state.uploaded_files_processed = True
+        # Load processed data, unless another session has it loaded already
+        with profiling.stage("load processed data") as record:
+            if processed_file_uploaded:
+                st.session_state.dataset = dataset_registry.open_dataset(
+                    dataset_id(pipeline_cache.archive_key(processed_file_uploaded.getvalue())),
+                    lambda: (load_processed_file(processed_file_uploaded), None))
+            else:
+                # Metrics precomputed by the app or by run_pipeline.py, computed again if missing or outdated. The
+                # dataset is rewritten when processed again, which changes its modification time
+                dataset_path = os.path.join(storage.OUTPUT_DIRECTORY, stored_dataset)
+                st.session_state.dataset = dataset_registry.open_dataset(
+                    dataset_id(stored_dataset, str(os.stat(dataset_path).st_mtime_ns)),
+                    lambda: (load_processed_dataset(stored_dataset), pipeline.read_artifact_metrics(dataset_path)))
+            record["rows_out"] = len(st.session_state.dataset.data)
+        st.session_state.dataset_path = None if processed_file_uploaded else dataset_path
+        st.session_state.years = obtain_year_period(st.session_state.dataset.data)
+        st.session_state.archive_keys = None
+        st.success("Processed data loaded succesfully")
+        st.session_state.loaded_source = processed_source
     except Exception as e:
-        st.error(f"An error occured while processing files: {e}")
-
-# Handle uploaded CSV file
-if processed_csv_uploaded and not st.session_state.csv_uploaded_processed:
-    try:
-        # Load processed data
-        st.session_state.years = obtain_year_period(processed_csv_uploaded.name)
-        st.session_state.final_data = load_csv(processed_csv_uploaded)
-        st.success("Processed CSV file loaded succesfully")
-        st.session_state.csv_uploaded_processed = True
-    except Exception as e:
-        st.error(f"An error ocurred while loading the file: {e}")
+        st.error(f"An error ocurred while loading the data: {e}")
 
 # Calculate metrics if data is available
-if st.session_state.final_data is not None:
+if st.session_state.dataset is not None:
+    final_data = st.session_state.dataset.data
     st.write("")
     st.write(f"Time period loaded: {st.session_state.years[0]} - {st.session_state.years[-1]}")
-    st.write(st.session_state.final_data.head(5))
-    with st.spinner("Calculating metrics..."):
-        try:
-            st.session_state.metrics = compute_metrics(st.session_state.final_data)
-            st.success("Metrics calculated succesfully! Navigate to the Dashboard Display")
-        except Exception as e:
-            st.error(f"An error ocurred while calculating metrics: {e}")
-
-# Reset upload states after processing
-if st.session_state.uploaded_files_processed or st.session_state.csv_uploaded_processed:
-    st.session_state.uploaded_files_processed = False
-    st.session_state.csv_uploaded_processed = False
\ No newline at end of file
+    st.write(final_data.head(5))
+    with st.expander("Memory report"):
+        st.dataframe(st.session_state.dataset.memory_report) # Computed once, when the dataset was opened
+
+    # Export the processed data on demand
+    export_format = st.selectbox("Export format", options=["Parquet", "CSV"])
+    if st.button("Prepare export"):
+        with profiling.stage(f"export {export_format}", rows_in=len(final_data)):
+            if export_format == "CSV":
+                export_data, mime = storage.to_csv_bytes(final_data), "text/csv"
+            else:
+                export_data, mime = storage.to_parquet_bytes(final_data), "application/octet-stream"
+        st.download_button(
+            label=f"Download {export_format}",
+            data=export_data,
+            file_name=f"{storage.dataset_name(st.session_state.years)}.{export_format.lower()}",
+            mime=mime
+        )
+
+    if st.session_state.dataset.metrics is None:
+        with st.spinner("Calculating metrics..."):
+            try:
+                with profiling.stage("metrics"):
+                    dataset_registry.set_metrics(st.session_state.dataset,
+                                                 pipeline.compute_metrics(final_data, st.session_state.archive_keys))
+            except Exception as e:
+                st.error(f"An error ocurred while calculating metrics: {e}")
+    if st.session_state.dataset.metrics is not None:
+        st.success("Metrics calculated succesfully! Navigate to the Dashboard Display")
+
+    with st.expander("Pipeline cache"):
+        st.write(pipeline_cache.cache_summary())
\ No newline at end of file
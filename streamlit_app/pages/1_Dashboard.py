@@ -1,12 +1,12 @@
 import streamlit as st
-import matplotlib.pyplot as plt
-import plotly.express as px
-import plotly.graph_objects as go
 import pandas as pd
 import numpy as np
-import os
-import utils.visualizations as visualizations
+import time
+import utils.functions as functions
 import utils.global_values as global_values
+import utils.profiling as profiling
+import utils.scenarios as scenarios
+import utils.sketches as sketches
 
 # Page configuration
 st.set_page_config(
@@ -15,66 +15,79 @@ st.set_page_config(
     layout="wide"
 )
 
+# Measures of the slice table, with their labels
+SLICE_MEASURES = {"passenger_kilometre": "Passenger-kilometre", "flow_passengers_in": "Passengers (boarding)",
+                  "distance_travelled": "Distance travelled (km)", "passenger_kilometre_co2": "Passenger-kilometre CO2 (g)"}
+SLICE_BUCKET_SECONDS = 900
+NETWORK_TOP = 25 # Stops and corridors shown in the network view
+JOB_POLL_SECONDS = 2 # Refresh interval while the uploaded files are processed in the background
+FIGURE_CACHE_ENTRIES = 64 # Prepared data kept per chart, for the selections (and datasets) seen last
+SCENARIO_SWEEP_TYPE = "Electric car" # Type of vehicle whose share of the fleet is swept in the scenario panel
+SCENARIO_SWEEP_POINTS = 101 # Scenarios of the sweep, from 0 to 100 % of the fleet
+CROWDING_QUANTILES = [0.5, 0.9, 0.99]
+CROWDING_TOP_LINES = 20 # Lines of the crowding table, the most crowded first
+
 # Metric functions
-def pkm_metric(df):
-    pkm = df.groupby("year")["pkm"].sum() / 1e6
-    value_actual = pkm.iloc[-1]
-    value_previous = pkm.iloc[-2]
+def delta_text(value_actual, value_previous):
+    # Change from the previous year, none if a single year is loaded (e.g. while the rest of the years are loading)
+    if value_previous is None:
+        return None
     absolute_increase = value_actual - value_previous
     percentage_increase = (absolute_increase / value_previous) * 100
+    return f"{absolute_increase:,.1f} ({percentage_increase:,.1f} %)"
+
+def pkm_metric(df):
+    # Total of each year (metrics["pkm_total"]), without the time series stacked for the charts
+    pkm = df["passenger_kilometre"].sort_index() / 1e6
+    value_actual = pkm.iloc[-1]
+    value_previous = pkm.iloc[-2] if len(pkm) > 1 else None
     st.metric(
         label=f"Passenger-kilometre (in millions) in {pkm.index[-1]}",
         value= f"{value_actual:,.1f} M pkm",
-        delta=f"{absolute_increase:,.1f} ({percentage_increase:,.1f} %)"
+        delta=delta_text(value_actual, value_previous)
     )
 
 def passenger_boarding_metric(df):
     passenger_boarding = df = df.stack().reset_index().rename({0:"passenger_in"}, axis=1)
     years = np.array(passenger_boarding["year"].unique())
     value_actual = passenger_boarding[passenger_boarding["year"] == years[-1]]["passenger_in"].sum() / 1e6
-    value_previous = passenger_boarding[passenger_boarding["year"] == years[-2]]["passenger_in"].sum() / 1e6
-    absolute_increase = value_actual - value_previous
-    percentage_increase = (absolute_increase / value_previous) * 100
+    value_previous = passenger_boarding[passenger_boarding["year"] == years[-2]]["passenger_in"].sum() / 1e6 if len(years) > 1 else None
     st.metric(
         label = f"Passengers (boarding) (in millions) ",
         value = f"{value_actual:,.1f} M pass. in",
-        delta = f"{absolute_increase:,.1f} ({percentage_increase:,.1f} %)"
+        delta = delta_text(value_actual, value_previous)
     )
 
 def distance_metric(df):
     distance = df.groupby("year")["distance_travelled"].sum() / 1e6
     value_actual = distance.iloc[-1]
-    value_previous = distance.iloc[-2]
-    absolute_increase = value_actual - value_previous
-    percentage_increase = (absolute_increase / value_previous) * 100
+    value_previous = distance.iloc[-2] if len(distance) > 1 else None
     st.metric(
         label=f"Distance travelled (in millions) in {distance.index[-1]}",
         value=f"{value_actual:,.1f} M vkm",
-        delta=f"{absolute_increase:,.1f} ({percentage_increase:,.1f} %)"
+        delta=delta_text(value_actual, value_previous)
     )
 
 def co2_metric(df):
     value_actual = df.iloc[-1][0]
-    value_previous = df.iloc[-2][0]
-    absolute_increase = value_actual - value_previous
-    percentage_increase = (absolute_increase / value_previous) * 100
+    value_previous = df.iloc[-2][0] if len(df) > 1 else None
     st.metric(
         label=f"CO2 emissions avoided {df.index[-1]}",
         value=f"{value_actual:,.0f} t CO2-eq",
-        delta=f"{absolute_increase:,.1f} ({percentage_increase:,.1f} %)"
+        delta=delta_text(value_actual, value_previous)
     )
 
-# Visualization plots
-def breakdown_lines_metric(df):
-    df = df.stack().reset_index().rename({0:"passenger_in"}, axis=1)
-
-    selected_years = st.multiselect("Select Years to Display", options=df["year"].unique(), default=df["year"].unique())
-    top_n = st.slider("Select Number of Top Lines", min_value=2, max_value=10, value=3)
-
+# Visualization plots. Each chart is drawn by a fragment with its widgets, so that changing them only runs that chart
+# again. The data of a chart is prepared by a cached function of the metrics (by their key, see metrics_key) and of
+# the selection, and the figure is built from it
+@st.cache_data(max_entries=FIGURE_CACHE_ENTRIES)
+def breakdown_lines_data(metrics_key, _df, selected_years, top_n):
+    df = _df.stack().reset_index().rename({0:"passenger_in"}, axis=1)
     df = df[df["year"].isin(selected_years)]
     top_lines = df.groupby(["line_name"])["passenger_in"].sum().nlargest(top_n).index
-    df = df[df["line_name"].isin(top_lines)]
+    return df[df["line_name"].isin(top_lines)]
 
+def breakdown_lines_metric(df):
     fig = go.Figure()
     for line in df["line_name"].unique():
         line_data = df[df["line_name"] == line]
@@ -93,26 +106,39 @@ def breakdown_lines_metric(df):
         )
     return fig
 
-def number_lines_metric(df):
-    df = df.stack().reset_index().rename({0:"number_lines"}, axis=1)
+@st.fragment
+def breakdown_lines_chart(metrics_key, df):
+    years = df.index.unique().tolist()
+    selected_years = st.multiselect("Select Years to Display", options=years, default=years)
+    top_n = st.slider("Select Number of Top Lines", min_value=2, max_value=10, value=3)
+    draw_chart("passengers boarding", breakdown_lines_metric, breakdown_lines_data(metrics_key, df, tuple(selected_years), top_n))
+
+@st.cache_data(max_entries=FIGURE_CACHE_ENTRIES)
+def number_lines_data(metrics_key, _df, selected_year):
+    df = _df.stack().reset_index().rename({0:"number_lines"}, axis=1)
     df["type_transport"] = df["type_transport"].map(global_values.VEHICLE_CLASS)
-    selected_year = st.selectbox("Select Year", options=df["year"].unique())
-    df = df[df["year"] == selected_year]
+    return df[df["year"] == selected_year]
 
-    fig = px.bar(
-        df,
-        x="type_transport",
-        y="number_lines",
-        color="type_transport",
-        height=500
-    )
+def number_lines_metric(df):
+    colors = px.colors.qualitative.Plotly
+    fig = go.Figure(go.Bar(
+        x=df["type_transport"],
+        y=df["number_lines"],
+        marker_color=[colors[i % len(colors)] for i in range(len(df))]
+    ))
     fig.update_layout(
+        height=500,
         xaxis_title="Vehicle Type",
         yaxis_title="Number of Lines",
         showlegend=False,
     )
     return fig
 
+@st.fragment
+def number_lines_chart(metrics_key, df):
+    selected_year = st.selectbox("Select Year", options=df.index.unique())
+    draw_chart("number of lines", number_lines_metric, number_lines_data(metrics_key, df, selected_year))
+
 def change_lines_metric(df):
     filter_years = st.multiselect("Select year", options=df.index[1:], default=df.index[1:])
     df = df.apply(lambda x: x - x.iloc[0]).loc[filter_years]
@@ -135,11 +161,12 @@ def change_lines_metric(df):
     )
     return fig
 
+@st.cache_data(max_entries=FIGURE_CACHE_ENTRIES)
+def km_travelled_data(metrics_key, _df, filtered_year):
+    df = _df.pivot_table(index="year", columns="vehicle_class", values="pkm", aggfunc="sum")
+    return df.loc[filtered_year]
+
 def donought_km_travelled(df):
-    unique_years = df["year"].unique()
-    df = df.pivot_table(index="year", columns="vehicle_class", values="pkm", aggfunc="sum")
-    filtered_year = st.selectbox("Select year",options=unique_years)
-    df = df.loc[filtered_year]
     label_years = df.index
     values = df.values
 
@@ -155,28 +182,48 @@ def donought_km_travelled(df):
         ]
     )
     fig.update_layout(
-        annotations=[{'text':f'{filtered_year}', 'x':0.5, 'y':0.5, 'font_size':20, 'showarrow':False}]
+        annotations=[{'text':f'{df.name}', 'x':0.5, 'y':0.5, 'font_size':20, 'showarrow':False}]
     )
     return fig
 
-def passengerkm_trend_plot(df):
-    unique_years = df["year"].unique()
-    filter_one_year = st.selectbox("Select year", options=unique_years, key="select_year")
-    df = df[(df["year"] == filter_one_year)]
+@st.fragment
+def km_travelled_chart(metrics_key, df):
+    filtered_year = st.selectbox("Select year",options=df["year"].unique())
+    draw_chart("passenger-kilometre share", donought_km_travelled, km_travelled_data(metrics_key, df, filtered_year))
 
-    fig = px.line(
-        df,
-        x="time",
-        y="pkm",
-        color="vehicle_class",
-        labels={"time":"Time", "pkm": "passenger-kilometre (pkm)", "vehicle_class":"Vehicle Type"}
-    )
+# Time series
+MAX_POINTS_PER_TRACE = 800 # About one point per pixel of a chart in a half-width column
+
+def select_time_level(key):
+    # Finest time bucket giving at most MAX_POINTS_PER_TRACE points per trace, unless another one is selected.
+    # Finer buckets are downsampled to MAX_POINTS_PER_TRACE points per trace before being drawn
+    levels = list(global_values.TIME_BUCKETS)
+    auto_level = next((level for level in levels if 24 * 3600 / global_values.TIME_BUCKETS[level] <= MAX_POINTS_PER_TRACE), levels[-1])
+    return st.select_slider("Time resolution", options=levels, value=auto_level, key=key)
+
+def to_time_of_day(seconds):
+    # Seconds since midnight as datetimes, so that Plotly draws a time axis
+    return pd.to_datetime(seconds, unit="s")
+
+def line_figure(df, x, y, color, legend_title):
+    # One line per value of color, as px.line draws them but without its per-figure overhead
+    fig = go.Figure()
+    for name, trace in df.groupby(color, sort=False, observed=True):
+        fig.add_trace(go.Scatter(x=trace[x], y=trace[y], mode="lines", name=str(name)))
+    fig.update_layout(legend_title_text=legend_title)
+    return fig
+
+@st.cache_data(max_entries=FIGURE_CACHE_ENTRIES)
+def passengerkm_trend_data(metrics_key, _rollups, level, year):
+    df = _rollups[level]
+    df = df[(df["year"] == year)]
+    df = functions.downsample_min_max(df, "time", "pkm", "vehicle_class", MAX_POINTS_PER_TRACE)
+    return df.assign(time=lambda x: to_time_of_day(x["time"]))
+
+def passengerkm_trend_plot(df):
+    fig = line_figure(df, "time", "pkm", "vehicle_class", "Vehicle Type")
     fig.update_layout(
-        xaxis=dict(
-            tickmode="array",
-            tickvals=df["time"][::5000],
-            tickangle=90
-        ),
+        xaxis=dict(tickangle=90),
         xaxis_title="Time",
         yaxis_title="passenger-kilometre (pkm)",
         xaxis_tickformat="%H:%M"
@@ -184,29 +231,24 @@ def passengerkm_trend_plot(df):
 
     return fig
 
-def occupancy_trend_plot(df):
-    df = df.unstack().unstack().reset_index().rename({"level_0":"type_day"}, axis="columns")
-    df = pd.melt(df, id_vars=["type_day", "year"], var_name="time_day")
-    type_day = df["type_day"].unique()
-    years = df["year"].unique()
-    
-    filter_one_year = st.selectbox("Select year", options=years, key="select_year_occupancy")
+@st.fragment
+def passengerkm_trend_chart(metrics_key, rollups):
+    level = select_time_level(key="resolution_pkm")
+    filter_one_year = st.selectbox("Select year", options=rollups[level]["year"].unique(), key="select_year")
+    draw_chart("passenger-kilometre distribution", passengerkm_trend_plot,
+               passengerkm_trend_data(metrics_key, rollups, level, filter_one_year))
 
-    df = df[df["year"]==filter_one_year].drop("year", axis="columns")
+@st.cache_data(max_entries=FIGURE_CACHE_ENTRIES)
+def occupancy_trend_data(metrics_key, _rollups, level, year):
+    df = _rollups[level].xs(year, axis="columns", level="year").rename_axis(columns="type_day").reset_index()
+    df = pd.melt(df, id_vars=["time"], var_name="type_day")
+    df = functions.downsample_min_max(df, "time", "value", "type_day", MAX_POINTS_PER_TRACE)
+    return df.assign(time=lambda x: to_time_of_day(x["time"]))
 
-    fig = px.line(
-        df,
-        x="time_day",
-        y="value",
-        color="type_day",
-        labels={"time_day": "Time", "value": "No. passengers", "type_day":"Day of the week"}
-    )
+def occupancy_trend_plot(df):
+    fig = line_figure(df, "time", "value", "type_day", "Day of the week")
     fig.update_layout(
-        xaxis=dict(
-            tickmode="array",
-            tickvals=df["time_day"][::1000],
-            tickangle=90
-        ),
+        xaxis=dict(tickangle=90),
         xaxis_title="Time of day",
         yaxis_title="# Passengers",
         xaxis_tickformat="%H:%M"
@@ -214,80 +256,330 @@ def occupancy_trend_plot(df):
 
     return fig
 
+@st.fragment
+def occupancy_trend_chart(metrics_key, rollups):
+    level = select_time_level(key="resolution_occupancy")
+    years = rollups[level].columns.get_level_values("year").unique()
+    filter_one_year = st.selectbox("Select year", options=years, key="select_year_occupancy")
+    draw_chart("occupancy trend", occupancy_trend_plot, occupancy_trend_data(metrics_key, rollups, level, filter_one_year))
+
+@st.cache_data(max_entries=FIGURE_CACHE_ENTRIES)
+def capacity_factor_trend_data(metrics_key, _rollups, level, year):
+    df = _rollups[level][year].reset_index()
+    df = pd.melt(df, id_vars=["time"], var_name="type_transport")
+    df = functions.downsample_min_max(df, "time", "value", "type_transport", MAX_POINTS_PER_TRACE)
+    return df.assign(time=lambda x: to_time_of_day(x["time"]))
+
 def capacity_factor_trend_plot(df):
-    df = df.unstack().unstack().reset_index()
-    df = pd.melt(df, id_vars=["year", "type_transport"])
-    
-    years = df["year"].unique()
+    fig = line_figure(df, "time", "value", "type_transport", "Type transport")
+    fig.update_layout(
+        xaxis=dict(tickangle=90),
+        xaxis_title = "Departure time",
+        yaxis_title = "Capacity factor",
+        xaxis_tickformat="%H:%M"
+    )
+    return fig
+
+@st.fragment
+def capacity_factor_trend_chart(metrics_key, rollups):
+    level = select_time_level(key="resolution_capacity")
+    years = rollups[level].columns.get_level_values("year").unique()
     filter_year = st.selectbox("Select year", options=years, key="filter_year_capacity")
-    df = df[df["year"]==filter_year].drop("year", axis="columns")
+    draw_chart("capacity factor", capacity_factor_trend_plot, capacity_factor_trend_data(metrics_key, rollups, level, filter_year))
+
+def slice_filters(path):
+    # Widgets of the slice to explore. Empty selections do not filter
+    col1, col2, col3 = st.columns(3)
+    with col1:
+        years = st.multiselect("Years", options=storage.dataset_years(path), key="slice_years")
+        day_type = st.selectbox("Days", options=list(query_engine.DAY_FACTORS), key="slice_day_type")
+    with col2:
+        lines = st.multiselect("Lines", options=query_engine.distinct_values(path, "line_name"), key="slice_lines")
+        vehicles = st.multiselect("Vehicle types", options=query_engine.distinct_values(path, "type_transport"), key="slice_vehicles")
+    with col3:
+        stops = st.multiselect("Stops", options=query_engine.distinct_values(path, "stop_current"), key="slice_stops")
+        directions = st.multiselect("Direction", options=query_engine.distinct_values(path, "direction"), key="slice_directions")
+    filters = {"line_name": lines, "type_transport": vehicles, "stop_current": stops, "direction": directions}
+    return years or None, filters, query_engine.DAY_FACTORS[day_type]
+
+def slice_summary(path, years, filters, day_factor):
+    df = query_engine.aggregate(path, ["year"], SLICE_MEASURES, filters, years, day_factor)
+    return df.set_index("year").rename(columns=SLICE_MEASURES)
+
+def slice_trend_plot(path, years, filters, day_factor):
+    df = query_engine.aggregate(path, ["year", "departure_time"], ["passenger_kilometre"], filters, years, day_factor,
+                                bucket_seconds=SLICE_BUCKET_SECONDS)
+    df = df.assign(time=lambda x: to_time_of_day(x["departure_time"]))
     fig = px.line(
         df,
-        x="departure_time",
-        y="value",
-        color="type_transport",
-        labels={"departure_time": "Time", "type_transport": "Type transport", "value": "Capacity factor"}
+        x="time",
+        y="passenger_kilometre",
+        color="year",
+        labels={"time": "Time", "passenger_kilometre": "passenger-kilometre (pkm)", "year": "Year"}
     )
     fig.update_layout(
-        xaxis=dict(
-            tickmode="array",
-            tickvals=df["departure_time"][::10000],
-            tickangle=90
-        ),
-        xaxis_title = "Departure time",
-        yaxis_title = "Capacity factor",
+        xaxis=dict(tickangle=90),
+        xaxis_title="Departure time",
+        yaxis_title="passenger-kilometre (pkm)",
+        xaxis_tickformat="%H:%M"
+    )
+    return fig
+
+def stop_activity_heatmap(stops):
+    df = stops["boardings"] + stops["alightings"]
+    fig = px.imshow(
+        df,
+        aspect="auto",
+        color_continuous_scale="Reds",
+        labels={"x": "Year", "y": "Stop", "color": "Passengers (boarding + alighting)"}
+    )
+    fig.update_layout(height=600)
+    return fig
+
+def segment_load_heatmap(matrix):
+    fig = px.imshow(
+        matrix,
+        aspect="auto",
+        color_continuous_scale="Blues",
+        labels={"x": "Next stop", "y": "Stop", "color": "Passengers"}
+    )
+    fig.update_layout(height=600, xaxis=dict(tickangle=90))
+    return fig
+
+# CO2 scenarios (utils/scenarios.py). The sliders only run the panel again, and all its scenarios (the current
+# values, the sweep of the share of SCENARIO_SWEEP_TYPE) are computed at once from the passenger-kilometre tensor
+@st.cache_data(max_entries=FIGURE_CACHE_ENTRIES)
+def scenario_arrays(metrics_key, _pkm_tensor):
+    return scenarios.tensor_arrays(_pkm_tensor)
+
+def scenario_inputs(vehicle_classes, baseline):
+    # Sliders of the fleet mix (shares in %, normalized to add up to 100) and of the intensities of the vehicle classes
+    st.markdown("Fleet of private vehicles (%)")
+    columns = st.columns(len(scenarios.FLEET_TYPES))
+    fleet_mix = [column.slider(fleet_type, 0, 100, int(round(share * 100)), key=f"scenario_fleet_{fleet_type}")
+                 for column, fleet_type, share in zip(columns, scenarios.FLEET_TYPES, scenarios.FLEET_MIX)]
+    with st.expander("Carbon intensity of the VBZ vehicles (kg CO2-eq per pkm)"):
+        columns = st.columns(4)
+        intensities = [columns[position % 4].slider(global_values.VEHICLE_CLASS.get(vehicle_class, vehicle_class), 0.0, 0.2,
+                                                     float(value), step=0.0005, format="%.4f", key=f"scenario_intensity_{vehicle_class}")
+                       for position, (vehicle_class, value) in enumerate(zip(vehicle_classes, baseline))]
+    return np.array(fleet_mix, dtype="float64"), np.array(intensities)
+
+def scenario_year_plot(years, baseline, scenario):
+    fig = go.Figure([go.Bar(x=years, y=baseline, name="Current values"), go.Bar(x=years, y=scenario, name="Scenario")])
+    fig.update_layout(
+        barmode="group",
+        xaxis_title="Year",
+        yaxis_title="CO2 emissions avoided (t CO2-eq)",
+        xaxis_type="category"
+    )
+    return fig
+
+def scenario_sweep_plot(shares, baseline, scenario, fleet_share):
+    fig = go.Figure([go.Scatter(x=shares * 100, y=baseline, mode="lines", name="Current VBZ intensities"),
+                     go.Scatter(x=shares * 100, y=scenario, mode="lines", name="Scenario VBZ intensities")])
+    fig.add_vline(x=fleet_share * 100, line_dash="dash")
+    fig.update_layout(
+        xaxis_title=f"Share of {SCENARIO_SWEEP_TYPE.lower()}s in the fleet (%)",
+        yaxis_title="CO2 emissions avoided (t CO2-eq)"
+    )
+    return fig
+
+@st.fragment
+def scenario_panel(metrics_key, pkm_tensor):
+    arrays = scenario_arrays(metrics_key, pkm_tensor)
+    baseline = scenarios.baseline_intensities(arrays["vehicle_classes"])
+    fleet_mix, intensities = scenario_inputs(arrays["vehicle_classes"], baseline)
+    if not fleet_mix.sum():
+        st.warning("Select a share of the fleet for at least one type of vehicle")
+        return
+    # Current values and scenario, and the sweep with both sets of intensities
+    avoided = scenarios.avoided_emissions(arrays, np.vstack([baseline, intensities]), np.vstack([scenarios.FLEET_MIX, fleet_mix]))
+    shares = np.linspace(0, 1, SCENARIO_SWEEP_POINTS)
+    mixes = scenarios.fleet_mix_sweep(fleet_mix, SCENARIO_SWEEP_TYPE, shares)
+    sweep = scenarios.avoided_emissions(arrays, np.repeat([baseline, intensities], len(shares), axis=0), np.vstack([mixes, mixes]))
+
+    years = arrays["years"].astype(str)
+    st.metric(
+        label=f"CO2 emissions avoided in {years[-1]} (scenario)",
+        value=f"{avoided[1, -1]:,.0f} t CO2-eq",
+        delta=delta_text(avoided[1, -1], avoided[0, -1])
+    )
+    col1, col2 = st.columns(2)
+    with col1:
+        draw_chart("CO2 scenario by year", scenario_year_plot, years, avoided[0], avoided[1])
+    with col2:
+        st.markdown(f"Emissions avoided in {years[-1]} by share of {SCENARIO_SWEEP_TYPE.lower()}s")
+        draw_chart("CO2 scenario sweep", scenario_sweep_plot, shares, sweep[:len(shares), -1], sweep[len(shares):, -1],
+                   fleet_mix[scenarios.FLEET_TYPES.index(SCENARIO_SWEEP_TYPE)] / fleet_mix.sum())
+
+# Crowding percentiles, read from the quantile sketches of the metrics (utils/sketches.py): the sketches of the
+# selected years and lines are merged when the selection changes, the rows of the data are not read again
+@st.cache_data(max_entries=FIGURE_CACHE_ENTRIES)
+def crowding_data(metrics_key, _sketch, capacity, years, lines):
+    sketch = _sketch[(_sketch["capacity"] == capacity) & _sketch["year"].isin(years)]
+    if lines:
+        sketch = sketch[sketch["line_name"].isin(lines)]
+    by_time = sketches.sketch_quantiles(sketch, ["time"], CROWDING_QUANTILES).drop(columns="weight") * 100
+    by_time = by_time.rename_axis(columns="percentile").stack().rename("value").reset_index()
+    by_line = sketches.sketch_quantiles(sketch, ["line_name"], CROWDING_QUANTILES).drop(columns="weight") * 100
+    by_line = by_line.sort_values(f"P{CROWDING_QUANTILES[1] * 100:g}", ascending=False).head(CROWDING_TOP_LINES)
+    return by_time.assign(time=lambda x: to_time_of_day(x["time"])), by_line.round(1).rename_axis("line")
+
+def crowding_plot(df):
+    fig = line_figure(df, "time", "value", "percentile", "Percentile")
+    fig.add_hline(y=100, line_dash="dash")
+    fig.update_layout(
+        xaxis=dict(tickangle=90),
+        xaxis_title="Departure time",
+        yaxis_title="Passengers on board (% of the capacity)",
         xaxis_tickformat="%H:%M"
     )
     return fig
 
+@st.fragment
+def crowding_panel(metrics_key, sketch):
+    if sketch.empty:
+        st.info("The crowding percentiles are not available for these metrics")
+        return
+    col1, col2, col3 = st.columns(3)
+    with col1:
+        capacity = st.selectbox("Capacity", options=list(sketches.CAPACITY_COLUMNS), format_func=sketches.CAPACITY_COLUMNS.get,
+                                key="crowding_capacity")
+    with col2:
+        year_options = sorted(sketch["year"].unique())
+        years = st.multiselect("Years", options=year_options, default=year_options[-1:], key="crowding_years")
+    with col3:
+        lines = st.multiselect("Lines", options=sorted(sketch["line_name"].unique()), key="crowding_lines")
+    by_time, by_line = crowding_data(metrics_key, sketch, capacity, years or year_options, lines)
+    col1, col2 = st.columns(2)
+    with col1:
+        draw_chart("crowding percentiles", crowding_plot, by_time)
+    with col2:
+        st.markdown("Most crowded lines (% of the capacity)")
+        st.dataframe(by_line)
+    st.caption(f"Percentiles of the departures of the year (weighted by their days), by hour of departure. They are "
+               f"within {sketches.RELATIVE_ACCURACY:.0%} of the exact percentiles")
+
+@st.fragment(run_every=JOB_POLL_SECONDS)
+def watch_job(job, years_shown):
+    # Run the page again once the job has completed more years, or finished
+    if job.finished or (job.partial is not None and job.partial["years"] != years_shown):
+        st.rerun()
+
+def draw_chart(name, build_figure, *args):
+    # Build and draw a figure, recording on the Diagnostics page the total time, the time to build the figure and,
+    # if enabled there, the size of its JSON, serialized as st.plotly_chart does to send it to the browser
+    with profiling.stage(f"figure: {name}") as record:
+        start = time.perf_counter()
+        fig = build_figure(*args)
+        record["build_seconds"] = round(time.perf_counter() - start, 4)
+        if profiling.PAYLOADS or profiling.DETAILED:
+            record["payload_kb"] = round(len(plotly.io.to_json(fig, validate=False)) / 1024, 1)
+        st.plotly_chart(fig)
+
 ########## Main logic ##########
-if "metrics" not in st.session_state or st.session_state.metrics is None:
+# Metrics of the dataset loaded on the main page, shared with the rest of the sessions using it
+dataset = st.session_state.get("dataset")
+# Uploads processed in the background (main page): the years completed so far are shown while the rest are loading
+job = st.session_state.get("job")
+if job is not None and job.status == "done":
+    dataset = job.result["dataset"] # Finished while on this page, the main page adopts it on its next run
+metrics = dataset.metrics if dataset is not None else None
+# Key of the metrics for the cached chart data: shared datasets have ids based on their content
+metrics_key = dataset.dataset_id if dataset is not None else None
+if job is not None and not job.finished:
+    if job.partial is not None:
+        metrics, metrics_key = job.partial["metrics"], job.partial["key"]
+        loading = [str(year) for year, stage in job.years.items() if stage not in ["done", "failed"]]
+        st.info(f"Showing {', '.join(map(str, job.partial['years']))}, still loading: {', '.join(loading)}")
+    watch_job(job, job.partial["years"] if job.partial is not None else None)
+if metrics is None:
     st.warning("Metrics are not available. Please, calculate them on the main page")
 else:
+    # Plotting libraries are only imported once there are charts to draw
+    import plotly.express as px
+    import plotly.graph_objects as go
+    import plotly.io
+
     st.title("Dashboard Page")
     st.markdown("<br><br>", unsafe_allow_html=True)
 
     # Main metrics
     col1, col2, col3, col4 = st.columns(4)
     with col1:
-        pkm_metric(st.session_state.metrics["pkm_amount"])
+        pkm_metric(metrics["pkm_total"])
     with col2:
-        distance_metric(st.session_state.metrics["distance_travelled"])
+        distance_metric(metrics["distance_travelled"])
     with col3:
-        co2_metric(st.session_state.metrics["saved_co2"])
+        co2_metric(metrics["saved_co2"])
     with col4:
-        passenger_boarding_metric(st.session_state.metrics["number_passengers"])
+        passenger_boarding_metric(metrics["number_passengers"])
 
     # Visualizations
     col1, col2 = st.columns(2)
     with col1:
         st.markdown("<br><br> <h1 style='font-size:26px'>Passenger-kilometre share </h1>", unsafe_allow_html=True)
-        fig = donought_km_travelled(df=st.session_state.metrics["pkm_amount"])
-        st.plotly_chart(fig)
+        km_travelled_chart(metrics_key, metrics["pkm_amount"])
 
     with col2:
         st.markdown("<br><br> <h1 style='font-size:26px'>Passengers (boarding)</h1>", unsafe_allow_html=True)
-        fig = breakdown_lines_metric(st.session_state.metrics["number_passengers"])
-        st.plotly_chart(fig)
+        breakdown_lines_chart(metrics_key, metrics["number_passengers"])
         
     col1, col2 = st.columns(2)
     with col1:
         st.markdown("<h1 style='font-size:26px'>Number of lines </h1>", unsafe_allow_html=True)
-        fig = number_lines_metric(st.session_state.metrics["number_lines"])
-        st.plotly_chart(fig)
+        number_lines_chart(metrics_key, metrics["number_lines"])
         
     with col2:
         st.markdown("<h1 style='font-size:26px'>Occupancy trend (passengers travelling) </h1>", unsafe_allow_html=True)
-        fig = occupancy_trend_plot(df=st.session_state.metrics["occupancy_trend"])
-        st.plotly_chart(fig)
+        occupancy_trend_chart(metrics_key, metrics["time_rollups"]["occupancy_trend"])
     
     col1, col2 = st.columns(2)
     with col1:
         st.markdown("<h1 style='font-size:26px'>Passenger-kilometre distribution", unsafe_allow_html=True)
-        fig = passengerkm_trend_plot(df=st.session_state.metrics["pkm_amount"])
-        st.plotly_chart(fig)
+        passengerkm_trend_chart(metrics_key, metrics["time_rollups"]["pkm_amount"])
         
     with col2:
         st.markdown("<h1 style='font-size:26px'>Capacity factor</h1>", unsafe_allow_html=True)
-        fig = capacity_factor_trend_plot(df=st.session_state.metrics["capacity_factor"])
-        st.plotly_chart(fig)
+        capacity_factor_trend_chart(metrics_key, metrics["time_rollups"]["capacity_factor"])
+
+    st.markdown("<br><br> <h1 style='font-size:26px'>CO2 scenarios</h1>", unsafe_allow_html=True)
+    scenario_panel(metrics_key, metrics["pkm_tensor"])
+
+    st.markdown("<br><br> <h1 style='font-size:26px'>Crowding</h1>", unsafe_allow_html=True)
+    crowding_panel(metrics_key, metrics["crowding"])
+
+    # Slices of the stored dataset, queried on its files with the filters pushed down (utils/query_engine.py)
+    if st.session_state.get("dataset_path") and job is None:
+        import utils.network as network
+        import utils.query_engine as query_engine
+        import utils.storage as storage
+
+        st.markdown("<br><br> <h1 style='font-size:26px'>Explore a slice</h1>", unsafe_allow_html=True)
+        years, filters, day_factor = slice_filters(st.session_state.dataset_path)
+        start = time.perf_counter()
+        try:
+            st.dataframe(slice_summary(st.session_state.dataset_path, years, filters, day_factor))
+            draw_chart("slice trend", slice_trend_plot, st.session_state.dataset_path, years, filters, day_factor)
+            st.caption(f"Queried with {query_engine.default_engine()} in {time.perf_counter() - start:.2f} s")
+        except FileNotFoundError:
+            st.warning("The stored dataset is not available anymore, load it again on the main page")
+
+        # Stop network of the stored dataset (utils/network.py), precomputed when the dataset was written
+        st.markdown("<br><br> <h1 style='font-size:26px'>Stop network</h1>", unsafe_allow_html=True)
+        try:
+            stop_network = network.load_network(st.session_state.dataset_path)
+        except FileNotFoundError:
+            stop_network = None
+        if stop_network is not None and len(stop_network["years"]):
+            network_year = st.selectbox("Select year", options=stop_network["years"][::-1].tolist(), key="network_year")
+            col1, col2 = st.columns(2)
+            with col1:
+                st.markdown("Busiest stops (boarding + alighting)")
+                draw_chart("busiest stops", stop_activity_heatmap, network.busiest_stops(stop_network, NETWORK_TOP))
+            with col2:
+                st.markdown(f"Passengers between the busiest stops in {network_year}")
+                draw_chart("segment loads", segment_load_heatmap, network.segment_matrix(stop_network, network_year, NETWORK_TOP))
+            st.markdown(f"Busiest corridors in {network_year} (both directions)")
+            st.dataframe(network.busiest_corridors(stop_network, network_year, NETWORK_TOP))
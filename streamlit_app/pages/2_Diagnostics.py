@@ -0,0 +1,93 @@
+import streamlit as st
+import pandas as pd
+import json
+import os
+import utils.dataset_registry as dataset_registry
+import utils.pipeline as pipeline
+import utils.pipeline_cache as pipeline_cache
+import utils.profiling as profiling
+import utils.storage as storage
+
+# Page configuration
+st.set_page_config(
+    page_title="Diagnostics",
+    page_icon=":stopwatch:",
+    layout="wide"
+)
+
+CURRENT_PROCESS = "Current app process"
+
+def profiled_datasets():
+    # Stored datasets with the profile of the run that produced them (written by run_pipeline.py)
+    return [name for name in storage.list_datasets()
+            if os.path.exists(os.path.join(storage.OUTPUT_DIRECTORY, name, pipeline.PROFILE_FILE))]
+
+def load_records(source):
+    if source == CURRENT_PROCESS:
+        return list(profiling.RECORDS)
+    with open(os.path.join(storage.OUTPUT_DIRECTORY, source, pipeline.PROFILE_FILE)) as f:
+        return json.load(f)
+
+def stage_summary(records):
+    # Totals per stage: number of runs, time, rows and highest peak memory
+    return (records.groupby("stage", sort=False)
+                   .agg(runs=("stage", "size"),
+                        wall_seconds=("wall_seconds", "sum"),
+                        cpu_seconds=("cpu_seconds", "sum"),
+                        rows_in=("rows_in", "sum"),
+                        rows_out=("rows_out", "sum"),
+                        peak_rss_mb=("peak_rss_mb", "max"))
+                   .sort_values("wall_seconds", ascending=False))
+
+########## Main logic ##########
+st.title("Diagnostics")
+
+detailed = st.checkbox("Detailed profiling (cProfile of each outermost stage)", value=profiling.DETAILED)
+profiling.set_detailed(detailed)
+payloads = st.checkbox("Size of the Dashboard figures (serializes each figure once more)", value=profiling.PAYLOADS)
+profiling.set_payloads(payloads)
+
+source = st.selectbox("Records", options=[CURRENT_PROCESS] + profiled_datasets())
+records = load_records(source)
+
+if not records:
+    st.info("No stages recorded yet. Load data on the main page or open the Dashboard")
+else:
+    records_df = pd.DataFrame([{key: value for key, value in record.items() if key != "profile"} for record in records])
+    records_df["started_at"] = pd.to_datetime(records_df["started_at"], unit="s")
+
+    st.markdown("<h1 style='font-size:26px'>Time per stage</h1>", unsafe_allow_html=True)
+    st.dataframe(stage_summary(records_df))
+
+    per_year = records_df.dropna(subset=["year"])
+    if not per_year.empty:
+        st.markdown("<h1 style='font-size:26px'>Wall time per stage and year (s)</h1>", unsafe_allow_html=True)
+        st.dataframe(per_year.pivot_table(index="stage", columns="year", values="wall_seconds", aggfunc="sum", sort=False))
+
+    figures = records_df[records_df["stage"].str.startswith("figure: ")]
+    if not figures.empty and "build_seconds" in figures:
+        # Last drawing of each Dashboard chart: time to build the figure, size sent to the browser (if measured) and total time
+        st.markdown("<h1 style='font-size:26px'>Dashboard figures</h1>", unsafe_allow_html=True)
+        columns = [column for column in ["wall_seconds", "build_seconds", "payload_kb", "started_at"] if column in figures]
+        st.dataframe(figures.drop_duplicates("stage", keep="last").set_index("stage")[columns])
+
+    with st.expander("All records"):
+        st.dataframe(records_df)
+
+    profiles = [record for record in records if record.get("profile")]
+    for record in profiles:
+        with st.expander(f"cProfile: {record['stage']}" + (f" ({record['year']})" if record["year"] else "")):
+            st.code(record["profile"])
+
+    st.download_button(label="Download JSON", data=profiling.to_json(records),
+                       file_name="profile.json", mime="application/json")
+
+if source == CURRENT_PROCESS and st.button("Clear records"):
+    profiling.clear()
+    st.rerun()
+
+with st.expander("Pipeline cache"):
+    st.write(pipeline_cache.cache_summary())
+
+with st.expander("Shared datasets (sessions using each dataset loaded in memory)"):
+    st.write(dataset_registry.registry_summary())
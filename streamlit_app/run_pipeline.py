@@ -0,0 +1,82 @@
+"""
+Headless batch pipeline: ingest, clean and compute the metrics of a directory of yearly OGD ZIP files, without
+Streamlit. The processed dataset and the metrics are written to the output directory, where the app lists them
+under "Option 2: Load the processed data".
+
+Usage (from the streamlit_app folder):
+    python run_pipeline.py path/to/zips --years 2022 2023 --workers 4
+    python run_pipeline.py path/to/zips --loading-mode stream --chunk-size 500000
+    python run_pipeline.py path/to/zips --loading-mode auto --dry-run
+
+The ZIP files are pre-scanned first (utils/prescan.py): the files that would fail are left out, and the "auto"
+loading mode follows the plan made from the estimated memory of the years (streaming them if they do not fit in
+the memory budget, with the chunk size fitting it).
+"""
+import argparse
+import json
+import logging
+import sys
+import utils.ingestion as ingestion
+import utils.pipeline as pipeline
+import utils.pipeline_cache as pipeline_cache
+import utils.prescan as prescan
+import utils.profiling as profiling
+import utils.storage as storage
+import utils.streaming as streaming
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("zip_directory", help="directory with the yearly ZIP files")
+    parser.add_argument("--years", nargs="+", help="years to process (default: all the ZIP files of the directory)")
+    parser.add_argument("--workers", type=int, default=ingestion.MAX_WORKERS, help="worker processes loading the years in parallel")
+    parser.add_argument("--memory-budget-mb", type=int, default=ingestion.MEMORY_BUDGET_MB,
+                        help="estimated memory allowed for the years loaded at the same time")
+    parser.add_argument("--loading-mode", choices=pipeline.LOADING_MODES + ["auto"], default="zip",
+                        help="auto: the loading mode, workers and chunk size of the ingestion plan")
+    parser.add_argument("--chunk-size", type=int, default=streaming.CHUNK_SIZE,
+                        help="rows of REISENDE read at a time in the stream loading mode, which bounds the memory used")
+    parser.add_argument("--output-directory", default=storage.OUTPUT_DIRECTORY)
+    parser.add_argument("--dry-run", action="store_true", help="only print the ingestion plan of the ZIP files")
+    parser.add_argument("--profile", action="store_true",
+                        help="also run each stage under cProfile; the reports are written to profile.json with the artifacts")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(name)s: %(message)s")
+    archives = pipeline.find_archives(args.zip_directory, args.years)
+    if not archives:
+        logging.error("No ZIP files found in %s for the selected years", args.zip_directory)
+        return 1
+
+    plan = prescan.plan_ingestion(prescan.scan_archives([(path, path) for _, path in archives]), args.memory_budget_mb,
+                                  args.workers, args.chunk_size)
+    for info in plan["files"]:
+        for error in info["errors"]:
+            logging.error("%s: %s", info["file"], error)
+        for warning in info["warnings"]:
+            logging.warning("%s: %s", info["file"], warning)
+    if args.dry_run:
+        print(json.dumps({"plan": plan}, indent=2, default=str))
+        return 0
+    archives = prescan.planned_archives(plan, [(path, path) for _, path in archives])
+    if not archives:
+        logging.error("None of the ZIP files can be loaded")
+        return 1
+
+    loading_mode, workers, chunk_size = args.loading_mode, args.workers, args.chunk_size
+    if loading_mode == "auto":
+        loading_mode, workers, chunk_size = plan["loading_mode"], plan["workers"], plan["chunk_size"]
+        logging.info("loading mode %s, %d worker(s), chunks of %d rows", loading_mode, workers, chunk_size)
+    if args.profile:
+        profiling.set_detailed(True)
+    path, report, records = pipeline.run(archives, args.output_directory, loading_mode, workers, args.memory_budget_mb,
+                                         chunk_size)
+    for year, info in report.items():
+        if info["status"] == "failed":
+            logging.warning("Year %s could not be loaded: %s", year, info["error"])
+    stages = [{key: value for key, value in record.items() if key != "profile"} for record in records]
+    print(json.dumps({"artifacts": path, "plan": plan, "report": report, "stages": stages,
+                      "pipeline_cache": pipeline_cache.cache_summary()}, indent=2, default=str))
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
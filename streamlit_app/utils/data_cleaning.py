@@ -1,5 +1,49 @@
 import pandas as pd
-import streamlit as st
+import numpy as np
+import os
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import utils.functions as functions
+import utils.profiling as profiling
+
+# Deduplication: the rows are hashed from the buffers of their columns (category codes and numeric values), in
+# blocks of DEDUP_BLOCK_ROWS processed by a shared pool of threads (numpy releases the GIL while hashing). Duplicated rows
+# have the same hash, so only the rows whose hash is repeated are candidates, which drop_duplicates then compares
+# exactly: the result is the same as that of drop_duplicates on the whole frame, while the memory used besides the
+# frame is 8 bytes per row and the temporaries of the blocks
+DEDUP_WORKERS = os.cpu_count() or 1 # Threads of a year cleaned alone, see dedup_workers when several years are processed
+DEDUP_BLOCK_ROWS = 250_000
+HASH_MULTIPLIER = np.uint64(0x9E3779B97F4A7C15)
+
+_dedup_executor = None # Pool of DEDUP_WORKERS threads shared by all the calls, created on first use (not on import, e.g. by the ingestion workers)
+_dedup_lock = threading.Lock()
+
+def dedup_workers(parallel_years):
+    # Threads of the deduplication when the ingestion plan processes parallel_years years at the same time, so that
+    # together they do not use more threads than CPUs
+    return max(1, DEDUP_WORKERS // max(1, parallel_years))
+
+def dedup_executor():
+    global _dedup_executor
+    with _dedup_lock:
+        if _dedup_executor is None:
+            _dedup_executor = ThreadPoolExecutor(max_workers=DEDUP_WORKERS, thread_name_prefix="dedup")
+        return _dedup_executor
+
+def map_blocks(function, blocks, workers):
+    # Results of function for each block, in order. At most workers blocks of the call are submitted to the shared
+    # pool at the same time, so that the years cleaned in parallel share its threads
+    if len(blocks) < 2 or workers < 2:
+        return [function(block) for block in blocks]
+    executor = dedup_executor()
+    results, pending = [], deque()
+    for block in blocks:
+        if len(pending) == workers:
+            results.append(pending.popleft().result())
+        pending.append(executor.submit(function, block))
+    results.extend(future.result() for future in pending)
+    return results
 
 def safe_decode(string):
     # Function to handle possible string errors as the Umlauts are not properly displayed
@@ -17,18 +61,116 @@ def adjust_invalid_times(time_str):
         return str(hour - 24) + time_str[2:]
     return time_str
 
-@st.cache_data
-def clean_data(data):
+def decode_strings(series):
+    # Decode each distinct value once, instead of once per row
+    if isinstance(series.dtype, pd.CategoricalDtype):
+        # Decode the categories and merge those that end up being equal after decoding
+        category_codes, categories = pd.factorize(np.array([safe_decode(value) for value in series.cat.categories], dtype=object))
+        codes = series.cat.codes.to_numpy()
+        codes = np.where(codes >= 0, category_codes[codes], -1)
+        return pd.Series(pd.Categorical.from_codes(codes, categories=categories), index=series.index, name=series.name)
+
+    # Missing values get the code -1, which takes the NaN appended at the end of the decoded values
+    codes, uniques = pd.factorize(series)
+    decoded = np.array([safe_decode(value) for value in uniques] + [np.nan], dtype=object)
+    return pd.Series(decoded[codes], index=series.index, name=series.name)
+
+def adjust_invalid_seconds(seconds):
+    # Departure times above 24h belong to trips after midnight and are moved back by one day
+    seconds = seconds.where(seconds < 24 * 3600, seconds - 24 * 3600)
+    if ((seconds < 0) | (seconds >= 24 * 3600)).any():
+        raise ValueError("Departure times out of the range 00:00:00 - 47:59:59")
+    return seconds
+
+def hash_buffers(data):
+    # Array hashed for each column, equal for the values that drop_duplicates takes as equal: the codes of the
+    # categoricals, the numeric values (floats are normalized when hashed) and the codes of the other values
+    buffers = []
+    for column in data.columns:
+        series = data[column]
+        if isinstance(series.dtype, pd.CategoricalDtype):
+            buffers.append(series.cat.codes.to_numpy())
+        elif isinstance(series.dtype, np.dtype) and series.dtype.kind in "biuf":
+            buffers.append(series.to_numpy())
+        elif isinstance(series.dtype, np.dtype) and series.dtype.kind in "mM":
+            buffers.append(series.to_numpy().view("int64"))
+        else: # Objects and extension types, factorized with the same equality as drop_duplicates
+            buffers.append(pd.factorize(series)[0])
+    return buffers
+
+def mix_hash(hashes):
+    # Final mixing of the hashes (splitmix64), so that the hashes of similar rows do not collide
+    hashes ^= hashes >> np.uint64(30)
+    hashes *= np.uint64(0xBF58476D1CE4E5B9)
+    hashes ^= hashes >> np.uint64(27)
+    hashes *= np.uint64(0x94D049BB133111EB)
+    hashes ^= hashes >> np.uint64(31)
+    return hashes
+
+def hash_rows(buffers, start, stop):
+    # 64-bit hash of the rows start to stop
+    hashes = np.zeros(stop - start, dtype="uint64")
+    for values in buffers:
+        values = values[start:stop]
+        if values.dtype.kind == "f":
+            # -0.0 and 0.0 are equal, as all the NaNs are
+            values = values.astype("float64") + 0.0
+            values[np.isnan(values)] = np.nan
+            values = values.view("uint64")
+        hashes *= HASH_MULTIPLIER
+        hashes += values.astype("uint64")
+    return mix_hash(hashes)
+
+def repeated_hash_rows(hashes, repeated, start, stop):
+    # Positions of the rows start to stop whose hash is one of the repeated hashes (sorted)
+    block = hashes[start:stop]
+    return start + np.flatnonzero(repeated[np.minimum(np.searchsorted(repeated, block), len(repeated) - 1)] == block)
+
+def duplicated_rows(data, workers=None):
+    """
+    Positions of the rows of data equal to an earlier row, the rows data.duplicated() marks. The rows are hashed
+    and only those sharing their hash with another row are compared, in blocks processed by workers threads
+    (DEDUP_WORKERS if not given).
+    """
+    workers = workers or DEDUP_WORKERS
+    buffers = hash_buffers(data)
+    blocks = [(start, min(start + DEDUP_BLOCK_ROWS, len(data))) for start in range(0, len(data), DEDUP_BLOCK_ROWS)]
+    hashes = np.concatenate([np.zeros(0, dtype="uint64")] + map_blocks(lambda block: hash_rows(buffers, *block), blocks, workers))
+
+    ordered = np.sort(hashes)
+    repeated = ordered[1:][ordered[1:] == ordered[:-1]]
+    if len(repeated) == 0:
+        return np.zeros(0, dtype="int64")
+    candidates = np.concatenate(map_blocks(lambda block: repeated_hash_rows(hashes, repeated, *block), blocks, workers))
+    return candidates[data.iloc[candidates].duplicated().to_numpy()]
+
+def drop_duplicated_rows(data, workers=None):
+    # Same as data.drop_duplicates(), without copying data when it has no duplicated rows. The number of rows
+    # dropped is stored in data.attrs["duplicated_rows"]
+    duplicated = duplicated_rows(data, workers)
+    if len(duplicated):
+        keep = np.ones(len(data), dtype=bool)
+        keep[duplicated] = False
+        data = data[keep]
+    data.attrs["duplicated_rows"] = len(duplicated)
+    return data
+
+def clean_data(data, dedup_workers=None):
     # Decode strings
-    data["stop_next"] = data["stop_next"].map(safe_decode)
-    data["stop_current"] = data["stop_current"].map(safe_decode)
+    with profiling.stage("decode strings"):
+        data["stop_next"] = decode_strings(data["stop_next"])
+        data["stop_current"] = decode_strings(data["stop_current"])
 
-    # Map transport types
-    data["departure_time"] = data["departure_time"].map(adjust_invalid_times)
-    data["departure_time"] = pd.to_datetime(data["departure_time"], format="%H:%M:%S").dt.time
+    # Departure times as seconds since midnight (already encoded as integers when loading the data)
+    if not pd.api.types.is_integer_dtype(data["departure_time"]):
+        data["departure_time"] = functions.time_string_to_seconds(data["departure_time"])
+    data["departure_time"] = adjust_invalid_seconds(data["departure_time"])
 
     # Convert distance to km
     data["distance"] = data["distance"] / 1000
 
     # Remove duplicated and return the data
-    return data.drop_duplicates()
\ No newline at end of file
+    with profiling.stage("drop duplicates", rows_in=len(data)) as record:
+        data = drop_duplicated_rows(data, dedup_workers)
+        record["rows_out"] = len(data)
+    return data
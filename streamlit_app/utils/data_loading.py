@@ -1,34 +1,162 @@
-import streamlit as st
 import pandas as pd
+import numpy as np
+import sys
+import zipfile
 import os
+import utils.dimensions as dimensions
+import utils.functions as functions
+import utils.profiling as profiling
 import utils.global_values as global_values
 
 CARBON_INTENSITY_TRANSPORT_VBZ = global_values.CARBON_INTENSITY_TRANSPORT_VBZ
+TABLE_COLUMNS = global_values.TABLE_COLUMNS
+CATEGORY_COLUMNS = global_values.CATEGORY_COLUMNS
 
-@st.cache_data
-def load_and_merge_data(year):
-    folder = f'{os.getcwd()}/data/{year}'
-    
-    # Load tables
-    REISENDE = pd.read_csv(f'{folder}/REISENDE.csv', sep=";").drop(["ID_Abschnitt", "Tagtyp_Id", "Anzahl_Messungen"], axis=1)
-    LINIE = pd.read_csv(f'{folder}/LINIE.csv', sep=";")
-    HALTESTELLEN = pd.read_csv(f'{folder}/HALTESTELLEN.csv', sep=";")
-    GEFAESSGROESSE = pd.read_csv(f'{folder}/GEFAESSGROESSE.csv', sep=";")
-
-    # Merge tables
-    merged_df = pd.merge(REISENDE, LINIE, how="left", on=["Linien_Id", "Linienname"]).drop("Linienname", axis=1)
-    merged_df = pd.merge(merged_df, HALTESTELLEN, how="left", on="Haltestellen_Id").drop(["Haltestellennummer", "Haltestellenkurzname"], axis=1)
-    merged_df = pd.merge(merged_df, CARBON_INTENSITY_TRANSPORT_VBZ, how="left", left_on="VSYS", right_index=True)
-    final_df = pd.merge(merged_df, GEFAESSGROESSE, how="left", on="Plan_Fahrt_Id").drop(["Linien_Id", "Plan_Fahrt_Id"], axis=1)
+def downcast_numeric(series):
+    # Smallest numeric type holding the same values: integers are downcast to the smallest integer type
+    # and floats to float32 only when no value changes
+    if pd.api.types.is_integer_dtype(series):
+        return pd.to_numeric(series, downcast="integer")
+    if pd.api.types.is_float_dtype(series) and series.dtype != "float32":
+        values = series.to_numpy()
+        downcast = values.astype("float32")
+        if np.array_equal(downcast.astype(values.dtype), values, equal_nan=True):
+            return pd.Series(downcast, index=series.index, name=series.name)
+    return series
+
+def apply_dtype_policy(table):
+    # Compact dtypes applied when reading the tables: categoricals for the labels (read as such by read_csv),
+    # downcast numerics and departure times encoded as seconds since midnight
+    for column in table.columns:
+        if column == "FZ_AB":
+            table[column] = functions.time_string_to_seconds(table[column])
+        elif pd.api.types.is_numeric_dtype(table[column]):
+            table[column] = downcast_numeric(table[column])
+    return table
+
+def read_table(source, columns):
+    dtypes = {column: "category" for column in columns if column in CATEGORY_COLUMNS}
+    return apply_dtype_policy(pd.read_csv(source, sep=";", usecols=columns, dtype=dtypes))
+
+def read_table_chunks(source, columns, chunk_size):
+    # Same as read_table, in chunks of chunk_size rows
+    dtypes = {column: "category" for column in columns if column in CATEGORY_COLUMNS}
+    with pd.read_csv(source, sep=";", usecols=columns, dtype=dtypes, chunksize=chunk_size) as reader:
+        for chunk in reader:
+            yield apply_dtype_policy(chunk)
+
+def read_tables_from_folder(folder):
+    # Read the tables previously extracted to disk, keeping only the columns used by the pipeline
+    return {table: read_table(os.path.join(folder, f"{table}.csv"), columns)
+            for table, columns in TABLE_COLUMNS.items()}
+
+def find_table_member(zip_ref, table):
+    # Member of the ZIP file holding a table, matched by file name regardless of its folder and case
+    members = {os.path.basename(f).upper(): f for f in zip_ref.namelist() if f.lower().endswith(".csv")}
+    member = members.get(f"{table}.CSV")
+    if member is None:
+        raise ValueError(f"{table}.csv not found in the ZIP file")
+    return member
+
+def read_tables_from_zip(zip_file, tables=None):
+    # Read the tables (all of them by default) straight from the member streams of the ZIP file, without writing them to disk
+    result = {}
+    with zipfile.ZipFile(zip_file, "r") as zip_ref:
+        for table in tables or TABLE_COLUMNS:
+            with zip_ref.open(find_table_member(zip_ref, table)) as csv_file:
+                result[table] = read_table(csv_file, TABLE_COLUMNS[table])
+    return result
+
+def read_table_chunks_from_zip(zip_file, table, chunk_size):
+    # Stream a table of the ZIP file in chunks of chunk_size rows
+    with zipfile.ZipFile(zip_file, "r") as zip_ref:
+        with zip_ref.open(find_table_member(zip_ref, table)) as csv_file:
+            yield from read_table_chunks(csv_file, TABLE_COLUMNS[table], chunk_size)
+
+def merge_tables(tables, year):
+    """
+    Attach the attributes of LINIE, HALTESTELLEN, GEFAESSGROESSE and the carbon intensity to REISENDE.
+
+    The rows referenced by each fact are found with position lookups on the keys of the dimension tables, and the
+    attributes are added to REISENDE in place, so the fact table is never copied. The resulting columns are the
+    same as those of left merges on the keys. The number of orphaned keys (facts referencing a missing row) and of
+    duplicated keys in the dimension tables are stored in final_df.attrs["integrity"].
+    """
+    REISENDE = tables["REISENDE"]
+    LINIE = tables["LINIE"]
+    HALTESTELLEN = tables["HALTESTELLEN"]
+    GEFAESSGROESSE = tables["GEFAESSGROESSE"]
+
+    # Lookup of the dimension rows
+    line_positions, duplicated_lines = dimensions.dimension_positions([LINIE["Linien_Id"], LINIE["Linienname"]],
+                                                                      [REISENDE["Linien_Id"], REISENDE["Linienname"]])
+    stop_positions, duplicated_stops = dimensions.dimension_positions([HALTESTELLEN["Haltestellen_Id"]], [REISENDE["Haltestellen_Id"]])
+    next_stop_positions, _ = dimensions.dimension_positions([HALTESTELLEN["Haltestellen_Id"]], [REISENDE["Nach_Hst_Id"]])
+    trip_positions, duplicated_trips = dimensions.dimension_positions([GEFAESSGROESSE["Plan_Fahrt_Id"]], [REISENDE["Plan_Fahrt_Id"]])
+
+    integrity = {"orphan_Linien_Id": dimensions.count_orphans(REISENDE["Linien_Id"], line_positions),
+                 "orphan_Haltestellen_Id": dimensions.count_orphans(REISENDE["Haltestellen_Id"], stop_positions),
+                 "orphan_Nach_Hst_Id": dimensions.count_orphans(REISENDE["Nach_Hst_Id"], next_stop_positions),
+                 "orphan_Plan_Fahrt_Id": dimensions.count_orphans(REISENDE["Plan_Fahrt_Id"], trip_positions),
+                 "duplicated_dimension_keys": duplicated_lines + duplicated_stops + duplicated_trips}
+
+    # Attach the attributes
+    final_df = REISENDE
+    del final_df["Linienname"]
+    dimensions.attach_columns(final_df, LINIE, line_positions, [c for c in LINIE.columns if c not in ("Linien_Id", "Linienname")])
+    dimensions.attach_columns(final_df, HALTESTELLEN, stop_positions, [c for c in HALTESTELLEN.columns if c != "Haltestellen_Id"])
+    final_df["carbon_intensity"] = final_df["VSYS"].map(CARBON_INTENSITY_TRANSPORT_VBZ["carbon_intensity"]).astype("float64")
+    dimensions.attach_columns(final_df, GEFAESSGROESSE, trip_positions, [c for c in GEFAESSGROESSE.columns if c != "Plan_Fahrt_Id"])
+    del final_df["Linien_Id"]
+    del final_df["Plan_Fahrt_Id"]
 
     # Add year column
-    final_df["year"] = year
+    final_df["year"] = pd.Categorical.from_codes(np.zeros(len(final_df), dtype="int8"), categories=[year])
 
     # Map the next_stop variable to the actual name of the stops
-    next_stop_mapped = pd.merge(REISENDE, HALTESTELLEN, how="left", left_on="Nach_Hst_Id", right_on="Haltestellen_Id")["Haltestellenlangname"]
-    final_df["stop_next"] = next_stop_mapped
+    final_df["stop_next"] = dimensions.take_column(HALTESTELLEN["Haltestellenlangname"], next_stop_positions)
 
+    final_df.attrs["integrity"] = integrity
     return final_df
 
+def load_and_merge_data(year):
+    # Fallback loader working on the CSV files extracted to ./data/<year>
+    folder = f'{os.getcwd()}/data/{year}'
+    with profiling.stage("read tables", year) as record:
+        tables = read_tables_from_folder(folder)
+        record["rows_out"] = len(tables["REISENDE"])
+    return merge_tables_profiled(tables, year)
+
+def load_and_merge_zip(zip_file, year):
+    # Loader working directly on the uploaded ZIP file
+    with profiling.stage("read tables", year) as record:
+        tables = read_tables_from_zip(zip_file)
+        record["rows_out"] = len(tables["REISENDE"])
+    return merge_tables_profiled(tables, year)
+
+def merge_tables_profiled(tables, year):
+    with profiling.stage("merge", year, rows_in=len(tables["REISENDE"])) as record:
+        final_df = merge_tables(tables, year)
+        record["rows_out"] = len(final_df)
+    return final_df
 
+def default_dtype_memory(series):
+    # Bytes used by the column with the default dtypes given by pandas: objects for the labels and times
+    # (a pointer per row plus the Python object), 64-bit numbers otherwise
+    if isinstance(series.dtype, pd.CategoricalDtype):
+        counts = np.bincount(series.cat.codes.to_numpy() + 1, minlength=len(series.cat.categories) + 1)
+        sizes = np.array([sys.getsizeof(np.nan)] + [sys.getsizeof(value) for value in series.cat.categories])
+        return int(8 * len(series) + counts @ sizes)
+    if series.name in ("departure_time", "FZ_AB") and pd.api.types.is_integer_dtype(series):
+        return int(8 * len(series) + len(series) * sys.getsizeof(functions.seconds_to_time([0])[0]))
+    if pd.api.types.is_numeric_dtype(series):
+        return 8 * len(series)
+    return int(series.memory_usage(deep=True, index=False))
 
+def memory_report(data):
+    # Bytes per column with the default dtypes (before) and with the dtype policy (after)
+    report = pd.DataFrame({"dtype": data.dtypes.astype(str),
+                           "bytes_before": [default_dtype_memory(data[column]) for column in data.columns],
+                           "bytes_after": data.memory_usage(deep=True, index=False)})
+    report.loc["total"] = ["", report["bytes_before"].sum(), report["bytes_after"].sum()]
+    return report
@@ -0,0 +1,141 @@
+import numpy as np
+import pandas as pd
+import logging
+import os
+import pickle
+import shutil
+import threading
+import weakref
+import utils.data_loading as data_loading
+import utils.storage as storage
+
+# Datasets shared by all the sessions of the app process. The processed data of a dataset is stored once as NumPy
+# files (one per column, the codes for categoricals) and memory-mapped read-only, so its pages are shared and
+# backed by the files instead of the heap. Metric frames and the memory report are small, kept once in memory per dataset.
+# Sessions hold handles: a dataset is evicted (frame dropped and files deleted) once no handle refers to it.
+REGISTRY_DIRECTORY = os.path.join(storage.OUTPUT_DIRECTORY, "shared_datasets")
+SCHEMA_FILE = "schema.pkl"
+
+logger = logging.getLogger(__name__)
+STATS = {"hits": 0, "loads": 0, "evictions": 0}
+_lock = threading.Lock()
+_datasets = {} # Dataset id -> {"data", "metrics", "memory_report", "handles", "path"}
+
+class Handle:
+    # Reference of a session to a shared dataset, released explicitly or when the handle is garbage collected
+    # (e.g. when the session ends). It holds no data itself
+    def __init__(self, dataset_id):
+        self.dataset_id = dataset_id
+        self._finalizer = weakref.finalize(self, release_dataset, dataset_id)
+
+    @property
+    def data(self):
+        return _datasets[self.dataset_id]["data"]
+
+    @property
+    def metrics(self):
+        return _datasets[self.dataset_id]["metrics"]
+
+    @property
+    def memory_report(self):
+        return _datasets[self.dataset_id]["memory_report"]
+
+    def release(self):
+        self._finalizer()
+
+def write_columns(data, path):
+    # Columns of the frame as .npy files, written to a temporary folder first so that a folder found at path is
+    # always complete. Columns that cannot be mapped (object or extension dtypes) are kept in the schema file
+    if os.path.isdir(path): # Left by a previous process: dataset ids depend on the content, so it holds the same data
+        return path
+    temporary_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    os.makedirs(temporary_path)
+    schema = []
+    for position, column in enumerate(data.columns):
+        series = data[column]
+        if isinstance(series.dtype, pd.CategoricalDtype):
+            np.save(os.path.join(temporary_path, f"{position}.npy"), series.cat.codes.to_numpy())
+            schema.append((column, "category", series.dtype))
+        elif isinstance(series.dtype, np.dtype) and series.dtype.kind in "biuf":
+            np.save(os.path.join(temporary_path, f"{position}.npy"), series.to_numpy())
+            schema.append((column, "array", None))
+        else:
+            schema.append((column, "series", series.reset_index(drop=True)))
+    with open(os.path.join(temporary_path, SCHEMA_FILE), "wb") as f:
+        pickle.dump(schema, f)
+    try:
+        os.replace(temporary_path, path)
+    except OSError: # Written meanwhile by another thread
+        shutil.rmtree(temporary_path, ignore_errors=True)
+    return path
+
+def read_columns(path):
+    # Frame over the memory-mapped files, without copying them. The arrays are read-only
+    with open(os.path.join(path, SCHEMA_FILE), "rb") as f:
+        schema = pickle.load(f)
+    columns = {}
+    for position, (column, kind, value) in enumerate(schema):
+        if kind == "series":
+            columns[column] = value
+            continue
+        # Plain array over the mapped memory, so that results of operations are not memmaps themselves
+        array = np.asarray(np.load(os.path.join(path, f"{position}.npy"), mmap_mode="r"))
+        columns[column] = pd.Categorical.from_codes(array, dtype=value, validate=False) if kind == "category" else array
+    return pd.DataFrame(columns, copy=False)
+
+def open_dataset(dataset_id, load):
+    """
+    Handle to the shared dataset dataset_id. The first session opening it loads it with load(), which returns the
+    processed data and its metrics (or None); the rest of the sessions get the same frames.
+    dataset_id must change whenever the data changes, e.g. a hash of the content it is loaded from.
+    """
+    with _lock:
+        entry = _datasets.get(dataset_id)
+        if entry is not None:
+            entry["handles"] += 1
+            STATS["hits"] += 1
+            return Handle(dataset_id)
+
+    data, metrics = load()
+    # Computed once here, as it scans every column of the frame (deep memory usage)
+    memory_report = data_loading.memory_report(data)
+    path = write_columns(data, os.path.join(REGISTRY_DIRECTORY, dataset_id))
+    del data
+    mapped_data = read_columns(path)
+
+    with _lock:
+        # Another session may have loaded the same dataset meanwhile, its frames are used
+        entry = _datasets.setdefault(dataset_id, {"data": mapped_data, "metrics": metrics, "memory_report": memory_report,
+                                                  "handles": 0, "path": path})
+        entry["handles"] += 1
+        STATS["loads"] += 1
+    logger.info("shared dataset loaded: %s", dataset_id[:12])
+    return Handle(dataset_id)
+
+def set_metrics(handle, metrics):
+    # Metrics calculated after the dataset was opened, shared with the rest of its sessions
+    with _lock:
+        _datasets[handle.dataset_id]["metrics"] = metrics
+
+def release_dataset(dataset_id):
+    with _lock:
+        entry = _datasets.get(dataset_id)
+        if entry is None:
+            return
+        entry["handles"] -= 1
+        if entry["handles"] > 0:
+            return
+        del _datasets[dataset_id]
+        # Frames still in use (e.g. by a page being drawn) keep their mapping after the files are deleted. On Windows,
+        # mapped files cannot be deleted and are left behind
+        shutil.rmtree(entry["path"], ignore_errors=True)
+        STATS["evictions"] += 1
+    logger.info("shared dataset evicted: %s", dataset_id[:12])
+
+def registry_summary():
+    with _lock:
+        datasets = {dataset_id[:12]: {"handles": entry["handles"], "rows": len(entry["data"]),
+                                      "mapped_mb": round(sum(os.path.getsize(os.path.join(entry["path"], name))
+                                                             for name in os.listdir(entry["path"])) / 1024**2, 1)}
+                    for dataset_id, entry in _datasets.items() if os.path.isdir(entry["path"])}
+        return {**STATS, "datasets": datasets}
@@ -0,0 +1,54 @@
+import numpy as np
+import pandas as pd
+
+def dimension_positions(dimension_keys, fact_keys):
+    """
+    Position of the dimension row referenced by each row of the fact table (-1 when there is none).
+
+    dimension_keys and fact_keys are lists with the key columns of each table. The first key is looked up in an
+    index built once from the dimension table, and the rest of the keys are compared with the matched row, so a
+    row only matches when all its keys are equal (as in a merge on all the keys). Dimension tables are expected
+    to have unique keys: when a key is duplicated only its first row is used.
+
+    Returns the positions and the number of duplicated keys found in the dimension table.
+    """
+    keys = pd.Index(dimension_keys[0])
+    duplicated = keys.duplicated()
+    rows = np.flatnonzero(~duplicated)
+    positions = keys[~duplicated].get_indexer(fact_keys[0])
+    positions = np.where(positions >= 0, rows[np.maximum(positions, 0)] if len(rows) else -1, -1)
+
+    for dimension_key, fact_key in zip(dimension_keys[1:], fact_keys[1:]):
+        matched = positions >= 0
+        equal = np.zeros(len(positions), dtype=bool)
+        equal[matched] = dimension_key.to_numpy()[positions[matched]] == fact_key.to_numpy()[matched]
+        positions = np.where(equal, positions, -1)
+    return positions, int(duplicated.sum())
+
+def take_column(column, positions):
+    # Values of a dimension column for each row of the fact table, missing when the row has no match.
+    # Dtypes follow a left merge: categoricals are kept, integers become float64 when there are missing rows
+    missing = positions < 0
+    safe_positions = np.where(missing, 0, positions)
+    if isinstance(column.dtype, pd.CategoricalDtype):
+        codes = column.cat.codes.to_numpy().take(safe_positions) if len(column) else np.full(len(positions), -1)
+        return pd.Categorical.from_codes(np.where(missing, -1, codes), dtype=column.dtype)
+
+    values = column.to_numpy()
+    values = values.take(safe_positions) if len(column) else np.full(len(positions), np.nan, dtype=object)
+    if missing.any():
+        if pd.api.types.is_integer_dtype(values) or pd.api.types.is_bool_dtype(values):
+            values = values.astype("float64")
+        elif not pd.api.types.is_float_dtype(values):
+            values = values.astype(object)
+        values[missing] = np.nan
+    return values
+
+def attach_columns(fact, dimension, positions, columns):
+    # Add the attributes of the dimension to the fact table in place, without copying the fact table
+    for column in columns:
+        fact[column] = take_column(dimension[column], positions)
+
+def count_orphans(fact_key, positions):
+    # Keys of the fact table (missing values excluded) without a row in the dimension table
+    return int(((positions < 0) & fact_key.notna().to_numpy()).sum())
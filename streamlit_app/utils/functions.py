@@ -1,9 +1,17 @@
 import pandas as pd
-import streamlit as st
+import numpy as np
+from pandas.api.types import union_categoricals
+import utils.global_values as global_values
 import zipfile
 import io
+import re
 
 def obtain_year_zipfile(string):
+    # Year of a yearly ZIP file from its name: a 4-digit number starting with 20 that is not part of a longer
+    # number (e.g. "Fahrgastzahlen_2022.zip"). Names without one keep the former lookup of the first "20"
+    match = re.search(r"(?<!\d)20\d{2}(?!\d)", string)
+    if match is not None:
+        return match.group(0)
     start_index = string.find("20")
     end_index = start_index + 4
     return string[start_index:end_index]
@@ -19,11 +27,94 @@ def extract_csv_files(zip_file, output_directory):
             
     return csv_files
 
-def aggregate_time_step(df, amount="5min"):
+def time_string_to_seconds(series):
+    # Parse each distinct "HH:MM:SS" value once into seconds since midnight. Hours are not bounded to 24,
+    # as the data include trips after midnight
+    codes, uniques = pd.factorize(series)
+    if (codes < 0).any():
+        raise ValueError("Missing values found in the departure times")
+    parts = pd.Series(uniques, dtype=object).str.split(":", expand=True)
+    if parts.shape[1] != 3:
+        raise ValueError("Departure times do not match the format HH:MM:SS")
+    hours, minutes, seconds = (parts[i].astype("int64").to_numpy() for i in range(3))
+    if ((hours < 0) | (minutes < 0) | (minutes > 59) | (seconds < 0) | (seconds > 59)).any():
+        raise ValueError("Departure times do not match the format HH:MM:SS")
+    return pd.Series((hours * 3600 + minutes * 60 + seconds).astype("int32")[codes], index=series.index, name=series.name)
 
-    df.index = pd.to_datetime(df.index, format="%H:%M:%S")
-    if amount != " ":
-        df = df.resample(amount).mean()
-    df.index = df.index.time
+def concat_frames(dataframes):
+    # Concatenate frames keeping their categorical columns, whose categories usually differ between years
+    # (pd.concat would turn them into object columns)
+    dataframes = [df.copy(deep=False) for df in dataframes]
+    for column in dataframes[0].columns:
+        if isinstance(dataframes[0][column].dtype, pd.CategoricalDtype):
+            categories = union_categoricals([df[column] for df in dataframes]).categories
+            for df in dataframes:
+                df[column] = df[column].cat.set_categories(categories)
+    return pd.concat(dataframes, ignore_index=True)
 
+def seconds_to_time(seconds):
+    # Seconds since midnight to datetime.time objects
+    return pd.to_datetime(np.asarray(seconds), unit="s").time
+
+def to_datetime_index(index):
+    # Departure times are stored as seconds since midnight (processed data saved before were datetime.time objects)
+    if pd.api.types.is_numeric_dtype(index):
+        return pd.to_datetime(index, unit="s")
+    return pd.to_datetime(index, format="%H:%M:%S")
+
+def to_seconds(index):
+    # Seconds since midnight of the departure times
+    if pd.api.types.is_numeric_dtype(index):
+        return np.asarray(index, dtype="int64")
+    times = to_datetime_index(index)
+    return np.asarray(times.hour * 3600 + times.minute * 60 + times.second, dtype="int64")
+
+def bucket_time_step(df, seconds):
+    # Mean of the rows of each time bucket (as resample(...).mean() does), with the buckets indexed by their start
+    # in seconds since midnight. Buckets without data between the first and last one are kept as missing rows
+    buckets = to_seconds(df.index) // seconds * seconds
+    df = df.groupby(buckets).mean()
+    if len(df):
+        df = df.reindex(np.arange(df.index.min(), df.index.max() + 1, seconds))
+    return df.rename_axis("time")
+
+def time_bucket_levels(df, levels=None):
+    # Rollups of a time series in the buckets of global_values.TIME_BUCKETS
+    levels = global_values.TIME_BUCKETS if levels is None else {level: global_values.TIME_BUCKETS[level] for level in levels}
+    return {level: bucket_time_step(df, seconds) for level, seconds in levels.items()}
+
+def seconds_index_to_time(df):
+    # Index of seconds since midnight to datetime.time objects
+    df = df.copy()
+    df.index = seconds_to_time(df.index)
     return df
+
+def downsample_min_max(df, x, y, group=None, max_points=800):
+    """
+    Rows of a long frame of time series (one per value of group) reduced to at most about max_points per series,
+    to draw them with about one point per pixel. The points of a series (in the order of x) are split into
+    max_points // 2 buckets of consecutive points, and the minimum and maximum of each bucket are kept, so that the
+    peaks and troughs of the series are drawn as in the full series. Series with max_points or fewer are kept whole.
+    """
+    df = df.sort_values(([group] if group else []) + [x], kind="stable")
+    groups = pd.factorize(df[group])[0] if group else np.zeros(len(df), dtype="int64")
+    sizes = np.bincount(groups)
+    if len(df) == 0 or sizes.max() <= max_points:
+        return df
+    # Position of each point within its series (the series are contiguous once sorted), and its bucket
+    size = sizes[groups]
+    position = np.arange(len(df)) - np.repeat(np.cumsum(sizes) - sizes, sizes)
+    n_buckets = max(max_points // 2, 1)
+    buckets = groups * n_buckets + position * n_buckets // size
+
+    # Sorted by bucket and value, the minimum of a bucket is its first point and the maximum its last one. Missing
+    # values are neither
+    values = df[y].to_numpy(dtype="float64", na_value=np.nan)
+    keep = size <= max_points
+    for fill, end in [(np.inf, "first"), (-np.inf, "last")]:
+        order = np.lexsort((np.where(np.isnan(values), fill, values), buckets))
+        sorted_buckets = buckets[order]
+        edges = np.flatnonzero(np.diff(sorted_buckets)) + 1
+        picks = np.concatenate([[0], edges]) if end == "first" else np.concatenate([edges - 1, [len(order) - 1]])
+        keep[order[picks]] = True
+    return df[keep]
@@ -32,6 +32,26 @@ MAPPING_ATTRIBUTES = {"Richtung": "direction",
                       "KAP_4m2": "passenger_capacity_4",
                       "Haltestellenlangname": "stop_current"}
 
+# Columns read from each table of the OGD data scheme (the rest of the columns are not used by the pipeline)
+TABLE_COLUMNS = {"REISENDE": ["Linien_Id", "Linienname", "Plan_Fahrt_Id", "Richtung", "Sequenz", "Haltestellen_Id",
+                             "Nach_Hst_Id", "FZ_AB", "Einsteiger", "Aussteiger", "Besetzung", "Distanz", "Tage_DTV",
+                             "Tage_DWV", "Tage_SA", "Tage_SO", "Nachtnetz", "Tage_SA_N", "Tage_SO_N"],
+                 "LINIE": ["Linien_Id", "Linienname", "VSYS", "Linienname_Fahrgastauskunft"],
+                 "HALTESTELLEN": ["Haltestellen_Id", "Haltestellenlangname"],
+                 "GEFAESSGROESSE": ["Plan_Fahrt_Id", "SITZPLAETZE", "KAP_1m2", "KAP_2m2", "KAP_3m2", "KAP_4m2"]}
+
+# Columns read as categoricals (low-cardinality labels)
+CATEGORY_COLUMNS = ["VSYS", "Linienname_Fahrgastauskunft", "Haltestellenlangname"]
+
+# Columns of the processed data used to calculate the metrics
+METRIC_COLUMNS = ["year", "departure_time", "line_name", "type_transport", "passenger_in", "passenger_amount", "distance",
+                  "factor_average", "factor_workingDays", "factor_saturday", "factor_sunday", "factor_saturday_night",
+                  "factor_sunday_night", "seat_capacity", "passenger_capacity_1", "passenger_capacity_2", "passenger_capacity_3",
+                  "passenger_capacity_4", "carbon_intensity"]
+
+# Time buckets (in seconds) of the time series rollups
+TIME_BUCKETS = {"15s": 15, "1min": 60, "5min": 300, "15min": 900, "1h": 3600}
+
 VEHICLE_CLASS = {'TR': "Trolley Bus",
                  'T': "Tram",
                  'B': "Bus Urban",
@@ -56,5 +76,8 @@ CARBON_INTENSITY_TRANSPORT_VBZ = pd.Series({
                                         "Trolley Bus": 0.097*0.5+0.047*0.5}
                                         ).to_frame().rename({0:"carbon_intensity"}, axis=1).rename({value: key for key, value in VEHICLE_CLASS.items()},axis=0)
 
-# Fleet of 35% diesel, 35% petrol, 20% electric, 10% motorbikes respectively
-CARBON_INTENSITY_VEHICLE_FLEET = 0.171*0.35 + 0.170*0.35 + 0.047*0.2 + 0.114*0.1
+# Carbon intensity of the types of vehicles of the representative fleet, and their share of it:
+# 35% diesel, 35% petrol, 20% electric, 10% motorbikes respectively
+VEHICLE_FLEET_INTENSITY = {"Diesel car": 0.171, "Petrol car": 0.170, "Electric car": 0.047, "Motorbike": 0.114}
+VEHICLE_FLEET_MIX = {"Diesel car": 0.35, "Petrol car": 0.35, "Electric car": 0.2, "Motorbike": 0.1}
+CARBON_INTENSITY_VEHICLE_FLEET = sum(VEHICLE_FLEET_INTENSITY[vehicle] * VEHICLE_FLEET_MIX[vehicle] for vehicle in VEHICLE_FLEET_MIX)
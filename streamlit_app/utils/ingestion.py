@@ -0,0 +1,97 @@
+import pandas as pd
+import io
+import multiprocessing
+import os
+import time
+import zipfile
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+import utils.data_loading as data_loading
+import utils.profiling as profiling
+
+MAX_WORKERS = os.cpu_count() or 1
+MEMORY_BUDGET_MB = 4096
+MEMORY_FACTOR = 3 # Approximate size of the merged frame in memory relative to the uncompressed CSV files
+# Workers are started fresh rather than forked: the pools are created from threads of the Streamlit server (e.g. the
+# background jobs), and a forked child could inherit a lock held by another thread (logging, imports)
+MP_CONTEXT = multiprocessing.get_context("spawn")
+
+def open_archive(archive):
+    # Archives are given either as a path to the ZIP file or as its content in bytes
+    if isinstance(archive, (bytes, bytearray)):
+        return io.BytesIO(archive)
+    return archive
+
+def estimate_memory_mb(archive):
+    # Estimation based on the uncompressed size of the CSV files, read from the central directory of the ZIP file
+    try:
+        with zipfile.ZipFile(open_archive(archive), "r") as zip_ref:
+            uncompressed_size = sum(info.file_size for info in zip_ref.infolist() if info.filename.lower().endswith(".csv"))
+    except zipfile.BadZipFile: # The error is reported by the worker loading the year
+        return 0.0
+    return uncompressed_size * MEMORY_FACTOR / 1024**2
+
+def load_year(year, archive):
+    # Work done by each worker process: load and merge the tables of a single year. The profiling records
+    # of the worker are returned to be added to those of the main process
+    start = time.perf_counter()
+    with profiling.collect() as records:
+        with profiling.stage("load and merge", year) as record:
+            data = data_loading.load_and_merge_zip(open_archive(archive), year)
+            record["rows_out"] = len(data)
+    return data, time.perf_counter() - start, records
+
+def iter_years(archives, max_workers=MAX_WORKERS, memory_budget_mb=MEMORY_BUDGET_MB):
+    """
+    Load and merge each year in its own worker process of a single pool, yielding (year, frame, report) as each
+    year completes, so that it can be used while the rest of the years are loading. The frame is None if the
+    year failed.
+
+    archives: list of (year, archive) tuples, where archive is a path to the ZIP file or its content in bytes.
+    A new year is only submitted while the estimated memory of the years in progress fits in memory_budget_mb
+    (one year is always allowed to run). A failing year is reported and does not stop the rest of the years.
+    The report has the timings, errors and referential integrity checks (orphaned and duplicated keys) of the year.
+    """
+    pending = sorted(archives, key=lambda item: item[0])
+    estimates = {year: estimate_memory_mb(archive) for year, archive in pending}
+
+    workers = max(1, min(max_workers, len(pending)))
+    with ProcessPoolExecutor(max_workers=workers, mp_context=MP_CONTEXT) as executor:
+        running = {}
+        def submit_years():
+            # Submit years while they fit in the memory budget
+            while pending:
+                year, archive = pending[0]
+                memory_in_use = sum(estimates[y] for y in running.values())
+                if running and memory_in_use + estimates[year] > memory_budget_mb:
+                    break
+                if len(running) >= workers:
+                    break
+                running[executor.submit(load_year, year, archive)] = year
+                pending.pop(0)
+
+        submit_years()
+        while running:
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                year = running.pop(future)
+                submit_years() # Before yielding, so that the next years load while the caller uses this one
+                try:
+                    data, seconds, records = future.result()
+                except Exception as e:
+                    yield year, None, {"status": "failed", "rows": 0, "seconds": None,
+                                       "estimated_memory_mb": round(estimates[year], 1), "error": str(e)}
+                    continue
+                profiling.add_records(records)
+                yield year, data, {"status": "loaded", "rows": len(data), "seconds": round(seconds, 2),
+                                   "estimated_memory_mb": round(estimates[year], 1), "error": None,
+                                   **data.attrs.get("integrity", {})}
+
+def ingest_years(archives, max_workers=MAX_WORKERS, memory_budget_mb=MEMORY_BUDGET_MB):
+    # All the years of iter_years: the list of loaded frames sorted by year and the report per year
+    results, report = {}, {}
+    for year, data, year_report in iter_years(archives, max_workers, memory_budget_mb):
+        report[year] = year_report
+        if data is not None:
+            results[year] = data
+    dataframes = [results[year] for year in sorted(results)]
+    return dataframes, dict(sorted(report.items()))
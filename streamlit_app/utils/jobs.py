@@ -0,0 +1,80 @@
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+import utils.profiling as profiling
+
+# Background jobs of the app: a pipeline run in a thread of its own, so that the page keeps responding while it
+# runs. The page only reads the progress of the job (its status, the stage of each year and the profiling records
+# of the stages completed), which the job updates as it goes. The heavy loading still runs in worker processes
+# (utils/ingestion.py), the job thread mostly waits for them
+MAX_JOBS = 2 # Jobs running at the same time, the rest wait for a free thread
+FINISHED = ["done", "failed", "cancelled"]
+
+logger = logging.getLogger(__name__)
+_executor = ThreadPoolExecutor(max_workers=MAX_JOBS, thread_name_prefix="pipeline-job")
+
+class JobCancelled(Exception):
+    pass
+
+class Job:
+    # State of a job, shared between the thread running it and the sessions showing its progress
+    def __init__(self, years):
+        self.status = "queued" # queued, running, done, failed or cancelled
+        self.years = {year: "queued" for year in sorted(years)} # Stage of each year
+        self.records = [] # Profiling records of the stages completed
+        self.partial = None # Result of the years completed so far, set by the job
+        self.result = None
+        self.error = None
+        self.started_at = self.finished_at = None
+        self._cancel = threading.Event()
+        self._future = None
+
+    @property
+    def finished(self):
+        return self.status in FINISHED
+
+    def cancel(self):
+        # The job stops at its next stage. A job still queued is not started
+        self._cancel.set()
+        if self._future is not None and self._future.cancel():
+            self.status, self.finished_at = "cancelled", time.time()
+
+    def check_cancelled(self):
+        if self._cancel.is_set():
+            raise JobCancelled()
+
+    def set_year(self, year, stage):
+        # Stages are the points where the job can be cancelled
+        self.check_cancelled()
+        self.years[year] = stage
+
+    def progress(self):
+        # Fraction of the years finished (processed or failed)
+        return sum(stage in ["done", "failed"] for stage in self.years.values()) / max(len(self.years), 1)
+
+def run_job(job, function, args):
+    job.status, job.started_at = "running", time.time()
+    try:
+        with profiling.collect() as records:
+            job.records = records
+            job.result = function(job, *args)
+        job.status = "done"
+    except JobCancelled:
+        job.status = "cancelled"
+        logger.info("job cancelled")
+    except Exception as e:
+        job.status, job.error = "failed", str(e)
+        logger.exception("job failed")
+    finally:
+        job.finished_at = time.time()
+
+def submit(function, years, *args):
+    """
+    Run function(job, *args) in a background thread and return the job. The function reports its progress with
+    job.set_year (and job.partial), which also raises JobCancelled once the job is cancelled. Its return value
+    is the result of the job.
+    """
+    job = Job(years)
+    job._future = _executor.submit(run_job, job, function, args)
+    return job
@@ -1,111 +1,415 @@
-import streamlit as st
 import pandas as pd
+import hashlib
 import io
+import logging
 import os 
 import numpy
+import threading
+from collections.abc import Mapping
+from concurrent.futures import ThreadPoolExecutor
 import utils.functions as functions
+import utils.profiling as profiling
+import utils.sketches as sketches
 import utils.global_values as global_values
 
 OUTPUT_PATH = os.path.join(os.getcwd(), "output")
+METRICS_CACHE_DIRECTORY = os.path.join(OUTPUT_PATH, "metrics_cache")
+METRICS_VERSION = "5" # Increase when the partial aggregates change, so that the cached years are computed again
 CARBON_INTENSITY_VBZ = global_values.CARBON_INTENSITY_TRANSPORT_VBZ
 CARBON_INTENSITY_VEHICLE_FLEET = global_values.CARBON_INTENSITY_VEHICLE_FLEET
 TOTAL_WORKING_DAYS_FACTOR = 251
 TOTAL_SATURDAYS_FACTOR = 52
 TOTAL_SUNDAYS_FACTOR = 62
 
-@st.cache_data
-def calculate_metrics(data):
+logger = logging.getLogger(__name__)
+_prefetcher = ThreadPoolExecutor(max_workers=1, thread_name_prefix="metrics-prefetch")
+
+CUBE_KEYS = ["year", "departure_time", "type_transport", "line_name"]
+
+MEASURE_COLUMNS = ["passenger_in", "passenger_amount", "seat_capacity", "distance", "carbon_intensity", "factor_average",
+                   "factor_workingDays", "factor_saturday", "factor_sunday", "factor_saturday_night", "factor_sunday_night"]
+
+def measure_definitions(columns, day_factor="factor_average"):
+    """
+    Measures of each row, from its columns given as float64 arrays or as DuckDB column expressions
+    (utils/query_engine.py), so that both engines share the same definitions. day_factor is the factor used to
+    extrapolate the flows, passenger-kilometres and distances to a year (factor_average: all the days).
+    """
+    measures = {}
+    measures["flow_passengers_in"] = columns["passenger_in"] * columns[day_factor]
+    measures["ocuppancy_rate_seats"] = columns["passenger_amount"] / columns["seat_capacity"]
+    measures["passenger_amount_workingDay"] = columns["passenger_amount"] * columns["factor_workingDays"] / TOTAL_WORKING_DAYS_FACTOR
+    measures["passenger_amount_nonWorkingDay"] = ((columns["passenger_amount"] * columns["factor_saturday"] / TOTAL_SATURDAYS_FACTOR) +
+                                    (columns["passenger_amount"] * columns["factor_sunday"] / TOTAL_SUNDAYS_FACTOR))
+    measures["passenger_amount_night"] = ((columns["passenger_amount"] * columns["factor_saturday_night"] / TOTAL_SATURDAYS_FACTOR) + 
+                                    (columns["passenger_amount"] * columns["factor_sunday_night"]) / TOTAL_SUNDAYS_FACTOR)
+    measures["passenger_kilometre"] = columns["passenger_amount"] * columns["distance"] * columns[day_factor]
+    measures["passenger_kilometre_co2"] = measures["passenger_kilometre"] * columns["carbon_intensity"]
+    measures["distance_travelled"] = columns["distance"] * columns[day_factor]
+    return measures
+
+def calculate_measures(data, day_factor="factor_average"):
+    # Columns may be stored with downcast dtypes, the measures are always calculated in float64
+    data = {column: data[column].to_numpy(dtype="float64", na_value=numpy.nan) for column in MEASURE_COLUMNS}
+    with numpy.errstate(divide="ignore", invalid="ignore"):
+        return measure_definitions(data, day_factor)
+
+def factorize_sorted(values):
+    # Codes and sorted uniques of a key (categoricals are decoded to their plain values). Missing values get the code -1
+    codes, uniques = pd.factorize(values)
+    uniques = pd.Index(numpy.asarray(uniques)) if isinstance(uniques.dtype, pd.CategoricalDtype) else pd.Index(uniques)
+    order = uniques.argsort()
+    rank = numpy.full(len(order) + 1, -1) # The last one is the rank of the missing values (code -1)
+    rank[order] = numpy.arange(len(order))
+    return rank[codes], uniques.take(order)
+
+def build_metric_cube(data):
+    """
+    Aggregate all the measures needed by the metrics in a single pass, at the finest grain used by them
+    (year, departure time, vehicle class and line). The keys are factorized once and combined into a single
+    group id, and every measure is summed with numpy.bincount over that id. The keys of the cube are kept as
+    categoricals with sorted categories, so that the roll-ups work on (and sort by) their integer codes.
+    The occupancy rate also keeps the count of non-missing values so that its mean can be derived from the cube.
+    """
+    group_ids = numpy.zeros(len(data), dtype="int64")
+    uniques = {}
+    for key in CUBE_KEYS:
+        codes, uniques[key] = factorize_sorted(data[key])
+        group_ids = group_ids * (len(uniques[key]) + 1) + (codes + 1)
+    group_ids, group_keys = pd.factorize(group_ids)
+    n_groups = len(group_keys)
+
+    # Decode the keys of each group from the combined id
+    cube, remainder = {}, group_keys
+    for key in reversed(CUBE_KEYS):
+        remainder, codes = numpy.divmod(remainder, len(uniques[key]) + 1)
+        cube[key] = pd.Categorical.from_codes(codes - 1, categories=uniques[key])
+    cube = pd.DataFrame({key: cube[key] for key in CUBE_KEYS})
+
+    for name, values in calculate_measures(data).items():
+        missing = numpy.isnan(values)
+        cube[name] = numpy.bincount(group_ids, weights=numpy.where(missing, 0, values), minlength=n_groups)
+        if name == "ocuppancy_rate_seats":
+            cube["ocuppancy_rate_seats_count"] = numpy.bincount(group_ids[~missing], minlength=n_groups)
+    return cube
+
+def rollup(cube, keys, measures):
+    # Sum of the measures of the cube by a subset of its keys. The groups are formed from the codes of the keys,
+    # so the labels are not hashed again. Groups with a missing key are dropped, as in groupby
+    codes = [cube[key].cat.codes.to_numpy().astype("int64") for key in keys]
+    valid = numpy.logical_and.reduce([key_codes >= 0 for key_codes in codes])
+    group_ids = numpy.zeros(valid.sum(), dtype="int64")
+    for key, key_codes in zip(keys, codes):
+        group_ids = group_ids * len(cube[key].cat.categories) + key_codes[valid]
+    group_ids, group_keys = pd.factorize(group_ids, sort=True) # Sorted by the labels, as the categories are sorted
+
+    # Index of the groups, built from the categories and codes of each key without factorizing the labels again
+    levels, level_codes, remainder = [], [], group_keys
+    for key in reversed(keys):
+        remainder, key_codes = numpy.divmod(remainder, len(cube[key].cat.categories))
+        levels.insert(0, cube[key].cat.categories)
+        level_codes.insert(0, key_codes)
+    if len(keys) > 1:
+        index = pd.MultiIndex(levels=levels, codes=level_codes, names=keys, verify_integrity=False).remove_unused_levels()
+    else:
+        index = levels[0].take(level_codes[0]).rename(keys[0])
+
+    sums = {measure: numpy.bincount(group_ids, weights=cube[measure].to_numpy()[valid], minlength=len(group_keys))
+            for measure in measures}
+    return pd.DataFrame(sums, index=index)
+
+def merge_cubes(cubes):
+    # Cube of the union of the data of several cubes (e.g. of the chunks of a year). Groups with a missing key are
+    # dropped, as the roll-ups drop them anyway
+    cube = functions.concat_frames(cubes)
+    for key in CUBE_KEYS:
+        cube[key] = cube[key].cat.set_categories(cube[key].cat.categories.sort_values())
+    merged = rollup(cube, CUBE_KEYS, [column for column in cube.columns if column not in CUBE_KEYS])
+    keys = {key: pd.Categorical.from_codes(merged.index.codes[i], categories=merged.index.levels[i])
+            for i, key in enumerate(CUBE_KEYS)}
+    return pd.DataFrame({**keys, **{column: merged[column].to_numpy() for column in merged.columns}})
+
+def calculate_partial_metrics(data):
+    with profiling.stage("build metric cube", rows_in=len(data)) as record:
+        cube = build_metric_cube(data)
+        record["rows_out"] = len(cube)
+    with profiling.stage("roll-ups", rows_in=len(cube)):
+        partials = partial_metrics_from_cube(cube)
+    with profiling.stage("crowding sketches", rows_in=len(data)) as record:
+        partials["crowding"] = sketches.build_sketches(data)
+        record["rows_out"] = len(partials["crowding"])
+    return partials
+
+def partial_metrics_from_cube(cube):
+    # Partial aggregates of a single year, rolled up from the metric cube. Every metric is keyed by year, so the
+    # partials of several years can be combined afterwards. Means are kept as sums and counts to combine them exactly
+    partials = {}
+    partials["pkm_total"] = rollup(cube, ["year"], ["passenger_kilometre"])
+
+    partials["number_passengers"] = (rollup(cube, ["year", "line_name"], ["flow_passengers_in"])
+                                         ["flow_passengers_in"]
+                                         .unstack("line_name"))
+
+    partials["occupancy_trend"] = (rollup(cube, ["departure_time", "year"],
+                                          ["passenger_amount_workingDay", "passenger_amount_nonWorkingDay","passenger_amount_night"])
+                                       .unstack("year"))
+
+    partials["passenger_day"] = (rollup(cube, ["departure_time", "year"], ["passenger_amount_night"])
+                                     ["passenger_amount_night"]
+                                     .unstack("year"))
+
+    partials["pkm_amount"] = (rollup(cube, ["departure_time", "year", "type_transport"], ["passenger_kilometre"])
+                                  ["passenger_kilometre"]
+                                  .unstack(["year", "type_transport"]))
+
+    partials["number_lines"] = (rollup(cube, ["year", "type_transport", "line_name"], [])
+                                    .groupby(level=["year", "type_transport"])
+                                    .size()
+                                    .rename("line_name"))
+
+    partials["capacity_factor"] = (rollup(cube, ["departure_time", "year", "type_transport"],
+                                          ["ocuppancy_rate_seats", "ocuppancy_rate_seats_count"])
+                                       .set_axis(["sum", "count"], axis=1))
+
+    partials["distance_travelled"] = (rollup(cube, ["year", "type_transport"], ["distance_travelled"])
+                                          ["distance_travelled"]
+                                          .unstack("type_transport"))
+
+    partials["pkm_co2_public_transport"] = (rollup(cube, ["year", "type_transport"], ["passenger_kilometre_co2"])
+                                                ["passenger_kilometre_co2"]
+                                                .unstack("type_transport"))
+    return partials
+
+def stack_pkm_amount(pkm_amount):
+    # Long format (time, vehicle class, year, pkm) of the passenger-kilometre time series
+    return pkm_amount.stack(future_stack=True).stack(future_stack=True).reset_index().rename({"level_0":"time","type_transport":"vehicle_class",
+                                                                  0:"pkm"}, axis=1)
+
+def capacity_factor_from_sums(capacity_factor_sums):
+    # Mean occupancy rate from the sums and counts indexed by (time, year, vehicle class)
+    return (capacity_factor_sums["sum"] / capacity_factor_sums["count"]).unstack(["year", "type_transport"]).sort_index(axis=0).sort_index(axis=1).fillna(0)
 
-    # Adding needed metrics
-    data["flow_passengers_in"] = data["passenger_in"] * data["factor_average"]
-    data["ocuppancy_rate_seats"] = data["passenger_amount"] / data["seat_capacity"]
-    data["passenger_amount_workingDay"] = data["passenger_amount"] * data["factor_workingDays"] / TOTAL_WORKING_DAYS_FACTOR
-    data["passenger_amount_nonWorkingDay"] = ((data["passenger_amount"] * data["factor_saturday"] / TOTAL_SATURDAYS_FACTOR) +
-                                    (data["passenger_amount"] * data["factor_sunday"] / TOTAL_SUNDAYS_FACTOR))
-    data["passenger_amount_night"] = ((data["passenger_amount"] * data["factor_saturday_night"] / TOTAL_SATURDAYS_FACTOR) + 
-                                    (data["passenger_amount"] * data["factor_sunday_night"]) / TOTAL_SUNDAYS_FACTOR)
-    data["passenger_kilometre"] = data["passenger_amount"] * data["distance"] * data["factor_average"]
-    data["passenger_kilometre_co2"] = data["passenger_kilometre"] * data["carbon_intensity"]
-    data["distance_travelled"] = data["distance"] * data["factor_average"]
+def combine_partials(partials, name, axis):
+    return pd.concat([partial[name] for partial in partials], axis=axis).sort_index(axis=0).sort_index(axis=1)
 
-    ######### PASSENGER FRAMES ########
+class LazyFrames(Mapping):
+    """
+    Frames computed on first access and kept, from functions without arguments by name. A frame is computed once,
+    also when several threads (the sessions showing it, the prefetch) ask for it at the same time. Iterates over
+    the given names only (all of them by default), the rest can still be accessed.
+    Pickled as the dictionary of all the frames, so the metrics files and caches hold plain dictionaries.
+    """
+    def __init__(self, functions, names=None):
+        self._functions = functions
+        self._names = list(functions) if names is None else names
+        self._frames = {}
+        self._locks = {name: threading.Lock() for name in functions}
 
-    # Calculation of auxiliary series
-    pkm_total = data.pivot_table(index="year", values="passenger_kilometre", aggfunc="sum")
+    def __getitem__(self, name):
+        if name not in self._frames:
+            with self._locks[name]: # KeyError for unknown names, as a dictionary
+                if name not in self._frames:
+                    self._frames[name] = self._functions[name]()
+        return self._frames[name]
 
+    def __iter__(self):
+        return iter(self._names)
+
+    def __len__(self):
+        return len(self._names)
+
+    def computed(self):
+        return [name for name in self._functions if name in self._frames]
+
+    def materialize(self):
+        # Dictionary of all the frames (and of the frames nested in them), computing the missing ones
+        return {name: materialize(frame) for name, frame in self.items()}
+
+    def __reduce__(self):
+        return (dict, (self.materialize(),))
+
+def materialize(frames):
+    return {name: materialize(frame) for name, frame in frames.items()} if isinstance(frames, Mapping) else frames
+
+def time_levels(df):
+    # Rollups of a time series in the buckets of global_values.TIME_BUCKETS, each computed when first used
+    def level(seconds):
+        return lambda: functions.bucket_time_step(df, seconds)
+    return LazyFrames({level_name: level(seconds) for level_name, seconds in global_values.TIME_BUCKETS.items()})
+
+######### PASSENGER FRAMES ########
+
+def number_passengers(partials):
     # Number of passengers (dim: line and year)
-    number_passengers = (data.pivot_table(index="year",
-                                          columns="line_name",
-                                          values="flow_passengers_in",
-                                          aggfunc="sum")
-    )
+    return combine_partials(partials, "number_passengers", axis=0)
 
+def occupancy_levels(partials):
     # Occupancy (dim: type of day, year and time instant)
-    occupancy_trend = data.pivot_table(index="departure_time",
-                                    columns="year",
-                                    values=["passenger_amount_workingDay", "passenger_amount_nonWorkingDay","passenger_amount_night"],
-                                    aggfunc="sum")
-
-    occupancy_trend = (functions.aggregate_time_step(occupancy_trend, amount="15S")
-                                .rename({"passenger_amount_nonWorkingDay": "Non-working days",
-                                        "passenger_amount_workingDay": "Working days",
-                                        "passenger_amount_night": "Non-working nights"},
-                                        axis=1))
-
-    # Number of passengers during night (dim: year, time, vehicle class) 
-    passengers_night = data.pivot_table(index="departure_time",
-                                        columns="year",
-                                        values="passenger_amount_night",
-                                        aggfunc="sum")
-    passengers_night = functions.aggregate_time_step(passengers_night, amount="15S")
-
-    # Passenger-kilometer (dim: vehicle class, year, time of day)
-    pkm_amount = data.pivot_table(index=["departure_time"],
-                                            columns=["year","type_transport"],
-                                            values="passenger_kilometre",
-                                            aggfunc="sum")
-    pkm_amount = functions.aggregate_time_step(pkm_amount, amount="15S")
-    pkm_amount = pkm_amount.stack(future_stack=True).stack(future_stack=True).reset_index().rename({"level_0":"time","type_transport":"vehicle_class",
-                                                                  0:"pkm"}, axis=1)
+    return time_levels(combine_partials(partials, "occupancy_trend", axis=1)
+                           .rename({"passenger_amount_nonWorkingDay": "Non-working days",
+                                    "passenger_amount_workingDay": "Working days",
+                                    "passenger_amount_night": "Non-working nights"},
+                                   axis=1))
+
+def passenger_day_levels(partials):
+    # Number of passengers during night (dim: year, time, vehicle class)
+    return time_levels(combine_partials(partials, "passenger_day", axis=1))
+
+def pkm_amount_series(partials):
+    # Passenger-kilometer (dim: vehicle class, year, time of day), with a column per year and vehicle class
+    return combine_partials(partials, "pkm_amount", axis=1)
+
+def pkm_amount_levels(partials, pkm_amount_seconds):
+    # Long format of each rollup, also computed when first used
+    def level(level_name):
+        return lambda: stack_pkm_amount(pkm_amount_seconds[level_name])
+    return LazyFrames({level_name: level(level_name) for level_name in pkm_amount_seconds})
+
+def pkm_tensor(partials, pkm_amount_series, pkm_total):
+    # Passenger-kilometres by year and by vehicle class and hour of departure, the input of the CO2 scenarios
+    # (utils/scenarios.py). The total of each year also counts the rows without vehicle class
+    seconds = global_values.TIME_BUCKETS["1h"]
+    hours = functions.to_seconds(pkm_amount_series.index) // seconds * seconds
+    pkm = pkm_amount_series.groupby(hours).sum().rename_axis("time").T.unstack("type_transport").fillna(0)
+    return {"pkm": pkm.reorder_levels(["type_transport", "time"], axis=1).sort_index(axis=1),
+            "pkm_total": pkm_total["passenger_kilometre"]}
 
+def number_lines(partials):
     # Number of lines (dim: year, vehicle class, line name)
-    number_lines = (data.groupby(["year", "type_transport"])[["line_name"]]
-                        .nunique()
-                        .unstack())
-    number_lines.columns = number_lines.columns.droplevel(0)
+    df = (pd.concat([partial["number_lines"] for partial in partials])
+              .to_frame()
+              .unstack())
+    df.columns = df.columns.droplevel(0)
+    return df
 
+def capacity_factor_sums(partials):
+    # Sums and counts of the occupancy rates (dim: time day, vehicle class, year)
+    sums = pd.concat([partial["capacity_factor"] for partial in partials])
+    return sums[sums["count"] > 0]
+
+def capacity_factor(partials, capacity_factor_sums):
     # Capacity factor of vehicle class (dim: time day, vehicle class, year)
-    capacity_factor = data.pivot_table(index="departure_time",
-                                        columns=["year", "type_transport"],
-                                        values="ocuppancy_rate_seats").fillna(0)
+    df = capacity_factor_from_sums(capacity_factor_sums)
+    df.index = pd.Index(functions.to_datetime_index(df.index).time, name="departure_time")
+    return df
+
+def capacity_factor_levels(partials, capacity_factor_sums):
+    # The buckets keep the mean of the occupancy rates of all the departures within them
+    def level(seconds):
+        def bucket():
+            buckets = functions.to_seconds(capacity_factor_sums.index.get_level_values("departure_time")) // seconds * seconds
+            bucket_sums = capacity_factor_sums.groupby([buckets, "year", "type_transport"], observed=True).sum()
+            return capacity_factor_from_sums(bucket_sums.rename_axis(["time", "year", "type_transport"]))
+        return bucket
+    return LazyFrames({level_name: level(seconds) for level_name, seconds in global_values.TIME_BUCKETS.items()})
 
-    ######### DISTANCE AND TIME METRICS #########
+######### DISTANCE AND TIME METRICS #########
 
+def distance_travelled(partials):
     # Distance travelled per vehicle and year
-    distance_travelled = (data.pivot_table(index="year",
-                                           columns="type_transport",
-                                           values="distance_travelled",
-                                           aggfunc="sum")
-                            .unstack()
-                            .reset_index()
-                            .rename({"type_transport":"vehicle_class",
-                                     0:"distance_travelled"}, axis=1))
+    return (combine_partials(partials, "distance_travelled", axis=0)
+                .unstack()
+                .reset_index()
+                .rename({"type_transport":"vehicle_class",
+                         0:"distance_travelled"}, axis=1))
+
+def crowding(partials):
+    # Quantile sketches of the crowding (dim: year, line, vehicle class, hour and capacity, see utils/sketches.py).
+    # Partials rolled up from a cube only (e.g. of the query engine) have none
+    crowding_sketches = [partial["crowding"] for partial in partials if "crowding" in partial]
+    return functions.concat_frames(crowding_sketches) if crowding_sketches else sketches.empty_sketch()
 
+def saved_co2(partials, pkm_total, pkm_co2_public_transport):
     # Emisssions saved by public transport fleet against representative vehicle fleet (dim: year)
-    pkm_co2_public_transport =  data.pivot_table(index="year",
-                                                columns="type_transport",
-                                                values="passenger_kilometre_co2",
-                                                aggfunc="sum")
     pkm_co2_car = pkm_total * CARBON_INTENSITY_VEHICLE_FLEET
-    saved_co2 = pkm_co2_car.sub(pkm_co2_public_transport.sum(axis=1), axis="rows") / 1000 # Translate to tons CO2-eq
-
-    all_df = {"number_passengers": number_passengers,
-              "occupancy_trend": occupancy_trend,
-              "passenger_day" : passengers_night,
-              "pkm_amount": pkm_amount,
-              "number_lines": number_lines,
-              "capacity_factor": capacity_factor,
-              "distance_travelled": distance_travelled,
-              "saved_co2": saved_co2}
-
-    return all_df
\ No newline at end of file
+    return pkm_co2_car.sub(pkm_co2_public_transport.sum(axis=1), axis="rows") / 1000 # Translate to tons CO2-eq
+
+def time_rollups(partials, *levels):
+    # Time series aggregated in buckets of 15s, 1min, 5min, 15min and 1h, indexed by the start of the bucket in seconds
+    return dict(zip(["occupancy_trend", "passenger_day", "pkm_amount", "capacity_factor"], levels))
+
+# Metric frames of the partial aggregates of the years: name -> (function, names of the frames it depends on). The
+# function gets the partials and those frames. The frames of METRIC_FRAMES are the metrics of the app, the rest are
+# the steps they share
+METRICS = {"pkm_total": (lambda partials: combine_partials(partials, "pkm_total", axis=0), []),
+           "pkm_co2_public_transport": (lambda partials: combine_partials(partials, "pkm_co2_public_transport", axis=0), []),
+           "number_passengers": (number_passengers, []),
+           "occupancy_levels": (occupancy_levels, []),
+           "occupancy_trend": (lambda partials, levels: functions.seconds_index_to_time(levels["15s"]), ["occupancy_levels"]),
+           "passenger_day_levels": (passenger_day_levels, []),
+           "passenger_day": (lambda partials, levels: functions.seconds_index_to_time(levels["15s"]), ["passenger_day_levels"]),
+           "pkm_amount_series": (pkm_amount_series, []),
+           "pkm_amount_seconds": (lambda partials, series: time_levels(series), ["pkm_amount_series"]),
+           "pkm_amount_levels": (pkm_amount_levels, ["pkm_amount_seconds"]),
+           "pkm_amount": (lambda partials, levels: stack_pkm_amount(functions.seconds_index_to_time(levels["15s"])),
+                          ["pkm_amount_seconds"]),
+           "pkm_tensor": (pkm_tensor, ["pkm_amount_series", "pkm_total"]),
+           "number_lines": (number_lines, []),
+           "capacity_factor_sums": (capacity_factor_sums, []),
+           "capacity_factor": (capacity_factor, ["capacity_factor_sums"]),
+           "capacity_factor_levels": (capacity_factor_levels, ["capacity_factor_sums"]),
+           "distance_travelled": (distance_travelled, []),
+           "crowding": (crowding, []),
+           "saved_co2": (saved_co2, ["pkm_total", "pkm_co2_public_transport"]),
+           "time_rollups": (time_rollups, ["occupancy_levels", "passenger_day_levels", "pkm_amount_levels", "capacity_factor_levels"])}
+METRIC_FRAMES = ["pkm_total", "number_passengers", "occupancy_trend", "passenger_day", "pkm_amount", "number_lines", "capacity_factor",
+                 "distance_travelled", "saved_co2", "pkm_tensor", "crowding", "time_rollups"]
+
+def lazy_metrics(partials):
+    """
+    Metric frames of the partial aggregates of each year, as a mapping that computes each frame (and the frames
+    it depends on) when first accessed, e.g. only the frames of the panels shown by the Dashboard.
+    """
+    def metric(name):
+        function, dependencies = METRICS[name]
+        def compute():
+            values = [frames[dependency] for dependency in dependencies]
+            with profiling.stage(f"metric {name}"):
+                return function(partials, *values)
+        return compute
+    frames = LazyFrames({name: metric(name) for name in METRICS}, METRIC_FRAMES)
+    return frames
+
+def prefetch_metrics(frames, done=None):
+    # Compute the frames not accessed yet in a background thread, then call done (e.g. to cache the metrics)
+    def run():
+        try:
+            materialize(frames)
+            if done is not None:
+                done()
+        except Exception:
+            logger.exception("prefetch of the metrics failed")
+    return _prefetcher.submit(run)
+
+def combine_partial_metrics(partials):
+    # Assemble the metric frames from the partial aggregates of each year
+    return lazy_metrics(partials).materialize()
+
+def calculate_metrics(data):
+    partials = [calculate_partial_metrics(year_data) for _, year_data in data.groupby("year", sort=True, observed=True)]
+    return combine_partial_metrics(partials)
+
+def fingerprint_year(year_data):
+    # Content hash of the columns used by the metrics, to detect new or changed years
+    hashes = pd.util.hash_pandas_object(year_data[global_values.METRIC_COLUMNS], index=False).values
+    return hashlib.sha256(hashes.tobytes() + METRICS_VERSION.encode()).hexdigest()
+
+def calculate_metrics_incremental(data, cache_directory=METRICS_CACHE_DIRECTORY):
+    """
+    Same metrics as calculate_metrics, but the partial aggregates of each year are persisted in cache_directory.
+    Only the years that are new or whose data changed are computed, the rest are read from the cache.
+    Returns the metric frames (see lazy_metrics, they are combined when first accessed) and the list of years
+    that were computed.
+    """
+    os.makedirs(cache_directory, exist_ok=True)
+    partials, computed_years = [], []
+    for year, year_data in data.groupby("year", sort=True, observed=True):
+        fingerprint = fingerprint_year(year_data)
+        cache_path = os.path.join(cache_directory, f"{year}.pkl")
+        cached = pd.read_pickle(cache_path) if os.path.exists(cache_path) else None
+        if cached is None or cached["fingerprint"] != fingerprint:
+            cached = {"fingerprint": fingerprint, "partials": calculate_partial_metrics(year_data)}
+            pd.to_pickle(cached, cache_path)
+            computed_years.append(year)
+        partials.append(cached["partials"])
+    return lazy_metrics(partials), computed_years
@@ -0,0 +1,208 @@
+import pandas as pd
+import numpy as np
+import os
+import utils.profiling as profiling
+import utils.storage as storage
+
+# Stop graph of a processed dataset: the stops are the nodes, indexed by position in the sorted stop ids, and every
+# pair of consecutive stops served by a trip (Haltestellen_Id -> Nach_Hst_Id) is a directed segment. The segments
+# are stored in compressed sparse row (CSR) form: the segments leaving the stop i are indptr[i]:indptr[i + 1] of
+# indices (their next stop). All the years share the graph, so the measures are arrays of segments (or stops) by
+# year, filled with numpy.bincount over the rows of each year. The measures are extrapolated to a year with
+# factor_average, as the passenger-kilometres of utils/metrics.py
+NETWORK_FILE = "network.npz"
+NETWORK_VERSION = "1" # Increase when the arrays change, so that the stored networks are built again
+NETWORK_COLUMNS = ["year", "Haltestellen_Id", "Nach_Hst_Id", "stop_current", "stop_next", "passenger_in", "passenger_out",
+                   "passenger_amount", "distance", "factor_average"]
+SEGMENT_MEASURES = ["segment_load", "segment_pkm", "segment_trips", "segment_distance"]
+STOP_MEASURES = ["boardings", "alightings"]
+
+def weighted(values, factor):
+    # Yearly values of each row, missing values count as 0 (as in the metric cube)
+    return np.nan_to_num(values.to_numpy(dtype="float64", na_value=np.nan) * factor, nan=0.0)
+
+def year_segments(data):
+    """
+    Sums of a year by stop and by segment: (node ids, node names, stop ids, stop sums) and (source ids, target
+    ids, segment sums), sorted by their ids. The nodes include the next stops, as stops only reached as a next
+    stop (e.g. terminals) are nodes of the network as well.
+    """
+    stops = data["Haltestellen_Id"].to_numpy(dtype="int64")
+    targets = data["Nach_Hst_Id"].to_numpy(dtype="float64", na_value=np.nan)
+    factor = data["factor_average"].to_numpy(dtype="float64", na_value=np.nan)
+    stop_ids, first_rows, stop_codes = np.unique(stops, return_index=True, return_inverse=True)
+    names = np.asarray(data["stop_current"].astype(object).to_numpy()[first_rows], dtype=str)
+    stop_sums = {"boardings": np.bincount(stop_codes, weighted(data["passenger_in"], factor), len(stop_ids)),
+                 "alightings": np.bincount(stop_codes, weighted(data["passenger_out"], factor), len(stop_ids))}
+
+    # Segments: rows with a next stop (the last stop of a trip has none)
+    valid = ~np.isnan(targets)
+    load = weighted(data["passenger_amount"], factor)[valid]
+    distance = data["distance"].to_numpy(dtype="float64", na_value=np.nan)[valid]
+    trips = np.nan_to_num(factor[valid], nan=0.0)
+    next_ids = targets[valid].astype("int64")
+    segment_keys, segment_codes = np.unique(stops[valid] << 32 | next_ids, return_inverse=True)
+    n_segments = len(segment_keys)
+    segment_sums = {"segment_load": np.bincount(segment_codes, load, n_segments),
+                    "segment_pkm": np.bincount(segment_codes, load * np.nan_to_num(distance, nan=0.0), n_segments),
+                    "segment_trips": np.bincount(segment_codes, trips, n_segments),
+                    # Weighted by the trips, to derive the mean length of the segment
+                    "segment_distance": np.bincount(segment_codes, trips * np.nan_to_num(distance, nan=0.0), n_segments)}
+    next_stop_ids, first_rows = np.unique(next_ids, return_index=True)
+    next_names = np.asarray(data["stop_next"].astype(object).to_numpy()[valid][first_rows], dtype=str)
+    nodes = (np.concatenate([stop_ids, next_stop_ids]), np.concatenate([names, next_names]), stop_ids, stop_sums)
+    return nodes, (segment_keys >> 32, segment_keys & 0xFFFFFFFF, segment_sums)
+
+def build_network(years_data):
+    """
+    Network of the data of several years, given as (year, data) tuples with the NETWORK_COLUMNS. Only the sums of
+    one year are held at a time besides the data being read.
+
+    Returns a dictionary of arrays: the years, the stop ids and names, the CSR arrays (indptr, indices) and the
+    measures of the segments (segments x years, sorted by source and target) and of the stops (stops x years).
+    """
+    years, stop_parts, segment_parts = [], [], []
+    for year, data in years_data:
+        with profiling.stage("network year", year, rows_in=len(data)):
+            stop_part, segment_part = year_segments(data)
+        years.append(str(year))
+        stop_parts.append(stop_part)
+        segment_parts.append(segment_part)
+
+    # Nodes of all the years, named after their first appearance
+    all_ids = np.concatenate([part[0] for part in stop_parts] + [np.zeros(0, dtype="int64")])
+    all_names = np.concatenate([part[1] for part in stop_parts] + [np.zeros(0, dtype=str)])
+    stop_ids, first = np.unique(all_ids, return_index=True)
+    n_stops, n_years = len(stop_ids), len(years)
+
+    # Segments of all the years, as keys source * n_stops + target (sorted keys are sorted by source, then target)
+    year_codes = np.concatenate([np.full(len(part[0]), position) for position, part in enumerate(segment_parts)] + [np.zeros(0, dtype="int64")])
+    keys = np.concatenate([np.searchsorted(stop_ids, part[0]) * n_stops + np.searchsorted(stop_ids, part[1])
+                           for part in segment_parts] + [np.zeros(0, dtype="int64")])
+    segment_keys, segment_codes = np.unique(keys, return_inverse=True)
+    cells = segment_codes * n_years + year_codes
+    network = {"version": np.array(NETWORK_VERSION), "years": np.array(years, dtype=str),
+               "stop_ids": stop_ids, "stop_names": all_names[first],
+               "indptr": np.concatenate([[0], np.cumsum(np.bincount(segment_keys // n_stops, minlength=n_stops))]),
+               "indices": (segment_keys % n_stops).astype("int32")}
+    for measure in SEGMENT_MEASURES:
+        values = np.concatenate([part[2][measure] for part in segment_parts] + [np.zeros(0)])
+        network[measure] = np.bincount(cells, values, len(segment_keys) * n_years).reshape(-1, n_years)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        network["segment_distance"] = np.where(network["segment_trips"] > 0,
+                                               network["segment_distance"] / network["segment_trips"], np.nan)
+
+    stop_cells = np.concatenate([np.searchsorted(stop_ids, part[2]) * n_years + position
+                                 for position, part in enumerate(stop_parts)] + [np.zeros(0, dtype="int64")])
+    for measure in STOP_MEASURES:
+        values = np.concatenate([part[3][measure] for part in stop_parts] + [np.zeros(0)])
+        network[measure] = np.bincount(stop_cells, values, n_stops * n_years).reshape(-1, n_years)
+    return network
+
+def build_network_from_dataset(path):
+    # Network of a stored dataset, read one year at a time with only the columns it needs
+    years = storage.dataset_years(path)
+    return build_network((year, storage.read_dataset(path, columns=NETWORK_COLUMNS, years=[year])) for year in years)
+
+def write_network(network, path):
+    np.savez(os.path.join(path, NETWORK_FILE), **network)
+
+def read_network(path):
+    # Network stored next to a dataset, None if missing or written by another version
+    network_path = os.path.join(path, NETWORK_FILE)
+    if not os.path.exists(network_path):
+        return None
+    with np.load(network_path) as arrays:
+        network = {name: arrays[name] for name in arrays.files}
+    return network if str(network["version"]) == NETWORK_VERSION else None
+
+def load_network(path):
+    # Stored network of the dataset, built and stored if missing (e.g. datasets written before the networks)
+    network = read_network(path)
+    if network is None:
+        with profiling.stage("build network"):
+            network = build_network_from_dataset(path)
+        write_network(network, path)
+    return network
+
+def segment_sources(network):
+    # Source stop of each segment, expanded from indptr
+    return np.repeat(np.arange(len(network["stop_ids"])), np.diff(network["indptr"]))
+
+def next_stops(network, stop_id):
+    # Stops reached from a stop, with the load of each segment by year
+    node = np.searchsorted(network["stop_ids"], stop_id)
+    if node == len(network["stop_ids"]) or network["stop_ids"][node] != stop_id:
+        raise KeyError(f"Unknown stop: {stop_id}")
+    start, end = network["indptr"][node], network["indptr"][node + 1]
+    return pd.DataFrame(network["segment_load"][start:end], columns=network["years"],
+                        index=pd.Index(network["stop_names"][network["indices"][start:end]], name="stop_next"))
+
+def year_position(network, year):
+    positions = np.flatnonzero(network["years"] == str(year))
+    if not len(positions):
+        raise KeyError(f"Year not in the network: {year}")
+    return positions[0]
+
+def top_positions(values, top):
+    # Positions of the largest values, in decreasing order
+    top = min(top, len(values))
+    positions = np.argpartition(-values, top - 1)[:top] if top else np.zeros(0, dtype="int64")
+    return positions[np.argsort(-values[positions], kind="stable")]
+
+def busiest_segments(network, year, top=20):
+    column = year_position(network, year)
+    positions = top_positions(network["segment_load"][:, column], top)
+    return pd.DataFrame({"stop_current": network["stop_names"][segment_sources(network)[positions]],
+                         "stop_next": network["stop_names"][network["indices"][positions]],
+                         "passengers": network["segment_load"][positions, column],
+                         "passenger_kilometre": network["segment_pkm"][positions, column],
+                         "trips": network["segment_trips"][positions, column],
+                         "distance": network["segment_distance"][positions, column]})
+
+def corridor_loads(network):
+    """
+    Segments of both directions between two stops added together. Returns the stops of each corridor (first
+    stop < second stop, as node positions) and its measures by year.
+    """
+    n_stops = len(network["stop_ids"])
+    sources, targets = segment_sources(network), network["indices"].astype("int64")
+    keys = np.minimum(sources, targets) * n_stops + np.maximum(sources, targets)
+    corridor_keys, codes = np.unique(keys, return_inverse=True)
+    n_years = len(network["years"])
+    cells = (codes[:, None] * n_years + np.arange(n_years)).reshape(-1)
+    measures = {measure: np.bincount(cells, network[measure].reshape(-1), len(corridor_keys) * n_years).reshape(-1, n_years)
+                for measure in ["segment_load", "segment_pkm", "segment_trips"]}
+    return corridor_keys // n_stops, corridor_keys % n_stops, measures
+
+def busiest_corridors(network, year, top=20):
+    column = year_position(network, year)
+    first, second, measures = corridor_loads(network)
+    positions = top_positions(measures["segment_load"][:, column], top)
+    return pd.DataFrame({"stop_a": network["stop_names"][first[positions]],
+                         "stop_b": network["stop_names"][second[positions]],
+                         "passengers": measures["segment_load"][positions, column],
+                         "passenger_kilometre": measures["segment_pkm"][positions, column],
+                         "trips": measures["segment_trips"][positions, column]})
+
+def busiest_stops(network, top=20):
+    # Boardings and alightings of the busiest stops over all the years, as frames of stops by year
+    activity = network["boardings"] + network["alightings"]
+    positions = top_positions(activity.sum(axis=1), top)
+    index = pd.Index(network["stop_names"][positions], name="stop")
+    return {measure: pd.DataFrame(network[measure][positions], index=index, columns=network["years"])
+            for measure in STOP_MEASURES}
+
+def segment_matrix(network, year, top=25):
+    # Load of the segments between the busiest stops of a year, as a frame of stops by next stops
+    column = year_position(network, year)
+    activity = network["boardings"][:, column] + network["alightings"][:, column]
+    positions = np.sort(top_positions(activity, top))
+    rank = np.full(len(network["stop_ids"]), -1)
+    rank[positions] = np.arange(len(positions))
+    sources, targets = rank[segment_sources(network)], rank[network["indices"]]
+    inside = (sources >= 0) & (targets >= 0)
+    matrix = np.zeros((len(positions), len(positions)))
+    matrix[sources[inside], targets[inside]] = network["segment_load"][inside, column]
+    names = network["stop_names"][positions]
+    return pd.DataFrame(matrix, index=pd.Index(names, name="stop_current"), columns=pd.Index(names, name="stop_next"))
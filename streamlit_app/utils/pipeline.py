@@ -0,0 +1,262 @@
+import pandas as pd
+import json
+import logging
+import os
+import utils.functions as functions
+import utils.data_loading as data_loading
+import utils.data_cleaning as data_cleaning
+import utils.metrics as metrics
+import utils.network as network
+import utils.ingestion as ingestion
+import utils.storage as storage
+import utils.streaming as streaming
+import utils.pipeline_cache as pipeline_cache
+import utils.profiling as profiling
+import utils.global_values as global_values
+
+EXTRACT_OUTPUT_DIRECTORY = "./data/"
+# "zip": read the tables from the ZIP files in memory, "disk": extract the CSV files to EXTRACT_OUTPUT_DIRECTORY first,
+# "stream": read REISENDE in chunks and fold them into the metrics, with bounded memory (batch pipeline only)
+LOADING_MODES = ["zip", "disk", "stream"]
+METRICS_FILE = "metrics.pkl"
+MANIFEST_FILE = "manifest.json"
+PROFILE_FILE = "profile.json"
+
+logger = logging.getLogger(__name__)
+
+def find_archives(directory, years=None):
+    # Yearly ZIP files of a directory as (year, path), optionally restricted to the given years
+    archives = []
+    for name in sorted(os.listdir(directory)):
+        if name.lower().endswith(".zip"):
+            year = functions.obtain_year_zipfile(name)
+            if years is None or year in years:
+                archives.append((year, os.path.join(directory, name)))
+    return archives
+
+def ingest_archives(archives, loading_mode="zip", max_workers=ingestion.MAX_WORKERS, memory_budget_mb=ingestion.MEMORY_BUDGET_MB):
+    """
+    Load and merge the raw tables of the archives, a list of (year, archive) tuples where archive is a path to
+    the ZIP file or its content in bytes. Returns the frames per year and a report per year.
+    """
+    if loading_mode == "zip":
+        dataframes, report = ingestion.ingest_years(archives, max_workers=max_workers, memory_budget_mb=memory_budget_mb)
+        years = [year for year, info in report.items() if info["status"] == "loaded"]
+        return dict(zip(years, dataframes)), report
+
+    dataframes, report = {}, {}
+    for year, archive in archives:
+        extraction_directory = os.path.join(EXTRACT_OUTPUT_DIRECTORY, str(year))
+        os.makedirs(extraction_directory, exist_ok=True)
+        with profiling.stage("extract CSV files", year):
+            csv_files = functions.extract_csv_files(ingestion.open_archive(archive), extraction_directory)
+        if not csv_files:
+            report[year] = {"status": "failed", "rows": 0, "error": "No CSV files found in the ZIP file"}
+            continue
+        logger.info("Extracted %d CSV files to %s", len(csv_files), extraction_directory)
+        dataframes[year] = data_loading.load_and_merge_data(year)
+        report[year] = {"status": "loaded", "rows": len(dataframes[year]), "error": None,
+                        **dataframes[year].attrs.get("integrity", {})}
+    return dataframes, report
+
+def iter_archives(archives, loading_mode="zip", max_workers=ingestion.MAX_WORKERS, memory_budget_mb=ingestion.MEMORY_BUDGET_MB):
+    # (year, raw frame or None if failed, report) of each archive as soon as it is loaded: the ZIP files in the
+    # worker processes of a single pool, the extracted CSV files one after the other
+    if loading_mode == "zip":
+        yield from ingestion.iter_years(archives, max_workers, memory_budget_mb)
+        return
+    for year, archive in archives:
+        dataframes, report = ingest_archives([(year, archive)], loading_mode)
+        yield year, dataframes.get(year), report[year]
+
+def clean_data(raw_data, dedup_workers=None):
+    raw_data = raw_data.rename(global_values.MAPPING_ATTRIBUTES, axis=1)
+    return data_cleaning.clean_data(raw_data, dedup_workers)
+
+def clean_year(raw_data, year, archive_key, year_report, dedup_workers=None):
+    # Cleaned data of a year, stored in the pipeline cache. The duplicated rows dropped are added to its report
+    with profiling.stage("clean", year, rows_in=len(raw_data)) as record:
+        cleaned = clean_data(raw_data, dedup_workers)
+        record["rows_out"] = len(cleaned)
+    year_report["duplicated_rows"] = cleaned.attrs.get("duplicated_rows")
+    pipeline_cache.save_frame(pipeline_cache.entry_key("cleaned", archive_key), cleaned)
+    return cleaned
+
+def process_archives(archives, loading_mode="zip", max_workers=ingestion.MAX_WORKERS, memory_budget_mb=ingestion.MEMORY_BUDGET_MB):
+    """
+    Cleaned data of the archives, a list of (year, archive) tuples. The cleaned data of each archive is read from
+    the pipeline cache, only the archives missing from it are loaded and cleaned.
+
+    Returns the cleaned data of all the years, the years loaded, a report per year and the archive key of each year.
+    """
+    archive_keys = {year: pipeline_cache.archive_key(archive) for year, archive in archives}
+    cleaned, report = {}, {}
+    for year, key in archive_keys.items():
+        data = pipeline_cache.load_frame(pipeline_cache.entry_key("cleaned", key))
+        if data is not None:
+            cleaned[year] = data
+            report[year] = {"status": "cached", "rows": len(data)}
+
+    missing = [(year, archive) for year, archive in archives if year not in cleaned]
+    if missing:
+        raw_frames, missing_report = ingest_archives(missing, loading_mode, max_workers, memory_budget_mb)
+        report.update(missing_report)
+        # The years are cleaned one after the other: the threads of the deduplication are those of a year cleaned alone
+        for year, raw_data in raw_frames.items():
+            cleaned[year] = clean_year(raw_data, year, archive_keys[year], report[year])
+
+    if not cleaned:
+        errors = "; ".join(f"{year}: {info['error']}" for year, info in report.items())
+        raise ValueError(f"None of the archives could be loaded ({errors})")
+    years = sorted(cleaned)
+    data = functions.concat_frames([cleaned[year] for year in years])
+    return data, years, dict(sorted(report.items())), {year: archive_keys[year] for year in years}
+
+def compute_metrics(cleaned_data, archive_keys=None):
+    # The metric frames are combined from the partial aggregates of the years when first accessed (e.g. by the
+    # panels of the Dashboard), and the rest of them in the background
+    if archive_keys is None:
+        # Processed data without archives: only the new or changed years are computed, based on their content
+        all_df, _ = metrics.calculate_metrics_incremental(cleaned_data)
+        metrics.prefetch_metrics(all_df)
+        return all_df
+
+    # Metrics of the whole selection and partial aggregates of each year are read from the pipeline cache
+    metrics_key = pipeline_cache.entry_key("metrics", *[archive_keys[year] for year in sorted(archive_keys)])
+    all_df = pipeline_cache.load_object(metrics_key)
+    if all_df is None:
+        partials = [year_partial_metrics(year_data, year, archive_keys[year])
+                    for year, year_data in cleaned_data.groupby("year", sort=True, observed=True)]
+        all_df = metrics.lazy_metrics(partials)
+        # Cached once all the frames are computed
+        metrics.prefetch_metrics(all_df, lambda: pipeline_cache.save_object(metrics_key, all_df))
+    return all_df
+
+def year_partial_metrics(year_data, year, archive_key):
+    # Partial aggregates of a year, read from the pipeline cache if computed before
+    partials_key = pipeline_cache.entry_key("partials", archive_key)
+    year_partials = pipeline_cache.load_object(partials_key)
+    if year_partials is None:
+        with profiling.stage("metric partials", year, rows_in=len(year_data)):
+            year_partials = metrics.calculate_partial_metrics(year_data)
+        pipeline_cache.save_object(partials_key, year_partials)
+    return year_partials
+
+def process_archives_job(job, archives, loading_mode="zip", max_workers=ingestion.MAX_WORKERS,
+                         memory_budget_mb=ingestion.MEMORY_BUDGET_MB):
+    """
+    process_archives and compute_metrics as a background job (utils/jobs.py), writing the artifacts to
+    storage.dataset_path. The years missing from the pipeline cache are loaded by a single pool of worker
+    processes, as many at a time as fit in memory_budget_mb, and each year is cleaned as soon as it is loaded, so
+    that the metrics of the years completed so far are published as job.partial ({"years", "metrics", "key"})
+    while the rest of the years are loading.
+
+    Returns the cleaned data, the years loaded, a report per year, the archive key of each year and the metrics.
+    """
+    archive_keys = {year: pipeline_cache.archive_key(archive) for year, archive in archives}
+    cleaned, report, partials = {}, {}, {}
+
+    def publish(year):
+        job.set_year(year, "metrics")
+        partials[year] = year_partial_metrics(cleaned[year], year, archive_keys[year])
+        completed = sorted(partials)
+        job.partial = {"years": completed, "metrics": metrics.lazy_metrics([partials[y] for y in completed]),
+                       "key": pipeline_cache.entry_key("metrics", *[archive_keys[y] for y in completed])}
+        job.set_year(year, "done")
+
+    missing = []
+    for year, archive in sorted(archives, key=lambda item: item[0]):
+        data = pipeline_cache.load_frame(pipeline_cache.entry_key("cleaned", archive_keys[year]))
+        if data is None:
+            missing.append((year, archive))
+            continue
+        cleaned[year] = data
+        report[year] = {"status": "cached", "rows": len(data)}
+        publish(year)
+
+    for year, _ in missing:
+        job.set_year(year, "loading")
+    # Each year is cleaned while the next ones are loading: the CPUs are shared with the worker processes
+    dedup_workers = data_cleaning.dedup_workers(min(max_workers, len(missing)))
+    with profiling.stage("ingest and clean"):
+        for year, raw_data, year_report in iter_archives(missing, loading_mode, max_workers, memory_budget_mb):
+            report[year] = year_report
+            if raw_data is None: # A failing year does not stop the rest of the years
+                job.set_year(year, "failed")
+                continue
+            job.set_year(year, "cleaning")
+            cleaned[year] = clean_year(raw_data, year, archive_keys[year], year_report, dedup_workers)
+            publish(year)
+
+    if not cleaned:
+        raise ValueError("None of the archives could be loaded")
+    job.check_cancelled()
+    years = sorted(cleaned)
+    archive_keys = {year: archive_keys[year] for year in years}
+    data = functions.concat_frames([cleaned.pop(year) for year in years])
+    # Metrics of all the years, shared with the Dashboard showing them: the frames it computed already are kept
+    all_df = job.partial["metrics"]
+    with profiling.stage("metrics"):
+        metrics.materialize(all_df)
+    pipeline_cache.save_object(job.partial["key"], all_df)
+    job.check_cancelled()
+    with profiling.stage("write artifacts"):
+        write_artifacts(data, all_df, storage.dataset_path(years),
+                        manifest={"archive_keys": archive_keys, "report": dict(sorted(report.items()))})
+    return data, years, dict(sorted(report.items())), archive_keys, all_df
+
+def write_artifacts(data, all_df, path, manifest=None):
+    # Processed dataset partitioned by year, with the metric frames, the stop network and a manifest next to it.
+    # The dataset is not written if data is None (already written in parts by the streaming mode)
+    if data is not None:
+        storage.write_dataset(data, path)
+    pd.to_pickle(all_df, os.path.join(path, METRICS_FILE))
+    with profiling.stage("network"):
+        network.write_network(network.build_network_from_dataset(path), path)
+    manifest = {"pipeline_version": pipeline_cache.PIPELINE_VERSION, "metrics_version": metrics.METRICS_VERSION,
+                "years": [str(year) for year in storage.dataset_years(path)], **(manifest or {})}
+    with open(os.path.join(path, MANIFEST_FILE), "w") as f:
+        json.dump(manifest, f, indent=2, default=str)
+    return path
+
+def read_artifact_metrics(path):
+    # Precomputed metrics of a processed dataset, None if missing or written by another version of the pipeline
+    manifest_path, metrics_path = os.path.join(path, MANIFEST_FILE), os.path.join(path, METRICS_FILE)
+    if not (os.path.exists(manifest_path) and os.path.exists(metrics_path)):
+        return None
+    with open(manifest_path) as f:
+        manifest = json.load(f)
+    if manifest.get("pipeline_version") != pipeline_cache.PIPELINE_VERSION or manifest.get("metrics_version") != metrics.METRICS_VERSION:
+        return None
+    return pd.read_pickle(metrics_path)
+
+def run(archives, output_directory=storage.OUTPUT_DIRECTORY, loading_mode="zip",
+        max_workers=ingestion.MAX_WORKERS, memory_budget_mb=ingestion.MEMORY_BUDGET_MB, chunk_size=streaming.CHUNK_SIZE):
+    """
+    Whole pipeline (ingest, clean, metrics) on a list of (year, archive) tuples. The processed dataset and the
+    metrics are written to output_directory/processed_data_<first year>-<last year>, with the profile of the run.
+
+    Returns the path of the artifacts, the report per year and the profiling records of the stages.
+    """
+    with profiling.collect() as records:
+        if loading_mode == "stream":
+            path = storage.dataset_path(sorted(year for year, _ in archives), output_directory)
+            with profiling.stage("stream"):
+                partials, report, archive_keys = streaming.stream_archives(archives, path, chunk_size)
+            if not partials:
+                raise ValueError("None of the archives could be loaded")
+            with profiling.stage("metrics"):
+                all_df = metrics.combine_partial_metrics(partials)
+            data = None
+        else:
+            with profiling.stage("ingest and clean"):
+                data, years, report, archive_keys = process_archives(archives, loading_mode, max_workers, memory_budget_mb)
+            path = storage.dataset_path(years, output_directory)
+            with profiling.stage("metrics"):
+                all_df = metrics.materialize(compute_metrics(data, archive_keys))
+        with profiling.stage("write artifacts"):
+            write_artifacts(data, all_df, path, manifest={"archive_keys": archive_keys, "report": report})
+
+    with open(os.path.join(path, PROFILE_FILE), "w") as f:
+        f.write(profiling.to_json(records))
+    return path, report, records
@@ -0,0 +1,117 @@
+import pandas as pd
+import hashlib
+import logging
+import os
+import pickle
+import threading
+import utils.storage as storage
+
+PIPELINE_VERSION = "5" # Increase when the output of the pipeline changes, so that the cached entries are not used anymore
+CACHE_DIRECTORY = os.path.join(storage.OUTPUT_DIRECTORY, "pipeline_cache")
+MAX_CACHE_BYTES = 20 * 1024**3
+
+logger = logging.getLogger(__name__)
+STATS = {"hits": 0, "misses": 0, "writes": 0, "evictions": 0}
+_lock = threading.Lock()
+
+def archive_key(archive):
+    # SHA-256 of the content of a ZIP file (bytes or path)
+    digest = hashlib.sha256()
+    if isinstance(archive, (bytes, bytearray)):
+        digest.update(archive)
+    else:
+        with open(archive, "rb") as f:
+            for block in iter(lambda: f.read(1024**2), b""):
+                digest.update(block)
+    return digest.hexdigest()
+
+def entry_key(kind, *keys):
+    # Key of a cache entry: kind of entry ("cleaned", "partials", "metrics"), the archive keys and the pipeline version
+    return hashlib.sha256(":".join([PIPELINE_VERSION, kind, *keys]).encode()).hexdigest()
+
+def entry_path(key, extension, directory=None):
+    # The defaults are read when called, so that CACHE_DIRECTORY and MAX_CACHE_BYTES can be changed after import (e.g. by a benchmark)
+    return os.path.join(directory or CACHE_DIRECTORY, f"{key}.{extension}")
+
+def count(stat, key):
+    with _lock:
+        STATS[stat] += 1
+    logger.info("pipeline cache %s: %s", stat, key[:12])
+
+def read_entry(path, reader):
+    if not os.path.exists(path):
+        count("misses", os.path.basename(path))
+        return None
+    try:
+        value = reader(path)
+    except Exception: # Incomplete or corrupted entry, computed again
+        logger.warning("pipeline cache entry %s could not be read", os.path.basename(path))
+        count("misses", os.path.basename(path))
+        return None
+    os.utime(path) # Mark as recently used
+    count("hits", os.path.basename(path))
+    return value
+
+def write_entry(path, writer, directory=None, max_bytes=None):
+    # Write to a temporary file first, so that readers never see incomplete entries
+    os.makedirs(directory or CACHE_DIRECTORY, exist_ok=True)
+    temporary_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    writer(temporary_path)
+    os.replace(temporary_path, path)
+    count("writes", os.path.basename(path))
+    evict(directory, max_bytes)
+
+def load_frame(key, directory=None):
+    return read_entry(entry_path(key, "parquet", directory), pd.read_parquet)
+
+def save_frame(key, data, directory=None, max_bytes=None):
+    write_entry(entry_path(key, "parquet", directory),
+                lambda path: data.to_parquet(path, index=False, compression=storage.COMPRESSION),
+                directory, max_bytes)
+
+def load_object(key, directory=None):
+    def reader(path):
+        with open(path, "rb") as f:
+            return pickle.load(f)
+    return read_entry(entry_path(key, "pkl", directory), reader)
+
+def save_object(key, value, directory=None, max_bytes=None):
+    def writer(path):
+        with open(path, "wb") as f:
+            pickle.dump(value, f, protocol=pickle.HIGHEST_PROTOCOL)
+    write_entry(entry_path(key, "pkl", directory), writer, directory, max_bytes)
+
+def cache_entries(directory=None):
+    # Entries of the cache as (last use, size, path), least recently used first
+    directory = directory or CACHE_DIRECTORY
+    if not os.path.isdir(directory):
+        return []
+    entries = []
+    for name in os.listdir(directory):
+        path = os.path.join(directory, name)
+        if name.endswith((".parquet", ".pkl")):
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError: # Evicted by another session in the meantime
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+    return sorted(entries)
+
+def evict(directory=None, max_bytes=None):
+    # Remove the least recently used entries until the cache fits in max_bytes
+    max_bytes = MAX_CACHE_BYTES if max_bytes is None else max_bytes
+    entries = cache_entries(directory)
+    total_bytes = sum(size for _, size, _ in entries)
+    for _, size, path in entries:
+        if total_bytes <= max_bytes:
+            break
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        total_bytes -= size
+        count("evictions", os.path.basename(path))
+
+def cache_summary(directory=None):
+    entries = cache_entries(directory)
+    return {**STATS, "entries": len(entries), "size_mb": round(sum(size for _, size, _ in entries) / 1024**2, 1)}
@@ -0,0 +1,236 @@
+import pandas as pd
+import functools
+import io
+import logging
+import os
+import re
+import zipfile
+import utils.data_loading as data_loading
+import utils.functions as functions
+import utils.ingestion as ingestion
+import utils.streaming as streaming
+import utils.global_values as global_values
+
+# Pre-scan of the yearly ZIP files before loading them: only the central directory of each ZIP file and the first
+# SAMPLE_BYTES of each table are read. The tables and columns are checked against the data scheme (TABLE_COLUMNS,
+# MAPPING_ATTRIBUTES and the tables documented in documentation/metadata.xlsx), the sample is read and merged as
+# the pipeline does, and the rows and memory of each year are extrapolated from it. The plan of the loading is
+# made from these estimates: the years left out, the years loaded at the same time and the years to stream
+METADATA_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "documentation", "metadata.xlsx")
+SAMPLE_BYTES = 1024**2 # Bytes read from the start of each table
+PEAK_FACTOR = 6 # Peak memory of loading and cleaning a year relative to the size of its merged frame
+HASH_BYTES = 16 # Bytes kept per row of the year by the streaming mode, to drop the duplicated rows across chunks
+MIN_CHUNK_SIZE = 100_000
+YEAR_PATTERN = re.compile(r"(?<!\d)20\d{2}(?!\d)")
+
+logger = logging.getLogger(__name__)
+
+@functools.lru_cache(maxsize=1)
+def read_metadata(path=METADATA_FILE):
+    """
+    Columns of each table documented in the "Tables" sheet of metadata.xlsx, by table name: each table is a title
+    row "<TABLE> (<description>)" followed by a header row "Attributes" and a row per column. Empty if the file
+    cannot be read (e.g. openpyxl is not installed), the columns are then only checked against TABLE_COLUMNS.
+    """
+    try:
+        sheet = pd.read_excel(path, sheet_name="Tables", header=None)
+    except Exception as e:
+        logger.warning("metadata of the tables not read from %s: %s", path, e)
+        return {}
+    documented, table = {}, None
+    for value in sheet.dropna(how="all", axis=1).iloc[:, 0]:
+        title = re.match(r"^([A-Z]+) \(", str(value))
+        if pd.isna(value):
+            table = None
+        elif title:
+            table = title.group(1)
+            documented[table] = []
+        elif table is not None and value != "Attributes":
+            documented[table].append(str(value).strip())
+    return documented
+
+def read_sample(zip_ref, info):
+    # Complete lines of the first SAMPLE_BYTES of a member, and whether they are the whole member
+    with zip_ref.open(info) as f:
+        sample = f.read(SAMPLE_BYTES)
+    if len(sample) >= info.file_size:
+        return sample, True
+    return sample[:sample.rfind(b"\n") + 1], False
+
+def column_issues(table, columns, errors, warnings):
+    # Columns read by the pipeline missing from the header (e.g. renamed in a new release of the data), and
+    # columns neither read by it nor documented in metadata.xlsx
+    lowercase = {column.lower(): column for column in columns}
+    for column in global_values.TABLE_COLUMNS[table]:
+        if column not in columns:
+            found = f", {lowercase[column.lower()]} found" if column.lower() in lowercase else ""
+            used_as = f" (used as {global_values.MAPPING_ATTRIBUTES[column]})" if column in global_values.MAPPING_ATTRIBUTES else ""
+            errors.append(f"{table}: column {column}{used_as} missing{found}")
+    documented = read_metadata().get(table)
+    if documented:
+        documented = {column.lower() for column in documented}
+        unknown = [column for column in columns if column.lower() not in documented and column not in global_values.TABLE_COLUMNS[table]]
+        if unknown:
+            warnings.append(f"{table}: columns not documented in metadata.xlsx: {', '.join(unknown)}")
+
+def scan_table(zip_ref, info, table, errors, warnings):
+    # Sample of a table read as the pipeline reads it, and its estimated number of rows. None if it cannot be read
+    sample, whole = read_sample(zip_ref, info)
+    try:
+        columns = pd.read_csv(io.BytesIO(sample), sep=";", nrows=0).columns
+    except (pd.errors.EmptyDataError, pd.errors.ParserError, UnicodeDecodeError) as e:
+        errors.append(f"{table}: header could not be read ({e})")
+        return None, None
+    issues = len(errors)
+    column_issues(table, list(columns), errors, warnings)
+    if len(errors) > issues:
+        return None, None
+    try:
+        frame = data_loading.read_table(io.BytesIO(sample), global_values.TABLE_COLUMNS[table])
+    except Exception as e:
+        errors.append(f"{table}: first rows could not be read ({e})")
+        return None, None
+    # Rows extrapolated from the bytes taken by the rows of the sample
+    header_bytes = sample.find(b"\n") + 1
+    if whole or len(frame) == 0:
+        return frame, len(frame)
+    return frame, round(len(frame) * (info.file_size - header_bytes) / (len(sample) - header_bytes))
+
+def frame_memory(frame):
+    # Bytes per row of a frame and bytes of its categories, taken once whatever the number of rows
+    per_row, fixed = 0.0, 0
+    for column in frame.columns:
+        if isinstance(frame[column].dtype, pd.CategoricalDtype):
+            per_row += frame[column].cat.codes.dtype.itemsize
+            fixed += int(frame[column].cat.categories.memory_usage(deep=True))
+        elif len(frame):
+            per_row += frame[column].memory_usage(deep=True, index=False) / len(frame)
+    return per_row, fixed
+
+def scan_archive(name, archive):
+    """
+    Pre-scan of a yearly ZIP file: its year (from the file name), the errors that would make the loading of the
+    year fail, warnings, the estimated rows of REISENDE and the estimated memory of the merged frame of the year
+    (with its dimension tables). bytes_per_row is the memory of a row of the merged frame.
+    """
+    year = functions.obtain_year_zipfile(os.path.basename(name))
+    scan = {"file": os.path.basename(name), "year": year, "errors": [], "warnings": [], "rows": None,
+            "memory_mb": None, "bytes_per_row": None, "dimension_memory_mb": None, "compressed_mb": None}
+    errors, warnings = scan["errors"], scan["warnings"]
+    if not YEAR_PATTERN.fullmatch(year):
+        errors.append("no year found in the file name")
+    elif len(set(YEAR_PATTERN.findall(scan["file"]))) > 1:
+        warnings.append(f"several years in the file name, {year} used")
+
+    try:
+        with zipfile.ZipFile(ingestion.open_archive(archive), "r") as zip_ref:
+            infos = [info for info in zip_ref.infolist() if info.filename.lower().endswith(".csv")]
+            scan["compressed_mb"] = round(sum(info.compress_size for info in infos) / 1024**2, 1)
+            member_years = {match for info in infos for match in YEAR_PATTERN.findall(info.filename)}
+            if YEAR_PATTERN.fullmatch(year) and member_years - {year}:
+                warnings.append(f"the files of the archive refer to {', '.join(sorted(member_years))}, {year} used")
+            members = {os.path.splitext(os.path.basename(info.filename))[0].upper(): info for info in infos}
+            documented = read_metadata()
+            unknown = [table for table in members if table not in global_values.TABLE_COLUMNS and documented and table not in documented]
+            if unknown:
+                warnings.append(f"tables not documented in metadata.xlsx: {', '.join(unknown)}")
+            frames, rows = {}, {}
+            for table in global_values.TABLE_COLUMNS:
+                if table not in members:
+                    errors.append(f"{table}.csv not found in the ZIP file")
+                    continue
+                frames[table], rows[table] = scan_table(zip_ref, members[table], table, errors, warnings)
+    except zipfile.BadZipFile:
+        errors.append("not a valid ZIP file")
+        return scan
+
+    if "REISENDE" in rows:
+        scan["rows"] = rows["REISENDE"]
+    if any(frame is None for frame in frames.values()) or len(frames) < len(global_values.TABLE_COLUMNS):
+        return scan
+    if rows["REISENDE"] == 0:
+        errors.append("REISENDE.csv has no rows")
+        return scan
+    # Memory of a merged row, from the merge of the samples. The integer attributes of the dimensions are counted
+    # as float64, as they are once any row of REISENDE misses its dimension row, which the sample cannot tell
+    dimension_bytes = 0
+    for table in frames:
+        if table != "REISENDE":
+            per_row, fixed = frame_memory(frames[table])
+            dimension_bytes += per_row * rows[table] + fixed
+    merged = data_loading.merge_tables({table: frame.copy() if table == "REISENDE" else
+                                        frame.astype({column: "float64" for column in frame.columns if pd.api.types.is_integer_dtype(frame[column])})
+                                        for table, frame in frames.items()}, year)
+    per_row, fixed = frame_memory(merged)
+    scan["bytes_per_row"] = round(per_row, 1)
+    scan["dimension_memory_mb"] = round(dimension_bytes / 1024**2, 1)
+    scan["memory_mb"] = round((per_row * rows["REISENDE"] + fixed + dimension_bytes) / 1024**2, 1)
+    return scan
+
+def scan_archives(archives):
+    # Pre-scan of a list of (name, archive) tuples, where archive is a path to the ZIP file or its content in bytes
+    scans, files = [], {}
+    for name, archive in archives:
+        scan = scan_archive(name, archive)
+        if scan["year"] in files:
+            scan["errors"].append(f"year {scan['year']} also in {files[scan['year']]}")
+        elif not scan["errors"]:
+            files[scan["year"]] = scan["file"]
+        scans.append(scan)
+    return scans
+
+def stream_chunk_size(scan, memory_budget_mb, chunk_size):
+    # Largest chunk of REISENDE whose loading fits in the memory budget, with the dimension tables and the hashes
+    # of the rows of the year kept in memory, between MIN_CHUNK_SIZE and chunk_size
+    available = memory_budget_mb * 1024**2 - scan["dimension_memory_mb"] * 1024**2 - scan["rows"] * HASH_BYTES
+    rows = int(available / (scan["bytes_per_row"] * PEAK_FACTOR)) // 10_000 * 10_000
+    return max(MIN_CHUNK_SIZE, min(chunk_size, rows))
+
+def plan_ingestion(scans, memory_budget_mb=ingestion.MEMORY_BUDGET_MB, max_workers=ingestion.MAX_WORKERS,
+                   chunk_size=streaming.CHUNK_SIZE):
+    """
+    Plan of the loading of the scanned archives. Each file gets a loading mode: "skipped" if it has errors,
+    "stream" if the estimated peak memory of the year (PEAK_FACTOR times its merged frame) does not fit in
+    memory_budget_mb, with the chunk size of REISENDE fitting it, "zip" otherwise. The workers are the years
+    loaded in memory at the same time whose peaks fit in the budget together.
+
+    Returns {"files": [scan with its plan, in the order of the scans], "loading_mode", "workers", "chunk_size",
+    "memory_budget_mb"}, the loading mode being "stream" if any year needs it. The files are a list, as several
+    uploads may have the same name.
+    """
+    files = []
+    for scan in scans:
+        plan = {**scan, "peak_memory_mb": None, "loading": "zip", "chunk_size": None}
+        if scan["errors"]:
+            plan["loading"] = "skipped"
+        elif scan["memory_mb"] is not None:
+            plan["peak_memory_mb"] = round(scan["memory_mb"] * PEAK_FACTOR, 1)
+            if plan["peak_memory_mb"] > memory_budget_mb:
+                plan["loading"], plan["chunk_size"] = "stream", stream_chunk_size(scan, memory_budget_mb, chunk_size)
+                if plan["chunk_size"] == MIN_CHUNK_SIZE:
+                    plan["warnings"] = scan["warnings"] + [f"may exceed the memory budget even in chunks of {MIN_CHUNK_SIZE} rows"]
+        files.append(plan)
+
+    # Years loaded at the same time: as many of the largest ones as fit in the budget together
+    peaks = sorted((plan["peak_memory_mb"] or 0 for plan in files if plan["loading"] == "zip"), reverse=True)
+    workers = 1
+    while workers < min(max_workers, len(peaks)) and sum(peaks[:workers + 1]) <= memory_budget_mb:
+        workers += 1
+    streamed = [plan["chunk_size"] for plan in files if plan["loading"] == "stream"]
+    return {"files": files, "loading_mode": "stream" if streamed else "zip", "workers": workers,
+            "chunk_size": min(streamed) if streamed else chunk_size, "memory_budget_mb": memory_budget_mb}
+
+def planned_archives(plan, archives, loadings=("zip", "stream")):
+    # (year, archive) tuples of the (name, archive) tuples, in the order they were scanned, whose loading mode in
+    # the plan is one of loadings (by default all but the skipped ones)
+    return [(info["year"], archive) for (_, archive), info in zip(archives, plan["files"]) if info["loading"] in loadings]
+
+def plan_summary(plan):
+    # One row per file, for display
+    columns = ["year", "loading", "rows", "memory_mb", "peak_memory_mb", "chunk_size", "compressed_mb", "errors", "warnings"]
+    summary = pd.DataFrame(plan["files"]).reindex(columns=["file"] + columns).set_index("file")
+    for column in ["errors", "warnings"]:
+        summary[column] = summary[column].map("; ".join)
+    for column in ["rows", "chunk_size"]:
+        summary[column] = summary[column].astype("Int64")
+    return summary
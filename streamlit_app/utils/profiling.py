@@ -0,0 +1,183 @@
+import cProfile
+import collections
+import io
+import json
+import logging
+import os
+import pstats
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+try:
+    import resource
+except ImportError: # Not available on Windows, peak memory is not reported there
+    resource = None
+
+MAX_RECORDS = 2000 # Records kept in memory, the oldest ones are dropped first
+PROFILE_TOP_FUNCTIONS = 30 # Functions listed in the cProfile report of a stage in detailed mode
+DETAILED = os.environ.get("PIPELINE_PROFILE") == "detailed" # Detailed mode: the outermost stages are also run under cProfile
+PAYLOADS = False # Size of the JSON of the Dashboard figures, which serializes them once more (also measured in detailed mode)
+SAMPLE_SECONDS = 0.02 # Interval at which the resident memory is sampled while stages are open
+
+logger = logging.getLogger(__name__)
+RECORDS = collections.deque(maxlen=MAX_RECORDS)
+_lock = threading.Lock()
+_local = threading.local() # Stages in progress and record collectors of the current thread
+# Stages open in any thread of the process, whose peak memory is raised by the sampler thread
+_open_stages = {}
+_sampler_condition = threading.Condition()
+_sampler_pid = None
+
+def set_detailed(enabled):
+    global DETAILED
+    DETAILED = enabled
+
+def set_payloads(enabled):
+    global PAYLOADS
+    PAYLOADS = enabled
+
+def read_rss_mb():
+    # Current resident memory of the process, None where /proc is not available
+    try:
+        with open("/proc/self/statm") as f:
+            return round(int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 1024**2, 1)
+    except (OSError, ValueError):
+        return None
+
+def read_peak_rss_mb():
+    # Peak resident memory of the process since the last reset. On Linux it is read from VmHWM, which
+    # reset_peak_rss sets back to the current memory; elsewhere it is the peak of the whole process
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return round(int(line.split()[1]) / 1024, 1)
+    except OSError:
+        pass
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return round(peak / 1024**2 if sys.platform == "darwin" else peak / 1024, 1) # Bytes on macOS, KB elsewhere
+
+def reset_peak_rss():
+    # Resets the peak of the whole process: only for single-threaded measurements (e.g. benchmark_prescan.py), the
+    # stages sample the memory instead
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+    except OSError: # Not Linux: the peak of the whole process is reported
+        pass
+
+def profile_report(profiler):
+    output = io.StringIO()
+    pstats.Stats(profiler, stream=output).sort_stats("cumulative").print_stats(PROFILE_TOP_FUNCTIONS)
+    return output.getvalue()
+
+def sample_rss():
+    # Raise the peak memory of the open stages to the current resident memory
+    rss = read_rss_mb()
+    if rss is None:
+        return
+    with _sampler_condition:
+        for record in _open_stages.values():
+            record["peak_rss_mb"] = max(record["peak_rss_mb"] or 0, rss)
+
+def run_sampler():
+    while True:
+        with _sampler_condition:
+            while not _open_stages:
+                _sampler_condition.wait()
+        sample_rss()
+        time.sleep(SAMPLE_SECONDS)
+
+def open_stage(record):
+    # The sampler thread is started with the first stage of the process (worker processes start without it)
+    global _sampler_pid
+    with _sampler_condition:
+        if _sampler_pid != os.getpid():
+            _sampler_pid = os.getpid()
+            threading.Thread(target=run_sampler, name="rss-sampler", daemon=True).start()
+        _open_stages[id(record)] = record
+        _sampler_condition.notify()
+
+def close_stage(record):
+    with _sampler_condition:
+        _open_stages.pop(id(record), None)
+
+def thread_state(name):
+    if getattr(_local, "pid", None) != os.getpid(): # Forked worker processes start with empty stages and collectors
+        _local.__dict__.clear()
+        _local.pid = os.getpid()
+    if not hasattr(_local, name):
+        setattr(_local, name, [])
+    return getattr(_local, name)
+
+@contextmanager
+def stage(name, year=None, rows_in=None):
+    """
+    Record the wall time, CPU time and peak resident memory of a stage of the pipeline, for a year if given
+    (by default the year of the stage it is nested in).
+    The record is yielded so that the caller can set the rows produced (record["rows_out"]). Stages can be nested,
+    the peak memory of a stage includes that of the stages inside it. It is the highest resident memory of the
+    process sampled every SAMPLE_SECONDS while the stage is open, so it also includes whatever other threads
+    allocate meanwhile, and may miss peaks shorter than the interval. Without /proc (not Linux) it is the peak of
+    the whole process. In detailed mode, the outermost stage of each thread is also profiled with cProfile.
+    """
+    stack = thread_state("stack")
+    if year is None and stack:
+        year = stack[-1]["year"]
+    record = {"stage": name, "year": None if year is None else str(year), "rows_in": rows_in, "rows_out": None,
+              "wall_seconds": None, "cpu_seconds": None, "peak_rss_mb": None, "process": os.getpid(),
+              "started_at": time.time()}
+    profiler = cProfile.Profile() if DETAILED and not stack else None
+    stack.append(record)
+    open_stage(record)
+    sample_rss()
+    wall_start, cpu_start = time.perf_counter(), time.process_time()
+    if profiler is not None:
+        try:
+            profiler.enable()
+        except ValueError: # Another profiler is already active in this thread
+            profiler = None
+    try:
+        yield record
+    finally:
+        if profiler is not None:
+            profiler.disable()
+            record["profile"] = profile_report(profiler)
+        record["wall_seconds"] = round(time.perf_counter() - wall_start, 4)
+        record["cpu_seconds"] = round(time.process_time() - cpu_start, 4)
+        sample_rss()
+        close_stage(record)
+        if read_rss_mb() is None:
+            record["peak_rss_mb"] = read_peak_rss_mb()
+        stack.pop()
+        add_records([record])
+        logger.info("%s%s: %.2f s wall, %.2f s CPU, peak memory %s MB", name, "" if year is None else f" ({year})",
+                    record["wall_seconds"], record["cpu_seconds"], record["peak_rss_mb"])
+
+def add_records(new_records):
+    # Also used to gather the records of the worker processes in the main process
+    with _lock:
+        RECORDS.extend(new_records)
+    for records in thread_state("collectors"):
+        records.extend(new_records)
+
+@contextmanager
+def collect():
+    # List of the records added in the current thread within the block, including those of worker processes
+    records = []
+    thread_state("collectors").append(records)
+    try:
+        yield records
+    finally:
+        thread_state("collectors").pop() # Blocks are nested, the last collector is this one
+
+def clear():
+    with _lock:
+        RECORDS.clear()
+
+def to_json(records=None):
+    return json.dumps(list(RECORDS) if records is None else records, indent=2, default=str)
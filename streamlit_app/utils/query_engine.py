@@ -0,0 +1,134 @@
+import pandas as pd
+import numpy as np
+import threading
+import utils.metrics as metrics
+import utils.profiling as profiling
+import utils.storage as storage
+
+try:
+    import duckdb
+except ImportError: # Optional: without DuckDB the queries run on pandas, reading only the needed columns and years
+    duckdb = None
+
+# Aggregations of the measures of utils/metrics.py over slices of a stored dataset (Parquet files partitioned by
+# year), run by DuckDB on the files themselves: the filters are pushed down to the scan and only the aggregated
+# rows are returned to Python. The pandas engine runs the same queries on the dataset read into memory, and is the
+# reference to verify the results of DuckDB (see benchmarks/benchmark_query_engine.py).
+ENGINES = ["duckdb", "pandas"]
+FILTER_COLUMNS = ["line_name", "type_transport", "stop_current", "direction"]
+KEY_COLUMNS = ["year", "departure_time", "type_transport", "line_name", "stop_current", "direction"]
+DAY_FACTORS = {"All days": "factor_average",
+               "Working days": "factor_workingDays",
+               "Saturdays": "factor_saturday",
+               "Sundays": "factor_sunday",
+               "Saturday nights": "factor_saturday_night",
+               "Sunday nights": "factor_sunday_night"}
+OCCUPANCY_COUNT = "ocuppancy_rate_seats_count" # Non-missing occupancy rates, to derive their mean from the sum
+
+_lock = threading.Lock()
+_local = threading.local()
+_database = None
+
+def default_engine():
+    return "duckdb" if duckdb is not None else "pandas"
+
+def connection():
+    # Cursor of the in-memory database for the current thread (Streamlit runs each session in a thread of its own).
+    # Cursors share the database, and so the metadata of the Parquet files already read
+    global _database
+    with _lock:
+        if _database is None:
+            _database = duckdb.connect()
+    if getattr(_local, "database", None) is not _database:
+        _local.database, _local.cursor = _database, _database.cursor()
+    return _local.cursor
+
+def dataset_files(path, years=None):
+    # Files of the selected year partitions: the years are pruned before anything is read
+    years = storage.dataset_years(path) if years is None else [str(year) for year in years]
+    return [file for year in years for file in storage.partition_files(path, year)]
+
+def check_query(keys, filters, day_factor):
+    # Column names are part of the query text, so only known columns are accepted (values are always parameters)
+    unknown = ([key for key in keys if key not in KEY_COLUMNS] + [column for column in filters if column not in FILTER_COLUMNS]
+               + ([day_factor] if day_factor not in DAY_FACTORS.values() else []))
+    if unknown:
+        raise ValueError(f"Unknown columns in the query: {unknown}")
+
+def aggregate(path, keys, measures, filters=None, years=None, day_factor="factor_average", bucket_seconds=None, engine=None,
+              dropna=True):
+    """
+    Sums of the measures (names of metrics.measure_definitions, or OCCUPANCY_COUNT) by the keys, for the rows of the
+    selected years whose filter columns take one of the given values, e.g. {"line_name": ["31"], "direction": [1]}.
+    Departure times are grouped in buckets of bucket_seconds if given. Rows with a missing key are dropped, as
+    in groupby, unless dropna is False (their groups are then sorted last). Returns a frame with the keys and
+    measures as columns, sorted by the keys.
+    """
+    filters = {column: list(values) for column, values in (filters or {}).items() if values is not None and len(values)}
+    check_query(keys, filters, day_factor)
+    engine = engine or default_engine()
+    with profiling.stage(f"query ({engine})") as record:
+        if engine == "duckdb":
+            result = aggregate_duckdb(dataset_files(path, years), keys, measures, filters, day_factor, bucket_seconds, dropna)
+        else:
+            result = aggregate_pandas(path, years, keys, measures, filters, day_factor, bucket_seconds, dropna)
+        record["rows_out"] = len(result)
+    return result
+
+def aggregate_duckdb(files, keys, measures, filters, day_factor, bucket_seconds, dropna):
+    columns = {column: duckdb.ColumnExpression(column).cast(duckdb.sqltype("DOUBLE")) for column in metrics.MEASURE_COLUMNS}
+    definitions = metrics.measure_definitions(columns, day_factor)
+    # NaN (e.g. 0 / 0) is missing as in the cube of the pandas engine: it is neither added nor counted
+    values = {measure: f"nullif({definition}, 'NaN'::DOUBLE)" for measure, definition in definitions.items()}
+    aggregates = [f"coalesce(sum({values[measure]}), 0) AS {measure}" if measure != OCCUPANCY_COUNT
+                  else f"count({values['ocuppancy_rate_seats']}) AS {measure}" for measure in measures]
+    key_expressions = [f"departure_time // {int(bucket_seconds)} * {int(bucket_seconds)} AS departure_time"
+                       if key == "departure_time" and bucket_seconds else key for key in keys]
+    conditions = [f"{key} IS NOT NULL" for key in keys if dropna] + [f"list_contains(?, {column})" for column in filters]
+    query = (f"SELECT {', '.join(key_expressions + aggregates)} "
+             f"FROM read_parquet(?, hive_partitioning = false) "
+             + (f"WHERE {' AND '.join(conditions)} " if conditions else "")
+             + (f"GROUP BY ALL ORDER BY {', '.join(f'{i + 1} NULLS LAST' for i in range(len(keys)))}" if keys else ""))
+    if not files:
+        return pd.DataFrame(columns=keys + measures)
+    return connection().execute(query, [files] + list(filters.values())).df()
+
+def aggregate_pandas(path, years, keys, measures, filters, day_factor, bucket_seconds, dropna):
+    data = storage.read_dataset(path, columns=list(dict.fromkeys(keys + list(filters) + metrics.MEASURE_COLUMNS)), years=years)
+    mask = np.logical_and.reduce([data[key].notna().to_numpy() for key in keys if dropna] +
+                                 [data[column].isin(values).to_numpy() for column, values in filters.items()] +
+                                 [np.ones(len(data), dtype=bool)])
+    data = data[mask]
+    values = metrics.calculate_measures(data, day_factor)
+    columns = {key: np.asarray(data[key]) for key in keys}
+    if bucket_seconds and "departure_time" in columns:
+        columns["departure_time"] = columns["departure_time"] // int(bucket_seconds) * int(bucket_seconds)
+    for measure in measures:
+        columns[measure] = (~np.isnan(values["ocuppancy_rate_seats"]) if measure == OCCUPANCY_COUNT
+                            else np.nan_to_num(values[measure], nan=0.0, posinf=np.inf, neginf=-np.inf))
+    frame = pd.DataFrame(columns)
+    if not keys:
+        return frame[measures].sum().to_frame().T
+    return frame.groupby(keys, sort=True, dropna=dropna).sum().reset_index()
+
+def distinct_values(path, column, engine=None):
+    # Values of a filter column in the dataset, for the filter widgets
+    check_query([], {column: []}, "factor_average")
+    if (engine or default_engine()) == "duckdb":
+        query = f"SELECT DISTINCT {column} FROM read_parquet(?, hive_partitioning = false) WHERE {column} IS NOT NULL ORDER BY 1"
+        return connection().execute(query, [dataset_files(path)]).df()[column].tolist()
+    return sorted(storage.read_dataset(path, columns=[column])[column].dropna().unique().tolist())
+
+def calculate_metrics(path, filters=None, years=None, day_factor="factor_average", engine=None):
+    """
+    Metric frames of metrics.calculate_metrics for a slice of the stored dataset. The engine aggregates the metric
+    cube of the slice, and the frames are rolled up from it as in the in-memory pipeline. As in its cube, the rows
+    without vehicle class or line are kept (e.g. in the totals of each year).
+    """
+    measures = list(metrics.measure_definitions(dict.fromkeys(metrics.MEASURE_COLUMNS, np.zeros(0)), day_factor)) + [OCCUPANCY_COUNT]
+    cube = aggregate(path, metrics.CUBE_KEYS, measures, filters, years, day_factor, engine=engine, dropna=False)
+    if cube.empty:
+        raise ValueError("No rows match the filters")
+    for key in metrics.CUBE_KEYS:
+        cube[key] = pd.Categorical(cube[key], categories=np.sort(cube[key].dropna().unique()))
+    return metrics.combine_partial_metrics([metrics.partial_metrics_from_cube(cube)])
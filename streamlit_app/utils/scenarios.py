@@ -0,0 +1,63 @@
+import numpy as np
+import pandas as pd
+import utils.global_values as global_values
+
+# CO2 scenarios: emissions avoided by public transport against a representative fleet of private vehicles, as
+# saved_co2 of utils/metrics.py but with the carbon intensities as inputs. The passenger-kilometres are kept as a
+# tensor of years x vehicle classes x hours of departure (the pkm_tensor metric), so a scenario is a vector of
+# intensities of the vehicle classes and a fleet mix, and many scenarios are evaluated with a single matrix
+# product. Intensities are in kg CO2-eq per passenger-kilometre, the avoided emissions in t CO2-eq
+FLEET_TYPES = list(global_values.VEHICLE_FLEET_MIX)
+FLEET_INTENSITY = np.array([global_values.VEHICLE_FLEET_INTENSITY[vehicle] for vehicle in FLEET_TYPES])
+FLEET_MIX = np.array([global_values.VEHICLE_FLEET_MIX[vehicle] for vehicle in FLEET_TYPES])
+
+def tensor_arrays(pkm_tensor):
+    """
+    Arrays of the pkm_tensor metric: the years, the vehicle classes, the hours (start in seconds), the
+    passenger-kilometres (years x vehicle classes x hours) and the total of each year.
+    """
+    pkm = pkm_tensor["pkm"]
+    classes = pkm.columns.get_level_values("type_transport").unique()
+    hours = np.sort(pkm.columns.get_level_values("time").unique())
+    pkm = pkm.reindex(columns=pd.MultiIndex.from_product([classes, hours]), fill_value=0)
+    return {"years": pkm.index.to_numpy(), "vehicle_classes": classes.to_numpy(), "hours": hours,
+            "pkm": pkm.to_numpy(dtype="float64").reshape(len(pkm), len(classes), len(hours)),
+            "pkm_total": pkm_tensor["pkm_total"].reindex(pkm.index).to_numpy(dtype="float64")}
+
+def baseline_intensities(vehicle_classes):
+    # Intensities of global_values for the vehicle classes. Classes without one count as 0, as in saved_co2
+    intensities = global_values.CARBON_INTENSITY_TRANSPORT_VBZ["carbon_intensity"]
+    return intensities.reindex(vehicle_classes).fillna(0).to_numpy(dtype="float64")
+
+def fleet_intensity(fleet_mix, intensities=FLEET_INTENSITY):
+    # Intensity of each fleet mix (scenarios x FLEET_TYPES), the shares are normalized to add up to 1
+    fleet_mix = np.atleast_2d(np.asarray(fleet_mix, dtype="float64"))
+    return (fleet_mix / fleet_mix.sum(axis=1, keepdims=True)) @ intensities
+
+def avoided_emissions(arrays, intensities, fleet_mix):
+    """
+    Emissions avoided in each year by each scenario, as scenarios x years. intensities are the intensities of the
+    vehicle classes of arrays (scenarios x vehicle classes) and fleet_mix the shares of FLEET_TYPES (scenarios x
+    fleet types), either of them can be a single vector shared by all the scenarios.
+    """
+    intensities = np.atleast_2d(np.asarray(intensities, dtype="float64"))
+    car = fleet_intensity(fleet_mix)
+    car, intensities = np.broadcast_arrays(car[:, None], intensities)
+    # Weights of (total pkm, pkm of each vehicle class) by scenario, and those pkm by year
+    weights = np.column_stack([car[:, 0], -intensities])
+    pkm = np.column_stack([arrays["pkm_total"], arrays["pkm"].sum(axis=2)])
+    return weights @ pkm.T / 1000
+
+def avoided_emissions_by_hour(arrays, intensities, fleet_mix):
+    # As avoided_emissions by hour of departure (scenarios x years x hours), of the pkm with a vehicle class only
+    intensities = np.atleast_2d(np.asarray(intensities, dtype="float64"))
+    weights = fleet_intensity(fleet_mix)[:, None] - intensities
+    return np.einsum("sc,ych->syh", weights, arrays["pkm"]) / 1000
+
+def fleet_mix_sweep(fleet_mix, fleet_type, shares):
+    # Fleet mixes with the given shares of a type of vehicle, the rest keeping their shares relative to each other
+    fleet_mix = np.asarray(fleet_mix, dtype="float64") / np.sum(fleet_mix)
+    position = FLEET_TYPES.index(fleet_type)
+    others = np.delete(fleet_mix, position)
+    others = others / others.sum() if others.sum() > 0 else np.full(len(others), 1 / len(others))
+    return np.insert(np.outer(1 - np.asarray(shares, dtype="float64"), others), position, shares, axis=1)
@@ -0,0 +1,122 @@
+import numpy as np
+import pandas as pd
+import utils.functions as functions
+import utils.global_values as global_values
+
+# Quantile sketches of the crowding of the vehicles (passengers on board over a capacity), in the style of
+# DDSketch: the values are counted in logarithmic bins, the bin i holding the values in (GAMMA^(i-1), GAMMA^i].
+# A sketch is a frame of the keys, the capacity, the bin and the weight of the rows in the bin, built per year, line,
+# vehicle class and hour of departure when the metrics are computed. Sketches are merged exactly by adding the
+# weights of their bins, so any combination of years, lines, vehicle classes and hours is read at query time.
+#
+# Error bound: a quantile read from a sketch is within RELATIVE_ACCURACY of the exact one, |estimate - x| <=
+# RELATIVE_ACCURACY * x, where x is the exact (weighted) quantile: the smallest value whose cumulated weight reaches
+# q times the total weight. Values below MIN_VALUE are read as 0. The rows are weighted by factor_average (days of
+# the year), as the yearly metrics, so the quantiles are those of the departures of a whole year
+RELATIVE_ACCURACY = 0.02
+GAMMA = (1 + RELATIVE_ACCURACY) / (1 - RELATIVE_ACCURACY)
+MIN_VALUE = 1e-3 # Smaller values (e.g. empty vehicles) are counted in ZERO_BIN
+ZERO_BIN = np.iinfo("int16").min
+BUCKET_SECONDS = global_values.TIME_BUCKETS["1h"]
+SKETCH_KEYS = ["year", "line_name", "type_transport", "time"]
+CAPACITY_COLUMNS = {"seat_capacity": "Seats",
+                    "passenger_capacity_1": "Seats + 1 standing/m²",
+                    "passenger_capacity_2": "Seats + 2 standing/m²",
+                    "passenger_capacity_3": "Seats + 3 standing/m²",
+                    "passenger_capacity_4": "Seats + 4 standing/m²"}
+SKETCH_COLUMNS = SKETCH_KEYS + ["capacity", "bin", "weight"]
+
+def bin_index(values):
+    # Bin of each value, ZERO_BIN for the values below MIN_VALUE
+    bins = np.full(len(values), ZERO_BIN, dtype="int16")
+    counted = values >= MIN_VALUE
+    bins[counted] = np.ceil(np.log(values[counted]) / np.log(GAMMA))
+    return bins
+
+def bin_value(bins):
+    # Value read from each bin: the one within RELATIVE_ACCURACY of all the values of the bin
+    bins = np.asarray(bins, dtype="float64")
+    return np.where(bins == ZERO_BIN, 0.0, 2 * GAMMA ** bins / (GAMMA + 1))
+
+def empty_sketch():
+    return pd.DataFrame({column: pd.Series(dtype="int16" if column == "bin" else "float64" if column == "weight" else "category")
+                         for column in SKETCH_COLUMNS})
+
+def build_sketches(data):
+    """
+    Sketches of the crowding of the rows of data against each capacity of CAPACITY_COLUMNS found in data, by the
+    SKETCH_KEYS (the departure time in buckets of BUCKET_SECONDS). Rows with a missing key, a missing or infinite
+    crowding (e.g. no capacity) or no weight are left out.
+    """
+    capacities = [column for column in CAPACITY_COLUMNS if column in data]
+    keys = {key: data[key] for key in SKETCH_KEYS[:-1]}
+    keys["time"] = data["departure_time"] // BUCKET_SECONDS * BUCKET_SECONDS
+    # Keys factorized once and combined into a group id (-1 if a key is missing)
+    group_ids, uniques = np.zeros(len(data), dtype="int64"), {}
+    for key, values in keys.items():
+        codes, uniques[key] = pd.factorize(values, sort=True)
+        group_ids = np.where((group_ids < 0) | (codes < 0), -1, group_ids * len(uniques[key]) + codes)
+    group_codes = np.full(len(data), -1)
+    group_codes[group_ids >= 0], groups = pd.factorize(group_ids[group_ids >= 0], sort=True)
+    amount = data["passenger_amount"].to_numpy(dtype="float64", na_value=np.nan)
+    weight = data["factor_average"].to_numpy(dtype="float64", na_value=np.nan)
+
+    parts = [(np.zeros(0, dtype="int64"),) * 3 + (np.zeros(0),)]
+    for position, column in enumerate(capacities):
+        with np.errstate(divide="ignore", invalid="ignore"):
+            crowding = amount / data[column].to_numpy(dtype="float64", na_value=np.nan)
+        valid = (group_codes >= 0) & np.isfinite(crowding) & (weight > 0)
+        bins = bin_index(crowding[valid]).astype("int64")
+        # Weight of each group and bin, summed with bincount over the bins found (a few hundred at most, as the
+        # crowding spans a few orders of magnitude). The slot 0 of each group is ZERO_BIN
+        counted = bins != ZERO_BIN
+        low, high = (bins[counted].min(), bins[counted].max()) if counted.any() else (0, -1)
+        n_slots = high - low + 2
+        slots = np.where(counted, bins - low + 1, 0)
+        sums = np.bincount(group_codes[valid] * n_slots + slots, weights=weight[valid], minlength=len(groups) * n_slots)
+        cells = np.flatnonzero(sums)
+        cell_groups, cell_slots = np.divmod(cells, n_slots)
+        parts.append((cell_groups, np.full(len(cells), position), np.where(cell_slots == 0, ZERO_BIN, cell_slots - 1 + low), sums[cells]))
+    cell_groups, capacity_codes, bins, sums = [np.concatenate(arrays) for arrays in zip(*parts)]
+    order = np.lexsort((bins, capacity_codes, cell_groups))
+
+    # Decode the keys of each group from its id
+    sketch, remainder = {}, groups[cell_groups[order]]
+    for key in reversed(SKETCH_KEYS):
+        remainder, codes = np.divmod(remainder, len(uniques[key]))
+        sketch[key] = uniques[key].take(codes)
+    sketch = pd.DataFrame({key: sketch[key] if key == "time" else pd.Categorical(sketch[key]) for key in SKETCH_KEYS})
+    sketch["capacity"] = pd.Categorical.from_codes(capacity_codes[order], categories=capacities)
+    sketch["bin"] = bins[order].astype("int16")
+    sketch["weight"] = sums[order]
+    return sketch
+
+def merge_sketches(sketches, keys=SKETCH_KEYS):
+    # Sketch of the union of the rows of several sketches, by the given keys (the rest of the keys are combined)
+    sketch = functions.concat_frames(sketches) if len(sketches) > 1 else sketches[0]
+    merged = sketch.groupby(keys + ["capacity", "bin"], observed=True, sort=True)["weight"].sum()
+    return merged[merged > 0].reset_index()
+
+def sketch_quantiles(sketch, keys, quantiles):
+    """
+    Quantiles of the crowding by the keys (e.g. ["line_name"] or ["time"]), merging the sketches of the rest of
+    the keys. The sketch should hold a single capacity. Returns a frame indexed by the keys, with a column per
+    quantile, and the total weight of each group.
+    """
+    merged = sketch.groupby(keys + ["bin"], observed=True, sort=True)["weight"].sum()
+    merged = merged[merged > 0]
+    weights, bins = merged.to_numpy(), merged.index.get_level_values("bin").to_numpy()
+    group_ids, groups = merged.index.droplevel("bin").factorize()
+    starts = np.flatnonzero(np.r_[True, group_ids[1:] != group_ids[:-1]]) if len(group_ids) else np.zeros(0, dtype="int64")
+    ends = np.r_[starts[1:], len(group_ids)] - 1
+    cumulative = np.cumsum(weights)
+    before = cumulative[starts] - weights[starts]
+    totals = cumulative[ends] - before
+
+    result = pd.DataFrame(index=groups.set_names(keys))
+    for quantile in quantiles:
+        # First bin of each group whose cumulated weight reaches the rank of the quantile
+        positions = np.clip(np.searchsorted(cumulative, before + quantile * totals, side="left"), starts, ends)
+        result[f"P{quantile * 100:g}"] = bin_value(bins[positions])
+    result["weight"] = totals
+    return result
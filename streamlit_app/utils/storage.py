@@ -0,0 +1,64 @@
+import pandas as pd
+import io
+import os
+import shutil
+import utils.functions as functions
+
+OUTPUT_DIRECTORY = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "output")
+COMPRESSION = "zstd"
+PARTITION_FILE = "part-0.parquet"
+
+def dataset_name(years):
+    return f"processed_data_{years[0]}-{years[-1]}"
+
+def dataset_path(years, directory=OUTPUT_DIRECTORY):
+    return os.path.join(directory, dataset_name(years))
+
+def write_dataset(data, path):
+    # Store the processed data as Parquet, one partition per year: <path>/year=<year>/part-0.parquet
+    if os.path.isdir(path):
+        shutil.rmtree(path)
+    for year, year_data in data.groupby("year", sort=True, observed=True):
+        partition = os.path.join(path, f"year={year}")
+        os.makedirs(partition, exist_ok=True)
+        year_data.to_parquet(os.path.join(partition, PARTITION_FILE), index=False, compression=COMPRESSION)
+    return path
+
+def write_part(data, path, year, part):
+    # Additional file of a year partition, for data written in parts (e.g. by the streaming mode): <path>/year=<year>/part-<part>.parquet
+    partition = os.path.join(path, f"year={year}")
+    os.makedirs(partition, exist_ok=True)
+    data.to_parquet(os.path.join(partition, f"part-{part}.parquet"), index=False, compression=COMPRESSION)
+
+def partition_files(path, year):
+    # Files of a year partition, in the order of their part number
+    partition = os.path.join(path, f"year={year}")
+    names = [name for name in os.listdir(partition) if name.startswith("part-") and name.endswith(".parquet")]
+    return [os.path.join(partition, name) for name in sorted(names, key=lambda name: int(name[5:-8]))]
+
+def dataset_years(path):
+    return sorted(folder.split("=", 1)[1] for folder in os.listdir(path) if folder.startswith("year="))
+
+def list_datasets(directory=OUTPUT_DIRECTORY):
+    if not os.path.isdir(directory):
+        return []
+    return sorted(folder for folder in os.listdir(directory)
+                  if os.path.isdir(os.path.join(directory, folder)) and dataset_years(os.path.join(directory, folder)))
+
+def read_dataset(path, columns=None, years=None):
+    # Read the partitions of the selected years, loading only the requested columns
+    years = dataset_years(path) if years is None else [str(year) for year in years]
+    frames = [pd.read_parquet(file, columns=columns) for year in years for file in partition_files(path, year)]
+    return functions.concat_frames(frames)
+
+def to_parquet_bytes(data):
+    # Single Parquet file with all the years, to be downloaded and uploaded again as processed data
+    buffer = io.BytesIO()
+    data.to_parquet(buffer, index=False, compression=COMPRESSION)
+    return buffer.getvalue()
+
+def to_csv_bytes(data):
+    # CSV is only generated as an export format, on demand. Departure times are written as HH:MM:SS
+    if pd.api.types.is_numeric_dtype(data["departure_time"]):
+        data = data.assign(departure_time=functions.seconds_to_time(data["departure_time"]))
+    return data.to_csv(index=False).encode("utf-8")
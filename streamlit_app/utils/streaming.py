@@ -0,0 +1,143 @@
+import pandas as pd
+import numpy as np
+import logging
+import os
+import shutil
+import time
+import utils.data_loading as data_loading
+import utils.data_cleaning as data_cleaning
+import utils.ingestion as ingestion
+import utils.metrics as metrics
+import utils.pipeline_cache as pipeline_cache
+import utils.profiling as profiling
+import utils.sketches as sketches
+import utils.storage as storage
+import utils.global_values as global_values
+
+CHUNK_SIZE = 1_000_000 # Rows of REISENDE read at a time, which sets the peak memory of the streaming mode with the row hashes
+SECOND_HASH_KEY = "vbz-dedup-key-02" # 16 characters, for the second hash of the string columns
+
+logger = logging.getLogger(__name__)
+
+def row_hashes(data):
+    # Two independent 64-bit hashes of each row, the second one with the columns in reverse order and another key.
+    # Numeric columns are hashed as float64, as the dtypes of the same column may differ between chunks
+    data = data.assign(**{column: data[column].astype("float64") for column in data.columns
+                          if pd.api.types.is_numeric_dtype(data[column].dtype) and not isinstance(data[column].dtype, pd.CategoricalDtype)})
+    first = pd.util.hash_pandas_object(data, index=False).to_numpy()
+    second = pd.util.hash_pandas_object(data[data.columns[::-1]], index=False, hash_key=SECOND_HASH_KEY).to_numpy()
+    return first, second
+
+def seen_before(runs, first, second):
+    # Rows whose hashes are in any of the runs, arrays of the hashes of the rows kept so far sorted by the first hash.
+    # The rows are looked up in the order of their first hash, which keeps the searches local in memory
+    order = np.argsort(first)
+    first, second = first[order], second[order]
+    seen = np.zeros(len(first), dtype=bool)
+    for run_first, run_second in runs:
+        left = np.searchsorted(run_first, first, side="left")
+        right = np.searchsorted(run_first, first, side="right")
+        single = (right - left) == 1
+        seen[single] |= run_second[left[single]] == second[single]
+        for i in np.flatnonzero(right - left > 1): # Same first hash for several rows kept, compare the second one with all of them
+            seen[i] |= (run_second[left[i]:right[i]] == second[i]).any()
+    result = np.empty_like(seen)
+    result[order] = seen
+    return result
+
+def add_run(runs, first, second):
+    # Add the hashes of the new rows as a run sorted by the first hash, merging the last runs while they are of
+    # similar size, so that there are only O(log n) runs to search. The stable sort merges two sorted runs in linear time
+    order = np.argsort(first)
+    runs.append((first[order], second[order]))
+    while len(runs) > 1 and len(runs[-2][0]) <= 2 * len(runs[-1][0]):
+        (first_a, second_a), (first_b, second_b) = runs.pop(-2), runs.pop()
+        merged_first, merged_second = np.concatenate([first_a, first_b]), np.concatenate([second_a, second_b])
+        order = np.argsort(merged_first, kind="stable")
+        runs.append((merged_first[order], merged_second[order]))
+
+def stream_year(archive, year, chunk_size=CHUNK_SIZE, dataset_path=None):
+    """
+    Metric partials of a year, reading REISENDE in chunks of chunk_size rows. Each chunk is enriched with the
+    dimension attributes, cleaned and folded into the metric cube of the year, so the fact table of the year is
+    never held in memory. Duplicated rows are dropped across chunks by their 128-bit row hashes (the first
+    occurrence is kept, as in drop_duplicates). The hashes of all the rows kept so far stay in memory, so the memory
+    is not bounded by chunk_size alone: it also grows with the rows of the year, by 16 bytes per row (twice that
+    while the largest runs are merged). The cleaned chunks are written as parts of the year partition of
+    dataset_path, if given.
+
+    Returns the partials and a report with the row counts and referential integrity checks.
+    """
+    dimension_tables = data_loading.read_tables_from_zip(archive, tables=["LINIE", "HALTESTELLEN", "GEFAESSGROESSE"])
+    cube, pending_cubes, runs = None, [], []
+    sketch, pending_sketches = None, []
+    report = {"chunks": 0, "rows": 0, "duplicated_rows": 0}
+    for part, chunk in enumerate(data_loading.read_table_chunks_from_zip(archive, "REISENDE", chunk_size)):
+        merged = data_loading.merge_tables({**dimension_tables, "REISENDE": chunk}, year)
+        for key, value in merged.attrs["integrity"].items():
+            # Duplicated keys are counted on the dimension tables, the same for every chunk
+            report[key] = value if key == "duplicated_dimension_keys" else report.get(key, 0) + value
+
+        cleaned = data_cleaning.clean_data(merged.rename(global_values.MAPPING_ATTRIBUTES, axis=1))
+        first, second = row_hashes(cleaned)
+        new_rows = ~seen_before(runs, first, second)
+        add_run(runs, first[new_rows], second[new_rows])
+        report["duplicated_rows"] += len(chunk) - int(new_rows.sum())
+        cleaned = cleaned[new_rows]
+
+        report["chunks"] += 1
+        report["rows"] += len(cleaned)
+        if len(cleaned) == 0:
+            continue
+        if dataset_path is not None:
+            storage.write_part(cleaned, dataset_path, year, part)
+        # The cubes of the chunks are merged into the cube of the year once they add up to its size, so that the
+        # cube of the year is not rebuilt for every chunk
+        pending_cubes.append(metrics.build_metric_cube(cleaned))
+        if sum(len(pending) for pending in pending_cubes) >= (len(cube) if cube is not None else 0):
+            cube = metrics.merge_cubes(([cube] if cube is not None else []) + pending_cubes)
+            pending_cubes = []
+        # The crowding sketches of the chunks are merged in the same way
+        pending_sketches.append(sketches.build_sketches(cleaned))
+        if sum(len(pending) for pending in pending_sketches) >= (len(sketch) if sketch is not None else 0):
+            sketch = sketches.merge_sketches(([sketch] if sketch is not None else []) + pending_sketches)
+            pending_sketches = []
+        logger.info("year %s: %d chunks, %d rows", year, report["chunks"], report["rows"])
+
+    if cube is None:
+        raise ValueError(f"No rows found in REISENDE.csv for {year}")
+    if pending_cubes:
+        cube = metrics.merge_cubes([cube] + pending_cubes)
+    if pending_sketches:
+        sketch = sketches.merge_sketches([sketch] + pending_sketches)
+    partials = metrics.partial_metrics_from_cube(cube)
+    partials["crowding"] = sketch
+    return partials, report
+
+def stream_archives(archives, dataset_path=None, chunk_size=CHUNK_SIZE):
+    """
+    Metric partials of the archives, a list of (year, archive) tuples, streamed one year after the other.
+    The partials are stored in the pipeline cache under the same keys as the in-memory path, a failing year is
+    reported and does not stop the rest of the years.
+
+    Returns the partials sorted by year, a report per year and the archive key of each year streamed.
+    """
+    if dataset_path is not None and os.path.isdir(dataset_path):
+        shutil.rmtree(dataset_path)
+    partials, report, archive_keys = [], {}, {}
+    for year, archive in sorted(archives, key=lambda item: item[0]):
+        start = time.perf_counter()
+        try:
+            with profiling.stage("stream year", year) as record:
+                year_partials, report[year] = stream_year(ingestion.open_archive(archive), year, chunk_size, dataset_path)
+                record["rows_out"] = report[year]["rows"]
+        except Exception as e:
+            report[year] = {"status": "failed", "rows": 0, "error": str(e)}
+            if dataset_path is not None:
+                shutil.rmtree(os.path.join(dataset_path, f"year={year}"), ignore_errors=True)
+            continue
+        report[year] = {"status": "streamed", "seconds": round(time.perf_counter() - start, 2), "error": None, **report[year]}
+        archive_keys[year] = pipeline_cache.archive_key(archive)
+        pipeline_cache.save_object(pipeline_cache.entry_key("partials", archive_keys[year]), year_partials)
+        partials.append(year_partials)
+    return partials, report, archive_keys